@@ -36,194 +36,3184 @@ import datetime
 import re
 import time
 import ftplib
+import sqlite3
+import socket
 import threading
+import collections
+import asyncore
+import asynchat
+import heapq
+import itertools
+import random
 import logging.handlers
 import sys
 import traceback
 import signal
 import StringIO
+import hashlib
+import Queue
+import json
+import BaseHTTPServer
 import ConfigParser
 import platform
+import stat
+import mmap
+import select
+import struct
+import errno
+import ctypes
+import ctypes.util
+import multiprocessing
+import tarfile
+import copy
+try:
+    from os import scandir          # Python 3.5 and later
+except ImportError:
+    try:
+        from scandir import scandir # the scandir package from PyPI
+    except ImportError:
+        scandir = None
+try:
+    from PIL import Image           # only needed to recompress images
+except ImportError:
+    Image = None
 
 version_string = "2.3.1"
 
+
+def mkdir(dirname):
+    try:
+        os.mkdir(dirname)
+    except:
+        pass
+
+
+def rmdir(dirname):
+    try:
+        os.rmdir(dirname)
+    except:
+        pass
+
+
+class Metrics():
+    """Counters, gauges and histograms describing what the uploader is 
+    doing, for the metrics HTTP endpoint and snapshot file.
+    
+    Each metric is declared once with counter(), gauge() or histogram(),
+    and its values are kept per set of labels, given as a dict.  Functions
+    added with add_collector() are called before the values are read, to
+    set gauges that are cheaper to work out on demand.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = collections.OrderedDict()  # name -> (type, help, buckets)
+        self.values = {}    # name -> {labels -> value or histogram}
+        self.collectors = []
+        
+    def _declare(self, name, kind, help_text, buckets=None):
+        with self.lock:
+            self.kinds[name] = (kind, help_text, buckets)
+            self.values[name] = {}
+            
+    def counter(self, name, help_text):
+        self._declare(name, "counter", help_text)
+        
+    def gauge(self, name, help_text):
+        self._declare(name, "gauge", help_text)
+        
+    def histogram(self, name, help_text, buckets):
+        self._declare(name, "histogram", help_text, sorted(buckets))
+        
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+        
+    def inc(self, name, amount=1, labels=None):
+        key = self._key(labels)
+        with self.lock:
+            values = self.values[name]
+            values[key] = values.get(key, 0) + amount
+            
+    def set(self, name, value, labels=None):
+        with self.lock:
+            self.values[name][self._key(labels)] = value
+            
+    def clear(self, name):
+        """Forget the values of name for all labels, e.g., before setting a
+        gauge for each of the days that now exist
+        """
+        with self.lock:
+            self.values[name] = {}
+            
+    def observe(self, name, value, labels=None):
+        key = self._key(labels)
+        buckets = self.kinds[name][2]
+        with self.lock:
+            values = self.values[name]
+            if key not in values:
+                values[key] = [[0] * len(buckets), 0.0, 0]
+            hist = values[key]
+            for i in range(len(buckets)):
+                if value <= buckets[i]:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+            
+    def export(self):
+        """Return a copy of all the values, for merge() in another process"""
+        self._collect()
+        with self.lock:
+            return copy.deepcopy(self.values)
+        
+    def merge(self, values, labels, skip=()):
+        """Replace the values that have labels with values, from export()
+        in another process, with labels added to them.  The metrics named
+        in skip belong to this process and are left alone.
+        """
+        extra = self._key(labels)
+        with self.lock:
+            for (name, series) in values.items():
+                if name not in self.values or name in skip:
+                    continue
+                current = self.values[name]
+                for key in [key for key in current 
+                            if set(extra) <= set(key)]:
+                    del current[key]
+                for (key, value) in series.items():
+                    current[tuple(sorted(key + extra))] = value
+                    
+    def get(self, name, labels=None):
+        """Return the value of a counter or gauge; for tests"""
+        with self.lock:
+            return self.values[name].get(self._key(labels), 0)
+        
+    def total(self, name):
+        """Return the sum of a counter's values for all labels"""
+        with self.lock:
+            return sum(self.values[name].values())
+        
+    def reset(self):
+        with self.lock:
+            for name in self.values:
+                self.values[name] = {}
+    
+    def _key(self, labels):
+        if not labels:
+            return ()
+        return tuple(sorted(labels.items()))
+    
+    def _collect(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception, e:
+                logging.error("metrics collector failed: %s", e)
+                
+    def prometheus(self):
+        """Return the metrics in the Prometheus text exposition format"""
+        self._collect()
+        lines = []
+        with self.lock:
+            for (name, (kind, help_text, buckets)) in self.kinds.items():
+                lines.append("# HELP %s %s" % (name, help_text))
+                lines.append("# TYPE %s %s" % (name, kind))
+                for (key, value) in sorted(self.values[name].items()):
+                    if kind != "histogram":
+                        lines.append("%s%s %s" % (name, prom_labels(key), 
+                                                  prom_number(value)))
+                        continue
+                    (counts, total, count) = value
+                    for (bound, n) in zip(buckets, counts):
+                        le = key + (("le", prom_number(bound)),)
+                        lines.append("%s_bucket%s %d" % (name, 
+                                                         prom_labels(le), n))
+                    le = key + (("le", "+Inf"),)
+                    lines.append("%s_bucket%s %d" % (name, prom_labels(le), 
+                                                     count))
+                    lines.append("%s_sum%s %s" % (name, prom_labels(key), 
+                                                  prom_number(total)))
+                    lines.append("%s_count%s %d" % (name, prom_labels(key), 
+                                                    count))
+        return "\n".join(lines) + "\n"
+    
+    def snapshot(self):
+        """Return the metrics as a dict that can be written as JSON"""
+        self._collect()
+        snap = {'time': time.time(), 'metrics': {}}
+        with self.lock:
+            for (name, (kind, help_text, buckets)) in self.kinds.items():
+                series = []
+                for (key, value) in sorted(self.values[name].items()):
+                    entry = {'labels': dict(key)}
+                    if kind == "histogram":
+                        (counts, total, count) = value
+                        entry['buckets'] = zip(buckets, counts)
+                        entry['sum'] = total
+                        entry['count'] = count
+                    else:
+                        entry['value'] = value
+                    series.append(entry)
+                snap['metrics'][name] = {'type': kind, 'help': help_text,
+                                         'values': series}
+        return snap
+    
+    def write_snapshot(self, path):
+        """Write snapshot() to path as JSON, replacing it atomically"""
+        tmppath = path + ".tmp"
+        with open(tmppath, "w") as f:
+            json.dump(self.snapshot(), f, indent=1, sort_keys=True)
+        os.rename(tmppath, path)
+    
+def prom_labels(key):
+    if not key:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", 
+                    "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                             for (name, value) in key)
+
+def prom_number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+AGE_BUCKETS = (1, 5, 15, 60, 300, 900, 3600, 4 * 3600, 12 * 3600, 86400,
+               3 * 86400, 7 * 86400)
+
+metrics = Metrics()
+metrics.counter("ftp_upload_files_total", "Files uploaded")
+metrics.counter("ftp_upload_bytes_total", "Bytes uploaded")
+metrics.counter("ftp_upload_failures_total", "Failed upload attempts")
+metrics.counter("ftp_upload_retries_total", "Uploads queued to be retried")
+metrics.counter("ftp_upload_dedup_files_total", 
+                "Files not sent because the server had their content")
+metrics.counter("ftp_upload_dedup_bytes_saved_total", 
+                "Bytes not sent because the server had the content")
+metrics.histogram("ftp_upload_file_seconds", 
+                  "Time taken to upload a file", LATENCY_BUCKETS)
+metrics.histogram("ftp_upload_age_seconds", 
+                  "Time from the camera writing a file to its upload", 
+                  AGE_BUCKETS)
+metrics.histogram("ftp_upload_connect_seconds", 
+                  "Time taken to connect and log in to the FTP server", 
+                  LATENCY_BUCKETS)
+metrics.gauge("ftp_upload_backlog_files", 
+              "Files in the incoming tree waiting to be uploaded")
+metrics.gauge("ftp_upload_backlog_bytes", 
+              "Bytes in the incoming tree waiting to be uploaded")
+metrics.gauge("ftp_upload_queued_files", "Files in the upload queue")
+metrics.gauge("ftp_upload_active_workers", "Uploads in progress")
+metrics.gauge("ftp_upload_unready_files", 
+              "Files in the incoming tree still being written")
+metrics.gauge("ftp_upload_concurrency_limit", 
+              "Uploads allowed at once by the concurrency controller")
+metrics.counter("ftp_upload_concurrency_changes_total",
+                "Changes made to the upload concurrency limit")
+metrics.gauge("ftp_upload_throughput_bytes", 
+              "Bytes per second uploaded in the controller's last interval")
+metrics.counter("ftp_upload_process_restarts_total",
+                "Upload processes restarted after dying")
+metrics.counter("ftp_upload_log_records_dropped_total",
+                "Log records below WARNING dropped because the log was busy")
+metrics.counter("ftp_upload_bundles_total", 
+                "Tar archives of previous days' images uploaded")
+metrics.counter("ftp_upload_recompress_files_total", 
+                "Images recompressed before upload")
+metrics.counter("ftp_upload_recompress_failures_total",
+                "Images that couldn't be recompressed")
+metrics.counter("ftp_upload_recompress_bytes_saved_total",
+                "Bytes saved by recompressing images")
+metrics.counter("ftp_upload_recompress_cpu_seconds_total",
+                "CPU seconds spent recompressing images")
+
+def record_upload(filepath, started, target_name, source=None):
+    """Count filepath as just uploaded, which it took since started to send
+    to the target called target_name.  source is the file that was sent in
+    its place, if any, e.g., a recompressed copy; the bytes sent are
+    counted from it, but the age is still that of filepath.
+    """
+    now = time.time()
+    labels = {'target': target_name}
+    metrics.inc("ftp_upload_files_total", labels=labels)
+    metrics.observe("ftp_upload_file_seconds", now - started, labels)
+    if source == None:
+        source = filepath
+    try:
+        st = os.stat(source)
+    except OSError:
+        return
+    try:
+        mtime = os.stat(filepath).st_mtime
+    except OSError:
+        mtime = st.st_mtime
+    metrics.inc("ftp_upload_bytes_total", st.st_size, labels)
+    metrics.observe("ftp_upload_age_seconds", now - mtime, labels)
+    
+def record_failure(kind, target_name):
+    metrics.inc("ftp_upload_failures_total", 
+                labels={'target': target_name, 'kind': kind})
+
+summary_totals = None    # the counter totals at the last summary
+
+def log_upload_summary():
+    """Log the number of files uploaded and failed since the last call, in
+    place of a line for each file
+    """
+    global summary_totals
+    now = time.time()
+    totals = (now, metrics.total("ftp_upload_files_total"),
+              metrics.total("ftp_upload_bytes_total"),
+              metrics.total("ftp_upload_failures_total"),
+              metrics.total("ftp_upload_retries_total"),
+              metrics.total("ftp_upload_dedup_bytes_saved_total"),
+              metrics.total("ftp_upload_recompress_bytes_saved_total"),
+              metrics.total("ftp_upload_recompress_cpu_seconds_total"),
+              metrics.total("ftp_upload_log_records_dropped_total"))
+    if summary_totals != None:
+        (seconds, nfiles, nbytes, failures, retries, saved, shrunk, 
+         cpu, dropped) = [a - b for (a, b) in zip(totals, summary_totals)]
+        logging.info("uploaded %d files, %.1f MB in the last %.0f seconds; "
+                     "%d failed attempts, %d retries queued", nfiles,
+                     nbytes / 1048576.0, seconds, failures, retries)
+        if saved:
+            logging.info("deduplication saved sending %.1f MB", 
+                         saved / 1048576.0)
+        if cpu:
+            logging.info("recompression saved sending %.1f MB using %.1f "
+                         "CPU seconds", shrunk / 1048576.0, cpu)
+        if dropped:
+            logging.warning("%d log records were dropped because the log "
+                            "couldn't keep up", dropped)
+    summary_totals = totals
+
+def measure_backlog(incoming):
+    """Set the backlog gauges for each day directory in incoming.  This
+    walks the whole incoming tree, so it's only done when metrics are on.
+    """
+    counts = []
+    for (dirpath, day) in get_daydirs(incoming):
+        nfiles = 0
+        nbytes = 0
+        for (path, unused_relpath, is_file) in walk_tree(dirpath):
+            if is_file:
+                try:
+                    nbytes += os.lstat(path).st_size
+                except OSError:
+                    continue
+                nfiles += 1
+        counts.append((day, nfiles, nbytes))
+    metrics.clear("ftp_upload_backlog_files")
+    metrics.clear("ftp_upload_backlog_bytes")
+    for (day, nfiles, nbytes) in counts:
+        metrics.set("ftp_upload_backlog_files", nfiles, {'day': day})
+        metrics.set("ftp_upload_backlog_bytes", nbytes, {'day': day})
+
+def collect_executor_metrics():
+    if readiness != None:
+        metrics.set("ftp_upload_unready_files", readiness.count())
+    executor = upload_executor
+    if executor == None:
+        return
+    metrics.clear("ftp_upload_queued_files")
+    metrics.clear("ftp_upload_active_workers")
+    for executor in getattr(executor, "executors", [executor]):
+        name = getattr(executor, "target", None)
+        name = "primary" if name == None else name.name
+        counts = executor.scheduler.counts()
+        for queue in ("today", "backlog"):
+            labels = {'target': name, 'queue': queue}
+            metrics.set("ftp_upload_queued_files", 
+                        counts['queued_' + queue], labels)
+            metrics.set("ftp_upload_active_workers", 
+                        counts['active_' + queue], labels)
+        metrics.set("ftp_upload_queued_files", counts['delayed'],
+                    {'target': name, 'queue': "delayed"})
+        
+metrics.add_collector(collect_executor_metrics)
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves /metrics in the Prometheus text format and /metrics.json as
+    the snapshot
+    """
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = metrics.prometheus()
+            content_type = "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body = json.dumps(metrics.snapshot(), sort_keys=True)
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        
+    def log_message(self, fmt, *args):
+        logging.debug("metrics: " + fmt, *args)
+
+metrics_server = None
+metrics_stop = threading.Event()
+metrics_threads = []
+
+def start_metrics():
+    """Start serving metrics on metrics_port and writing them to 
+    metrics_snapshot_path, as configured
+    """
+    global metrics_server
+    metrics_stop.clear()
+    if cfg.metrics_port:
+        metrics_server = BaseHTTPServer.HTTPServer((cfg.metrics_address, 
+                                                    cfg.metrics_port),
+                                                   MetricsHandler)
+        thread = threading.Thread(target=metrics_server.serve_forever,
+                                  name="metrics-http")
+        thread.daemon = True
+        thread.start()
+        metrics_threads.append(thread)
+        logging.info("serving metrics on %s:%d", cfg.metrics_address, 
+                     metrics_server.server_address[1])
+    if cfg.metrics_snapshot_path:
+        thread = threading.Thread(target=write_metrics_snapshots,
+                                  name="metrics-snapshot")
+        thread.daemon = True
+        thread.start()
+        metrics_threads.append(thread)
+        
+def write_metrics_snapshots():
+    while not metrics_stop.is_set():
+        try:
+            metrics.write_snapshot(cfg.metrics_snapshot_path)
+        except Exception, e:
+            logging.error("couldn't write the metrics snapshot: %s", e)
+        metrics_stop.wait(cfg.metrics_snapshot_interval)
+        
+def stop_metrics():
+    global metrics_server
+    metrics_stop.set()
+    if metrics_server != None:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+        metrics_server = None
+    while metrics_threads:
+        metrics_threads.pop().join()
+
+
+class RemoteDirCache():
+    """The remote directories known to exist on the FTP server, shared by
+    all the FTP sessions so that a directory one session has made or visited
+    isn't checked for again.  A directory is forgotten, along with the
+    directories under it, when the server refuses a command in it.
+    """
+    max_dirs = 10000    # forget everything rather than grow without limit
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirs = set()
+        self.saved = 0  # the number of round trips the cache has saved
+        
+    def known(self, dirname):
+        with self.lock:
+            return dirname in self.dirs
+        
+    def add(self, dirname):
+        """Remember dirname and its parents.  Only absolute paths are kept."""
+        if not dirname.startswith("/"):
+            return
+        with self.lock:
+            if len(self.dirs) >= self.max_dirs:
+                self.dirs.clear()
+            while dirname not in ("", "/") and dirname not in self.dirs:
+                self.dirs.add(dirname)
+                dirname = dirname.rsplit("/", 1)[0]
+                
+    def forget(self, dirname):
+        with self.lock:
+            prefix = dirname.rstrip("/") + "/"
+            self.dirs = set(d for d in self.dirs 
+                            if d != dirname and not d.startswith(prefix))
+            
+    def count_saved(self, round_trips=1):
+        with self.lock:
+            self.saved += round_trips
+            
+    def clear(self):
+        with self.lock:
+            self.dirs.clear()
+
+remote_dirs = RemoteDirCache()
+
+def change_create_ftp_dir(ftp_connection, dirname, dirs=None):
+    # dirname is relative or absolute; dirs is the RemoteDirCache for the
+    # server, by default the one for ftp_server
+    if dirs == None:
+        dirs = remote_dirs
+    
+    if ftp_connection != None:
+        try:
+            ftp_connection.cwd(dirname)
+        except ftplib.error_perm :
+            dirs.forget(dirname)    # it's gone from the server
+            try:
+                try:
+                    ftp_connection.mkd(dirname)
+                except ftplib.error_perm:
+                    # the parent directory may not exist yet, e.g., when a
+                    # file in a new day directory is queued straight from
+                    # the watcher, so create the path a level at a time
+                    make_ftp_path(ftp_connection, dirname, dirs=dirs)
+                ftp_connection.cwd(dirname)     
+            except Exception, e:
+                logging.warning("can't make/change to ftp directory %s" % dirname)
+                logging.exception(e)
+                return False
+        dirs.add(dirname)
+        
+    return True
+
+def make_ftp_path(ftp_connection, dirname, use_cache=True, dirs=None):
+    # dirname is absolute; create each missing directory along it
+    if dirs == None:
+        dirs = remote_dirs
+    path = ""
+    for part in dirname.strip("/").split("/"):
+        parent = path
+        path += "/" + part
+        if use_cache and dirs.known(path):
+            dirs.count_saved()
+            continue
+        try:
+            ftp_connection.cwd(path)
+        except ftplib.error_perm:
+            try:
+                ftp_connection.mkd(path)
+            except ftplib.error_perm:
+                try:
+                    # another session may have just made it
+                    ftp_connection.cwd(path)
+                    continue
+                except ftplib.error_perm:
+                    pass
+                if not use_cache:
+                    raise
+                # a directory we thought was there has gone, so start again
+                # without trusting the cache
+                dirs.forget(parent)
+                make_ftp_path(ftp_connection, dirname, use_cache=False, 
+                              dirs=dirs)
+                return
+
+def dir2date(indir):
+    #extract date from indir style z:\\ftp\\12-01-2
+    searchresult = re.search(r".*/([0-9]{4})-([0-9]{2})-([0-9]{2})", indir)
+    if searchresult == None:     #extract date from indir style 12-01-2
+        searchresult = re.search(r".*([0-9]{4})-([0-9]{2})-([0-9]{2})", indir)
+        
+    if searchresult != None:
+        year= int(searchresult.group(1))
+        month = int(searchresult.group(2))
+        day = int(searchresult.group(3))
+    else:
+        year = None
+        month = None
+        day = None
+
+    return (year, month, day)
+
+
+def iter_dir(dirpath):
+    """Yield (name, path, is_file, is_dir) for each entry in dirpath.
+    
+    With scandir, the entry types come from the directory itself (d_type)
+    on most filesystems, so nothing is stat'ed.  Without it, each entry is
+    stat'ed once.
+    """
+    if scandir != None:
+        for entry in scandir(dirpath):
+            yield (entry.name, entry.path, entry.is_file(), entry.is_dir())
+    else:
+        for name in os.listdir(dirpath):
+            path = os.path.join(dirpath, name)
+            try:
+                mode = os.stat(path).st_mode
+            except OSError:
+                continue    # removed since the listing was made
+            yield (name, path, stat.S_ISREG(mode), stat.S_ISDIR(mode))
+
+def walk_tree(top):
+    """Walk the tree below top, yielding (path, relpath, is_file) lazily.
+    
+    Files are yielded as they are found.  Each directory is yielded after
+    everything below it, so that it can be removed once it is empty.
+    relpath is the path relative to top.
+    """
+    for (name, path, is_file, is_dir) in iter_dir(top):
+        if is_file:
+            yield (path, name, True)
+        elif is_dir:
+            for (subpath, subrel, sub_is_file) in walk_tree(path):
+                yield (subpath, os.path.join(name, subrel), sub_is_file)
+            yield (path, name, False)
+
+def get_daydirs(location):        
+    daydirs=[]
+    for (direc, dirpath, unused_is_file, is_dir) in iter_dir(location):
+        (year, unused_month, unused_day) = dir2date(direc)
+        if is_dir and year != None:
+            daydirs.append((dirpath,direc))
+    daydirs = sorted(daydirs)
+
+    return daydirs	
+
+
+class UploadTarget():
+    """An FTP server and destination directory that images are uploaded to.
+    
+    ftp_server and ftp_destination are the primary target.  Each server
+    named in mirror_targets gets a copy of every file as well, through its
+    own session pool and cache of remote directories.
+    """
+    def __init__(self, name, server, port, username, password, destination,
+                 required=True, primary=False):
+        self.name = name
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.destination = destination
+        self.required = required    # files wait until this target has them
+        self.primary = primary
+        if primary:
+            self.remote_dirs = remote_dirs
+        else:
+            self.remote_dirs = RemoteDirCache()
+        self.lock = threading.Lock()
+        self.pool = None
+        
+    def get_pool(self):
+        if self.primary:
+            return get_ftp_pool()
+        with self.lock:
+            if self.pool == None:
+                self.pool = FTPSessionPool(cfg.ftp_pool_size, 
+                                           cfg.ftp_keepalive, self)
+            return self.pool
+        
+    def close_pool(self):
+        with self.lock:
+            if self.pool != None:
+                self.pool.close()
+                self.pool = None
+        self.remote_dirs.clear()
+        
+    def remote_dir(self, ftp_dir):
+        """Return the directory on this target that corresponds to ftp_dir,
+        a directory under ftp_destination
+        """
+        if ftp_dir.startswith(cfg.ftp_destination):
+            return self.destination + ftp_dir[len(cfg.ftp_destination):]
+        return ftp_dir
+    
+def primary_target():
+    """Return the UploadTarget for ftp_server and ftp_destination"""
+    return UploadTarget("primary", cfg.ftp_server, cfg.ftp_port, 
+                        cfg.ftp_username, cfg.ftp_password, 
+                        cfg.ftp_destination, primary=True)
+        
+def connect_to_ftp(target=None):
+    """Open an FTP connection, log in and change to cfg.ftp_destination, or
+    to the destination of target, an UploadTarget, if one is given.
+    Failures are logged and the exception is raised again so the caller
+    can decide when to try again.
+    """
+    if target == None:
+        target = primary_target()
+    ftp_connection = None   
+    started = time.time()
+    try:
+        ftp_connection = ftplib.FTP(timeout=30)
+        ftp_connection.connect(target.server, target.port)
+        ftp_connection.login(target.username, target.password)
+        logging.debug(ftp_connection.getwelcome())
+        logging.debug("current directory is: %s", ftp_connection.pwd())
+        logging.debug("changing directory to: %s", target.destination)
+        ftp_connection.cwd(target.destination)
+        logging.debug("current directory is: %s", ftp_connection.pwd())
+        metrics.observe("ftp_upload_connect_seconds", time.time() - started,
+                        {'target': target.name})
+    except ftplib.error_perm, e:
+        logging.error("Failed to open FTP connection, %s", e)
+        if ftp_connection != None:
+            ftp_connection.close()
+        raise
+    except Exception, e:
+        logging.error("Unexpected exception in connect_to_ftp():")
+        logging.exception(e)
+        if ftp_connection != None:
+            ftp_connection.close()  # close any connection to cloud server
+        raise
+        
+    return ftp_connection
+
+def quit_ftp(ftp_connection):
+    if ftp_connection != None :
+        try:
+            ftp_connection.quit()
+            logging.debug("ftp connection successfully closed")
+        except Exception, e:
+            #logging.warning("Exception during FTP.quit():", e)
+            logging.warning("Exception during FTP.quit():")
+            logging.exception(e)
+
+
+# Exceptions that mean the control connection of an FTP session can no longer
+# be trusted.  A session that raises one of these (or a 421 reply, see
+# connection_lost()) is dropped from the pool.
+#
+ftp_connection_errors = (socket.error, EOFError, ftplib.error_reply,
+                         ftplib.error_proto)
+
+def connection_lost(e):
+    return isinstance(e, ftp_connection_errors) or str(e).startswith("421")
+
+# The outcomes of an upload.  Each kind of failure is retried differently;
+# see UploadExecutor.
+#
+UPLOAD_OK = "ok"
+FAIL_TRANSIENT = "transient"    # network trouble or a 4xx reply
+FAIL_AUTH = "auth"              # the server won't let us log in
+FAIL_PERMANENT = "permanent"    # the server or filesystem refuses this file
+FAIL_BUSY = "busy"              # 421: the server has too many connections
+
+def classify_failure(e):
+    """Return the kind of failure that exception e represents"""
+    if isinstance(e, ftplib.error_temp) and str(e).startswith("421"):
+        return FAIL_BUSY
+    if isinstance(e, ftplib.error_perm):
+        if str(e).startswith("530"):
+            return FAIL_AUTH
+        return FAIL_PERMANENT
+    if isinstance(e, (socket.error, EOFError, ftplib.Error)):
+        return FAIL_TRANSIENT
+    if isinstance(e, EnvironmentError):
+        return FAIL_PERMANENT   # e.g., the local file can't be read
+    return FAIL_TRANSIENT
+
+def batch_result(results):
+    """Return the outcome of a batch of uploads made on one session, from 
+    the results of each, for the circuit breaker: a login failure, or 
+    otherwise success if any file got through, or else the first failure.
+    """
+    if FAIL_AUTH in results:
+        return FAIL_AUTH
+    if UPLOAD_OK in results:
+        return UPLOAD_OK
+    for kind in (FAIL_TRANSIENT, FAIL_BUSY):
+        if kind in results:
+            return kind
+    return results[0]
+
+
+class RetryPolicy():
+    """Exponential backoff with jitter.  The delay before the nth retry is
+    chosen at random between half and all of base * 2**(n-1) seconds,
+    capped at cap seconds, so that workers that failed together don't all
+    come back at the same moment.
+    """
+    def __init__(self, base, cap):
+        self.base = base
+        self.cap = cap
+        
+    def delay(self, attempt):
+        delay = min(self.cap, self.base * 2 ** (attempt - 1))
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+    
+
+class CircuitBreaker():
+    """Shared by all the upload workers to stop them all from hammering a
+    server that is down or refusing our login.
+    
+    After threshold consecutive connection failures, or any login failure,
+    the breaker opens and allow() returns False until a backoff delay has
+    passed.  Then a single upload is allowed through as a probe: if it
+    works the breaker closes, and if not it opens again for longer.
+    """
+    def __init__(self, threshold, policy):
+        self.threshold = threshold
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.failures = 0       # consecutive failures
+        self.trips = 0          # consecutive times the breaker has opened
+        self.open_until = 0
+        self.probing = False
+        
+    def allow(self):
+        with self.lock:
+            if time.time() < self.open_until:
+                return False
+            if self.trips:
+                if self.probing:
+                    return False
+                self.probing = True
+            return True
+        
+    def success(self):
+        with self.lock:
+            if self.trips:
+                logging.info("FTP server is back; resuming uploads")
+            self.failures = 0
+            self.trips = 0
+            self.probing = False
+            
+    def failure(self, kind):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if kind == FAIL_AUTH or self.failures >= self.threshold:
+                self.trips += 1
+                delay = self.policy.delay(self.trips)
+                self.open_until = time.time() + delay
+                logging.warning("FTP server failing (%s); pausing uploads "
+                                "for %.0f seconds", kind, delay)
+                
+    def busy(self):
+        """The server is up but has too many connections.  End any probe
+        without opening or closing the breaker, so the next upload is
+        another probe.
+        """
+        with self.lock:
+            self.probing = False
+            
+    def remaining(self):
+        with self.lock:
+            return max(0, self.open_until - time.time())
+
+
+class FTPSession():
+    """A logged-in FTP connection that is checked out of an FTPSessionPool.
+    The session remembers the remote directory it is in so that callers can
+    skip redundant CWD commands.
+    """
+    def __init__(self, ftp_connection, target=None):
+        if target == None:
+            target = primary_target()
+        self.ftp = ftp_connection
+        self.cwd = target.destination   # connect_to_ftp() leaves us here
+        self.dirs = target.remote_dirs
+        self.last_used = time.time()
+        self.broken = False     # set when the connection can't be reused
+
+
+class FTPSessionPool():
+    """A bounded, thread-safe pool of logged-in FTP sessions.
+    
+    Workers check a session out with get() and give it back with put().
+    At most size sessions are open at once; get() blocks while they are all
+    checked out.  Sessions that have sat idle for longer than keepalive
+    seconds are probed with NOOP before being handed out, and sessions found
+    to be dead are closed and replaced with a fresh connection.
+    
+    The sessions are connected to target, an UploadTarget, or by default to
+    ftp_server.
+    """
+    def __init__(self, size, keepalive, target=None):
+        self.target = target
+        self.size = size
+        self.keepalive_interval = keepalive
+        self.slots = threading.Semaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []          # idle sessions, most recently used last
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        
+    def get(self):
+        """Check out a session, blocking until one is available.  If a new
+        connection is needed and can't be made, connect_to_ftp()'s exception
+        is raised.
+        """
+        self.slots.acquire()
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                session = self.idle.pop()
+            if self._alive(session):
+                with self.lock:
+                    self.reused += 1
+                return session
+            self._close(session)
+            
+        try:
+            ftp_connection = connect_to_ftp(self.target)
+        except:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.created += 1
+        return FTPSession(ftp_connection, self.target)
+    
+    def put(self, session):
+        """Return a session to the pool.  Broken sessions are closed."""
+        if session.broken:
+            self._close(session)
+        else:
+            session.last_used = time.time()
+            with self.lock:
+                self.idle.append(session)
+        self.slots.release()
+        
+    def keepalive(self):
+        """Send a NOOP on each idle session that hasn't been used within the
+        keepalive interval, and drop the sessions that don't answer.
+        """
+        now = time.time()
+        with self.lock:
+            stale = [s for s in self.idle
+                     if now - s.last_used >= self.keepalive_interval]
+            self.idle = [s for s in self.idle if s not in stale]
+        for session in stale:
+            if self._alive(session):
+                with self.lock:
+                    self.idle.insert(0, session)
+            else:
+                self._close(session)
+                
+    def close(self):
+        """Log out of all the idle sessions."""
+        self.trim(0)
+            
+    def trim(self, keep):
+        """Log out of the least recently used idle sessions, keeping keep"""
+        with self.lock:
+            count = max(0, len(self.idle) - keep)
+            idle = self.idle[:count]
+            self.idle = self.idle[count:]
+        for session in idle:
+            quit_ftp(session.ftp)
+            
+    def _alive(self, session):
+        if time.time() - session.last_used < self.keepalive_interval:
+            return True
+        try:
+            session.ftp.voidcmd("NOOP")
+            session.last_used = time.time()
+            return True
+        except Exception, e:
+            logging.info("dropping dead FTP session: %s", e)
+            return False
+        
+    def _close(self, session):
+        with self.lock:
+            self.discarded += 1
+        try:
+            session.ftp.close()
+        except Exception:
+            pass
+        
+
+ftp_pool = None
+ftp_pool_lock = threading.Lock()
+
+def get_ftp_pool():
+    """Return the process-wide FTP session pool, creating it if need be"""
+    global ftp_pool
+    with ftp_pool_lock:
+        if ftp_pool == None:
+            ftp_pool = FTPSessionPool(cfg.ftp_pool_size, cfg.ftp_keepalive)
+        return ftp_pool
+
+def close_ftp_pool():
+    global ftp_pool
+    with ftp_pool_lock:
+        if ftp_pool != None:
+            ftp_pool.close()
+            ftp_pool = None
+    remote_dirs.clear()     # the server may change before we reconnect
+    for target in cfg.mirror_targets:
+        target.close_pool()
+
+
+def change_session_dir(session, dirname):
+    """Change the session's remote directory to dirname, creating it if
+    necessary.  Nothing is sent if the session is already in dirname.
+    """
+    if session.cwd == dirname:
+        session.dirs.count_saved()
+        return True
+    session.cwd = None
+    try:
+        if not change_create_ftp_dir(session.ftp, dirname, session.dirs):
+            return False
+    except Exception, e:
+        logging.warning("lost FTP connection changing to %s: %s", dirname, e)
+        session.broken = connection_lost(e)
+        return False
+    session.cwd = dirname
+    return True
+
+def remote_size(ftp_connection, filename):
+    """Return the size of filename on the server, or None if it's not there"""
+    ftp_connection.voidcmd("TYPE I")    # SIZE is only exact in binary mode
+    try:
+        return ftp_connection.size(filename)
+    except ftplib.error_perm:
+        return None
+
+class TokenBucket():
+    """A token bucket limiting a flow of bytes to rate bytes per second,
+    with bursts of up to burst bytes.
+    
+    take() doesn't sleep itself; it charges the bytes to the bucket, which
+    may go into debt, and returns how long the caller should wait.  Callers
+    that share the bucket queue up behind the debt, so together they get
+    no more than rate.
+    """
+    def __init__(self, rate, burst=None):
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.burst = 0
+        self.tokens = 0
+        self.stamp = time.time()
+        self.set_rate(rate, burst)
+        self.tokens = self.burst
+        
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self.rate = rate
+            if burst == None:
+                burst = max(65536, rate / 10)
+            self.burst = burst
+            self.tokens = min(self.tokens, burst)
+        
+    def take(self, nbytes):
+        """Charge nbytes to the bucket.
+        :return: the number of seconds to wait before sending more
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, 
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= nbytes
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / float(self.rate)
+        
+
+class RateLimiter():
+    """Limits the upload bandwidth so that uploading a backlog doesn't
+    swamp a shared uplink.
+    
+    There can be a cap on all uploads together, separate caps on today's
+    and on previous days' uploads, and caps on the uploads from each camera
+    location.  Rates are in bytes per second; 0 means no limit.  The
+    schedule is a list of (start, end, rate) daily windows, in minutes since
+    midnight, during which rate replaces the overall, today's and backlog
+    caps, e.g., to run at full speed at night.  Location caps always apply.
+    """
+    def __init__(self, rate, today_rate, backlog_rate, location_rates,
+                 schedule):
+        self.rates = {'all': rate, 'today': today_rate, 
+                      'backlog': backlog_rate}
+        self.location_rates = location_rates
+        self.schedule = schedule
+        self.lock = threading.Lock()
+        self.buckets = {}   # key -> TokenBucket
+        self.window = None  # the schedule window in force
+        
+    def scheduled_window(self, now=None):
+        """Return the schedule window covering now, or None"""
+        if now == None:
+            now = datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        for window in self.schedule:
+            (start, end, unused_rate) = window
+            if start <= end:
+                if start <= minute < end:
+                    return window
+            elif minute >= start or minute < end:   # it spans midnight
+                return window
+        return None
+        
+    def limits(self, location, today):
+        """Return the (key, rate) pairs that apply to an upload"""
+        window = self.scheduled_window()
+        if window != self.window:
+            logging.info("upload rate schedule window now %s", window)
+            self.window = window
+        keys = ('all', 'today' if today else 'backlog')
+        limits = []
+        for key in keys:
+            if window != None:
+                rate = window[2]
+            else:
+                rate = self.rates[key]
+            if rate:
+                limits.append((key, rate))
+        rate = self.location_rates.get(location)
+        if rate:
+            limits.append(("location " + location, rate))
+        return limits
+    
+    def throttle(self, nbytes, location, today):
+        """Charge nbytes sent for an upload from location to the buckets
+        that apply, and sleep as long as the tightest of them needs
+        """
+        wait = 0
+        with self.lock:
+            limits = self.limits(location, today)
+            buckets = []
+            for (key, rate) in limits:
+                bucket = self.buckets.get(key)
+                if bucket == None:
+                    bucket = self.buckets[key] = TokenBucket(rate)
+                elif bucket.rate != rate:
+                    bucket.set_rate(rate)
+                buckets.append(bucket)
+        for bucket in buckets:
+            wait = max(wait, bucket.take(nbytes))
+        if wait > 0:
+            time.sleep(wait)
+            
+    def callback(self, ftp_dir, today):
+        """Return a callback for store_binary() that throttles an upload 
+        into ftp_dir, or None if no limit can apply to it
+        """
+        location = upload_location(ftp_dir)
+        if (not any(self.rates.values()) and not self.schedule 
+                and not self.location_rates.get(location)):
+            return None
+        return lambda nbytes: self.throttle(nbytes, location, today)
+    
+def upload_location(ftp_dir):
+    """Return the camera location an upload directory belongs to, i.e., the
+    directory below the day directory
+    """
+    match = re.search(r"/[0-9]{4}-[0-9]{2}-[0-9]{2}/([^/]+)", ftp_dir)
+    if match == None:
+        return None
+    return match.group(1)
+
+rate_limiter = None
+rate_limiter_lock = threading.Lock()
+
+def get_rate_limiter():
+    """Return the upload rate limiter, or None if uploads aren't limited"""
+    global rate_limiter
+    with rate_limiter_lock:
+        if rate_limiter == None and (cfg.upload_rate_limit or 
+                cfg.today_rate_limit or cfg.backlog_rate_limit or
+                cfg.location_rate_limits or cfg.rate_limit_schedule):
+            rate_limiter = RateLimiter(cfg.upload_rate_limit,
+                                       cfg.today_rate_limit,
+                                       cfg.backlog_rate_limit,
+                                       cfg.location_rate_limits,
+                                       cfg.rate_limit_schedule)
+        return rate_limiter
+
+def reset_rate_limiter():
+    global rate_limiter
+    with rate_limiter_lock:
+        rate_limiter = None
+
+def upload_callback(ftp_dir, today):
+    """Return the store_binary() callback for an upload into ftp_dir"""
+    limiter = get_rate_limiter()
+    if limiter == None:
+        return None
+    return limiter.callback(ftp_dir, today)
+
+
+def libc_sendfile():
+    """Return the C library's sendfile64() through ctypes, or None if the 
+    platform doesn't have it
+    """
+    if not hasattr(libc_sendfile, "function"):
+        libc_sendfile.function = None
+        if platform.system() == "Linux":
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library("c"), 
+                                   use_errno=True)
+                function = libc.sendfile64
+                function.argtypes = [ctypes.c_int, ctypes.c_int,
+                                     ctypes.POINTER(ctypes.c_longlong),
+                                     ctypes.c_size_t]
+                function.restype = ctypes.c_ssize_t
+                libc_sendfile.function = function
+            except (OSError, AttributeError):
+                pass
+    return libc_sendfile.function
+
+def transfer_method():
+    """Return how files are sent: "sendfile", "mmap" or "read".  "auto" in
+    the config picks sendfile where the platform has it, otherwise mmap.
+    """
+    method = cfg.transfer_method
+    if method in ("auto", "sendfile") and libc_sendfile() == None:
+        method = "mmap"
+    elif method == "auto":
+        method = "sendfile"
+    return method
+
+def send_with_sendfile(conn, filehandle, offset, size, callback):
+    # the kernel copies the file straight into the socket
+    sendfile = libc_sendfile()
+    position = ctypes.c_longlong(offset)
+    timeout = conn.gettimeout()
+    while position.value < size:
+        count = min(cfg.ftp_blocksize, size - position.value)
+        sent = sendfile(conn.fileno(), filehandle.fileno(), 
+                        ctypes.byref(position), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                # sockets with a timeout are non-blocking underneath
+                if not select.select([], [conn], [], timeout)[1]:
+                    raise socket.timeout("timed out")
+                continue
+            if err == errno.EINTR:
+                continue
+            raise socket.error(err, os.strerror(err))
+        if sent == 0:
+            raise EOFError("%s was truncated while it was sent" 
+                           % filehandle.name)
+        if callback != None:
+            callback(sent)
+
+def send_with_mmap(conn, filehandle, offset, size, callback, hasher=None):
+    # send slices of the mapped file without copying them into strings
+    mapped = mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        position = offset
+        while position < size:
+            count = min(cfg.ftp_blocksize, size - position)
+            block = buffer(mapped, position, count)
+            conn.sendall(block)
+            if hasher != None:
+                hasher.update(block)
+            position += count
+            if callback != None:
+                callback(count)
+    finally:
+        mapped.close()
+
+def store_binary(ftp_connection, command, filehandle, callback=None, 
+                 rest=None, hasher=None):
+    """Send filehandle from its current position to the end, with command,
+    STOR or APPE, like ftplib's storbinary(), but in cfg.ftp_blocksize
+    blocks with the transfer_method().
+    :param callback: called with the number of bytes sent after each block
+    :param rest: the REST offset to send before the command
+    :param hasher: a hashlib object updated with the data as it's sent.  
+    sendfile never sees the data, so mmap is used instead.
+    :return: the server's reply
+    """
+    method = transfer_method()
+    if hasher != None and method == "sendfile":
+        method = "mmap"
+    if method == "read":
+        block_callback = None
+        if callback != None or hasher != None:
+            def block_callback(block):
+                if hasher != None:
+                    hasher.update(block)
+                if callback != None:
+                    callback(len(block))
+        return ftp_connection.storbinary(command, filehandle, 
+                                         cfg.ftp_blocksize, block_callback,
+                                         rest)
+    
+    offset = filehandle.tell()
+    size = os.fstat(filehandle.fileno()).st_size
+    ftp_connection.voidcmd("TYPE I")
+    conn = ftp_connection.transfercmd(command, rest)
+    try:
+        if offset < size:
+            if method == "sendfile":
+                send_with_sendfile(conn, filehandle, offset, size, callback)
+            else:
+                send_with_mmap(conn, filehandle, offset, size, callback, 
+                               hasher)
+    finally:
+        conn.close()
+    return ftp_connection.voidresp()
+
+def store_ftp_file(session, filepath, filename, callback=None, 
+                   hasher=None):
+    """Upload filepath to filename in the session's current directory.
+    
+    Files of at least cfg.resume_threshold bytes are resumed: if part of
+    the file is already on the server, e.g., from a transfer that was cut
+    off, only the rest is sent, using REST and STOR, or APPE if the server
+    won't restart a STOR.
+    :param callback: called with the number of bytes sent after each
+    block, see upload_callback()
+    :param hasher: a hashlib object to update with the file's content as
+    it's sent
+    :return: True if the whole file was sent, so hasher has seen all of 
+    it, False if it was resumed or was already on the server
+    """
+    filehandle = open(filepath, "rb")
+    try:
+        offset = 0
+        size = os.fstat(filehandle.fileno()).st_size
+        if cfg.resume_threshold and size >= cfg.resume_threshold:
+            offset = remote_size(session.ftp, filename) or 0
+            if offset == size:
+                logging.info("%s is already complete on the server", filepath)
+                return False
+            if offset > size:
+                offset = 0      # not the same file; replace it
+        if offset == 0:
+            store_binary(session.ftp, "STOR " + filename, filehandle, 
+                         callback, hasher=hasher)
+            return True
+        
+        logging.info("resuming upload of %s at byte %d of %d", filepath,
+                     offset, size)
+        filehandle.seek(offset)
+        try:
+            store_binary(session.ftp, "STOR " + filename, filehandle, 
+                         callback, rest=offset)
+        except ftplib.error_perm, e:
+            if not str(e).startswith(("500", "501", "502", "504")):
+                raise
+            # REST isn't supported for STOR; append to the partial file
+            filehandle.seek(offset)
+            store_binary(session.ftp, "APPE " + filename, filehandle,
+                         callback)
+        return False
+    finally:
+        filehandle.close()
+
+class DedupIndex():
+    """A bounded SQLite index of the content hashes of recently uploaded
+    files, for each target, so that a file whose content the target already
+    has needn't be sent again.
+    
+    Each hash maps to the remote path of a file that has that content.  
+    When a target's index holds more than max_entries hashes, the least
+    recently used are dropped.  The upload processes share the index, so
+    an update that can't get the database lock is logged and skipped; the
+    file is then just sent, or not remembered.
+    """
+    trim_every = 100    # adds between trims of the index
+    
+    def __init__(self, path, max_entries):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.adds = 0
+        self.no_site_copy = set()   # targets that refused SITE CPFR/CPTO
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS hashes (
+                               target TEXT NOT NULL,
+                               digest TEXT NOT NULL,
+                               size INTEGER,
+                               remote TEXT,
+                               used REAL,
+                               PRIMARY KEY (target, digest))""")
+        self.db.execute("""CREATE INDEX IF NOT EXISTS hashes_used 
+                               ON hashes (target, used)""")
+        
+    def lookup(self, target, digest, size):
+        """Return the remote path of a file on target with this content, or
+        None
+        """
+        with self.lock:
+            try:
+                row = self.db.execute("SELECT remote FROM hashes WHERE "
+                                      "target=? AND digest=? AND size=?",
+                                      (target, digest, size)).fetchone()
+                if row == None:
+                    return None
+                self.db.execute("UPDATE hashes SET used=? WHERE target=? "
+                                "AND digest=?", (time.time(), target, digest))
+            except sqlite3.Error, e:
+                logging.warning("can't look up dedup index: %s", e)
+                return None
+        return row[0]
+    
+    def add(self, target, digest, size, remote):
+        with self.lock:
+            try:
+                self.db.execute("INSERT OR REPLACE INTO hashes "
+                                "VALUES (?, ?, ?, ?, ?)", 
+                                (target, digest, size, remote, time.time()))
+                self.adds += 1
+                if self.adds % self.trim_every == 0:
+                    self.db.execute("DELETE FROM hashes WHERE target=? AND "
+                                    "digest IN (SELECT digest FROM hashes "
+                                    "WHERE target=? ORDER BY used DESC "
+                                    "LIMIT -1 OFFSET ?)", 
+                                    (target, target, self.max_entries))
+            except sqlite3.Error, e:
+                logging.warning("can't update dedup index: %s", e)
+                
+    def forget(self, target, digest):
+        with self.lock:
+            try:
+                self.db.execute("DELETE FROM hashes WHERE target=? AND "
+                                "digest=?", (target, digest))
+            except sqlite3.Error, e:
+                logging.warning("can't update dedup index: %s", e)
+            
+    def count(self, target):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM hashes WHERE "
+                                   "target=?", (target,)).fetchone()[0]
+            
+    def close(self):
+        with self.lock:
+            self.db.close()
+            
+
+dedup_index = None
+dedup_index_lock = threading.Lock()
+
+def get_dedup_index():
+    """Return the DedupIndex, or None if cfg.dedup is "none" """
+    global dedup_index
+    if cfg.dedup == "none":
+        return None
+    with dedup_index_lock:
+        if dedup_index == None:
+            dedup_index = DedupIndex(cfg.dedup_index_path, 
+                                     cfg.dedup_index_size)
+        return dedup_index
+    
+def close_dedup_index():
+    global dedup_index
+    with dedup_index_lock:
+        if dedup_index != None:
+            dedup_index.close()
+            dedup_index = None
+
+def file_digest(filepath):
+    hasher = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        while True:
+            block = f.read(65536)
+            if not block:
+                break
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def server_copy(session, index, target_name, original, filename):
+    """Copy original to filename on the server with SITE CPFR/CPTO, as
+    ProFTPD's mod_copy does.
+    :return: True if the copy was made
+    """
+    if target_name in index.no_site_copy:
+        return False
+    try:
+        session.ftp.sendcmd("SITE CPFR " + original)
+        session.ftp.voidcmd("SITE CPTO " + filename)
+    except (ftplib.error_perm, ftplib.error_reply), e:
+        if str(e)[:3] in ("500", "501", "502", "504"):
+            logging.info("%s doesn't support SITE CPFR/CPTO; sending "
+                         "duplicates instead", target_name)
+            index.no_site_copy.add(target_name)
+        else:
+            logging.warning("couldn't copy %s on the server: %s", original, e)
+        return False
+    return True
+
+def store_deduplicated(session, target, ftp_dir, filepath, filename, 
+                       callback=None):
+    """Upload filepath like store_ftp_file(), unless the dedup index shows
+    the target already has a file with the same content.  Then the file is
+    skipped, or, with dedup = copy, copied on the server from the file that
+    has the content.  A file already stored under the same name is always
+    skipped.
+    
+    Files of up to dedup_prehash_limit bytes are hashed before they are
+    sent, so they can be skipped; larger ones are hashed as they are sent,
+    so they are only recognized when they turn up again.
+    :return: True if the file was sent, False if it wasn't needed
+    """
+    index = get_dedup_index()
+    if index == None:
+        store_ftp_file(session, filepath, filename, callback)
+        return True
+    remote = ftp_dir.rstrip("/") + "/" + filename
+    size = os.path.getsize(filepath)
+    hasher = None
+    if size <= cfg.dedup_prehash_limit:
+        digest = file_digest(filepath)
+        original = index.lookup(target.name, digest, size)
+        action = None
+        if original == remote or (original != None and cfg.dedup == "skip"):
+            action = "skipped"
+        elif original != None:
+            if server_copy(session, index, target.name, original, filename):
+                action = "copied"
+            elif target.name not in index.no_site_copy:
+                index.forget(target.name, digest)   # e.g., original is gone
+        if action != None:
+            logging.debug("%s has the same content as %s; %s", filepath, 
+                          original, action)
+            labels = {'target': target.name, 'action': action}
+            metrics.inc("ftp_upload_dedup_files_total", labels=labels)
+            metrics.inc("ftp_upload_dedup_bytes_saved_total", size, 
+                        {'target': target.name})
+            return False
+    else:
+        digest = None
+        hasher = hashlib.sha1()
+    if store_ftp_file(session, filepath, filename, callback, hasher):
+        if hasher != None:
+            digest = hasher.hexdigest()
+    else:
+        digest = None   # it was resumed, so only part of it was hashed
+    if digest != None:
+        index.add(target.name, digest, size, remote)
+    return True
+
+
+class UploadJournal():
+    """A small SQLite database recording how far each file has got through
+    the upload process, so that a restarted ftp_upload can pick up where
+    it left off.
+    
+    A file goes from QUEUED to UPLOADING to UPLOADED (the server has
+    confirmed the STOR) to MOVED (it's in processed_location).  The file's
+    size and mtime are recorded along with its state so that a file that
+    has been replaced since it was recorded isn't mistaken for the old one.
+    """
+    QUEUED = "queued"
+    UPLOADING = "uploading"
+    UPLOADED = "uploaded"
+    MOVED = "moved"
+    
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+                               path TEXT PRIMARY KEY,
+                               state TEXT NOT NULL,
+                               size INTEGER,
+                               mtime REAL,
+                               updated REAL)""")
+        
+    def record(self, filepath, state):
+        """Record that filepath has reached state"""
+        try:
+            st = os.stat(filepath)
+            size, mtime = st.st_size, st.st_mtime
+        except OSError:
+            size, mtime = None, None    # already moved
+        with self.lock:
+            if size == None:
+                self.db.execute("UPDATE files SET state=?, updated=? "
+                                "WHERE path=?", 
+                                (state, time.time(), filepath))
+            else:
+                # queueing a file again mustn't lose track of how far it got
+                # before, e.g., when it's resumed from the journal
+                verb = "IGNORE" if state == self.QUEUED else "REPLACE"
+                self.db.execute("INSERT OR %s INTO files "
+                                "VALUES (?, ?, ?, ?, ?)" % verb,
+                                (filepath, state, size, mtime, time.time()))
+                
+    def confirmed(self, filepath):
+        """Return True if filepath, as it is now, is known to be on the
+        server already.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime FROM files "
+                                  "WHERE path=? AND state IN (?, ?)",
+                                  (filepath, self.UPLOADED, self.MOVED)
+                                  ).fetchone()
+        if row == None:
+            return False
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return False
+        return (st.st_size, st.st_mtime) == (row[0], row[1])
+    
+    def unfinished(self):
+        """Return the paths of the files that hadn't been moved to
+        processed_location, oldest record first.
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT path FROM files WHERE state != ? "
+                                   "ORDER BY updated", 
+                                   (self.MOVED,)).fetchall()
+        return [row[0] for row in rows]
+        
+    def prune(self):
+        """Forget the files that have been completely dealt with"""
+        with self.lock:
+            self.db.execute("DELETE FROM files WHERE state=?", (self.MOVED,))
+            
+    def close(self):
+        with self.lock:
+            self.db.close()
+            
+
+journal = None  # the UploadJournal, if cfg.journal_path is set
+
+def journal_record(filepath, state):
+    if journal != None:
+        try:
+            journal.record(filepath, state)
+        except sqlite3.Error, e:
+            logging.warning("can't update upload journal for %s: %s",
+                            filepath, e)
+            
+def journal_confirmed(filepath):
+    """Return True if the journal shows filepath is on the server already.
+    The upload processes share the journal, so if it's locked the file is
+    assumed not to be.
+    """
+    if journal == None:
+        return False
+    try:
+        return journal.confirmed(filepath)
+    except sqlite3.Error, e:
+        logging.warning("can't read upload journal for %s: %s", filepath, e)
+        return False
+    
+def journal_prune():
+    if journal != None:
+        try:
+            journal.prune()
+        except sqlite3.Error, e:
+            logging.warning("can't prune upload journal: %s", e)
+            
+def resume_from_journal():
+    """Queue the files that were in progress when ftp_upload last stopped,
+    ahead of the first scan of the incoming tree.  Files the journal shows
+    were already uploaded are only moved, not sent again.
+    """
+    journal_prune()
+    try:
+        unfinished = journal.unfinished()
+    except sqlite3.Error, e:
+        logging.warning("can't read upload journal: %s", e)
+        return
+    executor = get_upload_executor()
+    count = 0
+    for filepath in unfinished:
+        job = upload_job(filepath)
+        if job != None and os.path.isfile(filepath):
+            executor.submit(*job)
+            count += 1
+    logging.info("resuming %d unfinished uploads from the journal", count)
+    
+    
+def staged_path(filepath):
+    """Return where the recompressed copy of filepath, a file in the 
+    incoming tree, is kept in staging_location
+    """
+    relpath = os.path.relpath(filepath, cfg.incoming_location)
+    return os.path.join(cfg.staging_location, relpath)
+
+def upload_source(filepath):
+    """Return the file to send for filepath: its recompressed copy if there
+    is one, otherwise filepath itself
+    """
+    if cfg.recompress and cfg.staging_location:
+        staged = staged_path(filepath)
+        if os.path.exists(staged):
+            return staged
+    return filepath
+
+def discard_staged(filepath):
+    """Delete the recompressed copy of filepath, if any, along with the
+    staging directories it leaves empty
+    """
+    if not (cfg.recompress and cfg.staging_location):
+        return
+    staged = staged_path(filepath)
+    try:
+        os.remove(staged)
+    except OSError:
+        return
+    top = os.path.abspath(cfg.staging_location)
+    dirpath = os.path.dirname(os.path.abspath(staged))
+    while dirpath.startswith(top + os.sep):
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            break
+        dirpath = os.path.dirname(dirpath)
+
+def recompress_image(filepath, stagedpath, quality, max_size, strip):
+    """Re-encode the JPEG image filepath at the given quality into 
+    stagedpath, shrinking it to fit within max_size pixels square if 
+    max_size isn't 0, and leaving out its EXIF and ICC data if strip is set.
+    Nothing is written if the result wouldn't be any smaller.  This runs in
+    the Recompressor's worker processes, so it doesn't log.
+    :return: (the size of filepath, the size of stagedpath or None if it
+    wasn't written, the CPU seconds used, an error message or None)
+    """
+    cpu = sum(os.times()[:2])
+    size = None
+    staged_size = None
+    error = None
+    try:
+        size = os.path.getsize(filepath)
+        image = Image.open(filepath)
+        options = {'quality': quality, 'optimize': True}
+        if not strip:
+            for key in ("exif", "icc_profile"):
+                if image.info.get(key):
+                    options[key] = image.info[key]
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        if max_size:
+            image.thumbnail((max_size, max_size), Image.ANTIALIAS)
+        dirpath = os.path.dirname(stagedpath)
+        if not os.path.isdir(dirpath):
+            try:
+                os.makedirs(dirpath)
+            except OSError:
+                pass    # another worker made it
+        tmppath = stagedpath + ".tmp"
+        image.save(tmppath, "JPEG", **options)
+        if os.path.getsize(tmppath) < size:
+            os.rename(tmppath, stagedpath)
+            staged_size = os.path.getsize(stagedpath)
+        else:
+            os.remove(tmppath)
+    except Exception, e:
+        error = str(e) or e.__class__.__name__
+    return (size, staged_size, sum(os.times()[:2]) - cpu, error)
+
+def run_recompress(convert, args):
+    """Run convert(*args) in a worker process, turning an exception into an
+    error result so that the file is still passed on for upload
+    """
+    try:
+        return convert(*args)
+    except Exception, e:
+        return (None, None, 0, str(e) or e.__class__.__name__)
+
+def ignore_sigint():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class Recompressor():
+    """The optional stage between the directory scan and the upload queue
+    that re-encodes images to save uplink bandwidth.
+    
+    Files are recompressed by a pool of nprocesses worker processes, so the
+    work is spread across the cores.  The smaller copy is written to
+    staging_location and is what gets uploaded; the original is moved to
+    processed_location as usual, and the copy is deleted.  A file that 
+    can't be recompressed, or that wouldn't get any smaller, is uploaded 
+    as it is.  Each file is passed on to the upload executor when its 
+    worker is done with it.
+    :param convert: the function the workers run, recompress_image() by
+    default
+    """
+    def __init__(self, nprocesses, quality, max_size, strip, convert=None):
+        self.quality = quality
+        self.max_size = max_size
+        self.strip = strip
+        self.convert = recompress_image if convert == None else convert
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.pool = multiprocessing.Pool(nprocesses or None, ignore_sigint)
+        
+    def is_pending(self, filepath):
+        with self.lock:
+            if filepath in self.pending:
+                return True
+        return get_upload_executor().is_pending(filepath)
+    
+    def submit(self, ftp_dir, filepath, donepath, filename, today):
+        """Recompress a file and then queue it for upload, like 
+        UploadExecutor.submit().
+        :return: True if the file was taken, False if it's already on its 
+        way
+        """
+        if self.is_pending(filepath):
+            return False
+        job = (ftp_dir, filepath, donepath, filename, today)
+        stagedpath = staged_path(filepath)
+        if os.path.exists(stagedpath):
+            # recompressed before ftp_upload was last stopped
+            return get_upload_executor().submit(*job)
+        with self.lock:
+            self.pending.add(filepath)
+        args = (filepath, stagedpath, self.quality, self.max_size, self.strip)
+        self.pool.apply_async(run_recompress, (self.convert, args),
+                              callback=lambda result: self.done(job, result))
+        return True
+        
+    def done(self, job, result):
+        """Count a recompressed file and queue it for upload.  This is 
+        called on the pool's result thread.
+        """
+        (size, staged_size, cpu, error) = result
+        filepath = job[1]
+        metrics.inc("ftp_upload_recompress_cpu_seconds_total", cpu)
+        if error != None:
+            logging.info("can't recompress %s, sending it as it is: %s", 
+                         filepath, error)
+            metrics.inc("ftp_upload_recompress_failures_total")
+        elif staged_size != None:
+            logging.debug("recompressed %s from %d to %d bytes", filepath, 
+                          size, staged_size)
+            metrics.inc("ftp_upload_recompress_files_total")
+            metrics.inc("ftp_upload_recompress_bytes_saved_total", 
+                        size - staged_size)
+        try:
+            get_upload_executor().submit(*job)
+        finally:
+            with self.lock:
+                self.pending.discard(filepath)
+                
+    def close(self):
+        """Wait for the files being recompressed to be queued for upload"""
+        self.pool.close()
+        self.pool.join()
+        
+
+recompressor = None
+recompressor_lock = threading.Lock()
+
+def get_recompressor():
+    """Return the Recompressor, or None if recompression isn't configured
+    or PIL isn't installed
+    """
+    global recompressor
+    if not cfg.recompress:
+        return None
+    with recompressor_lock:
+        if recompressor == None:
+            if Image == None:
+                logging.warning("recompress needs PIL (the Pillow package); "
+                                "uploading images as they are")
+                cfg.recompress = False
+                return None
+            if not cfg.staging_location:
+                logging.warning("recompress needs a staging_location; "
+                                "uploading images as they are")
+                cfg.recompress = False
+                return None
+            mkdir(cfg.staging_location)
+            recompressor = Recompressor(cfg.recompress_processes,
+                                        cfg.recompress_quality,
+                                        cfg.recompress_max_size,
+                                        cfg.recompress_strip_metadata)
+        return recompressor
+    
+def stop_recompressor():
+    global recompressor
+    with recompressor_lock:
+        if recompressor != None:
+            recompressor.close()
+            recompressor = None
+    
+    
+def send_files(ftp_dir, files, target=None, callback=None):
+    """Upload files into ftp_dir on the server, one after another over a
+    single pooled session.  If the session turns out to be dead, it's
+    replaced once and the upload carries on straight away.
+    :param files: a list of (filepath, filename, donepath).  When mirroring,
+    a file that has already been moved to its donepath is sent from there.
+    :param target: the UploadTarget to send the files to; by default
+    ftp_server
+    :param callback: the block callback for store_ftp_file()
+    :return: a dict of filepath -> UPLOAD_OK or the kind of failure
+    """
+    if target == None:
+        target = primary_target()
+    pool = target.get_pool()
+    results = {}
+    todo = collections.deque(files)
+    session = None
+    replaced = False
+    while todo:
+        if session == None:
+            try:
+                session = pool.get()
+            except Exception, e:
+                kind = classify_failure(e)
+                if kind == FAIL_PERMANENT:
+                    kind = FAIL_AUTH    # e.g., no access to ftp_destination
+                break
+        
+        if not change_session_dir(session, ftp_dir):
+            pool.put(session)
+            if session.broken and not replaced:
+                session = None
+                replaced = True
+                continue
+            session = None
+            # if we can't create or change to the ftp_dir for some reason
+            # (probably transient), abort storing the files, and let them
+            # be tried again later
+            logging.warn("storefile: aborting; couldn't change to %s" % ftp_dir)
+            kind = FAIL_TRANSIENT
+            break
+            
+        (filepath, filename, donepath) = todo[0]
+        source = upload_source(filepath)
+        if target.primary:
+            logging.debug("Uploading %s", filepath)
+            journal_record(filepath, UploadJournal.UPLOADING)
+        else:
+            logging.debug("Uploading %s to %s", filepath, target.name)
+            if not os.path.exists(source) and os.path.exists(donepath):
+                source = donepath   # the required targets have it already
+        started = time.time()
+        try:
+            sent = store_deduplicated(session, target, ftp_dir, source, 
+                                      filename, callback)
+        except Exception, e:
+            record_failure(classify_failure(e), target.name)
+            if connection_lost(e):
+                logging.warning("FTP session failed storing %s: %s", 
+                                filepath, e)
+                session.broken = True
+            else:
+                logging.error("Failed to store ftp file: %s: %s", filepath, e)
+                logging.exception(e)
+                session.cwd = None  # may have been an error in the remote dir
+                if isinstance(e, ftplib.error_perm):
+                    session.dirs.forget(ftp_dir)
+            if session.broken:
+                pool.put(session)
+                session = None
+                if not replaced:
+                    replaced = True
+                    continue
+                kind = classify_failure(e)
+                break
+            results[filepath] = classify_failure(e)
+            todo.popleft()
+            continue
+        if sent:
+            record_upload(filepath, started, target.name, source)
+        if target.primary:
+            journal_record(filepath, UploadJournal.UPLOADED)
+        results[filepath] = UPLOAD_OK
+        todo.popleft()
+        
+    if session != None:
+        pool.put(session)
+    for (filepath, unused_filename, unused_donepath) in todo:
+        results[filepath] = kind
+    return results
+
+def storefiles(jobs, target=None, tracker=None):
+    """Upload a batch of files that all go into the same remote directory
+    and move each one that is stored to its donepath.  Files that fail are
+    left where they are.
+    
+    When mirroring, target is the UploadTarget to send the files to, and
+    each file that is stored is acknowledged to tracker, which moves the
+    file once all the required targets have it.
+    :param jobs: a list of (ftp_dir, filepath, donepath, filename, today)
+    :return: a list of UPLOAD_OK or the kind of failure for each job, so the
+    caller can decide when to try again.
+    """
+    primary = target == None or target.primary
+    ftp_dir = jobs[0][0]
+    results = {}
+    to_send = []
+    for (unused_dir, filepath, donepath, filename, unused_today) in jobs:
+        if primary and journal_confirmed(filepath):
+            logging.info("%s is already on the server; not sending it again", 
+                         filepath)
+            results[filepath] = UPLOAD_OK
+        else:
+            to_send.append((filepath, filename, donepath))
+    if to_send:
+        results.update(send_files(ftp_dir, to_send, target,
+                                  upload_callback(ftp_dir, jobs[0][4])))
+        
+    for job in jobs:
+        (unused_dir, filepath, donepath, filename, unused_today) = job
+        if results[filepath] == UPLOAD_OK:
+            if tracker != None:
+                tracker.ack(job, target.name)
+            else:
+                move_stored_file(filepath, donepath, filename)
+    return [results[job[1]] for job in jobs]
+
+def storefile(ftp_dir, filepath, donepath, filename, today):
+    """Upload a file and move it to donepath.  The file is left where it is
+    if the upload fails.
+    :return: UPLOAD_OK, or the kind of failure, so the caller can decide
+    when to try again.
+    """
+    return storefiles([(ftp_dir, filepath, donepath, filename, today)])[0]
+
+def move_stored_file(filepath, donepath, filename):
+    logging.debug("file : %s stored on ftp", filename)
+    logging.debug("moving file to Storage")
+
+    try :
+        # if the directory we want to move the file into doesn't exist,
+        # create it.  This is a hack.  It's intended to recover from the
+        # case where the purge process has deleted an old storage day-
+        # directory, but for whatever reason, there are still files in
+        # the incoming area for that day that need to be FTP'd to the
+        # server
+        #
+        donedir = os.path.dirname(donepath)
+        if not os.path.exists(donedir):
+            os.makedirs(donedir)
+            
+        shutil.move(filepath, donepath)
+        journal_record(filepath, UploadJournal.MOVED)
+        discard_staged(filepath)
+    except Exception, e:
+        logging.warning("can't move file %s, possible sharing violation", filepath )
+        logging.exception(e)
+
+class UploadScheduler():
+    """The queue of upload jobs shared by the upload workers.
+    
+    Today's files always go first.  reserved workers are kept free for
+    today's files: no more than nworkers - reserved backlog (previous day)
+    files are uploaded at once.  So that the backlog isn't starved by a
+    steady stream of today's images, a backlog file that has waited longer
+    than max_wait seconds is taken ahead of today's files when a backlog
+    slot is free.
+    
+    Jobs to be retried later are held aside by put_later() until they are
+    due, without tying up a worker.  A backlog job keeps the time it was
+    first queued, so retrying it doesn't reset its wait.
+    
+    All the counts are kept under a single lock, so they are exact.
+    """
+    def __init__(self, nworkers, reserved, max_wait, backlog_size):
+        self.cond = threading.Condition()
+        self.reserved = reserved
+        self.limit = nworkers   # jobs run at once; see set_limit()
+        self.backlog_limit = max(1, nworkers - reserved)
+        self.max_wait = max_wait
+        self.backlog_size = backlog_size
+        self.today = collections.deque()    # today's jobs
+        self.backlog = collections.deque()  # (time queued, job)
+        self.delayed = []       # heap of (time due, seq, job, today, queued)
+        self.seq = itertools.count()
+        self.active_today = 0
+        self.active_backlog = 0
+        self.aged = 0           # backlog jobs taken ahead of today's
+        self.closed = False
+        
+    def set_limit(self, limit):
+        """Let no more than limit jobs run at once, e.g., fewer than there
+        are workers, still keeping reserved of them for today's files
+        """
+        with self.cond:
+            self.limit = limit
+            self.backlog_limit = max(1, limit - self.reserved)
+            self.cond.notify_all()
+            
+    def saturated(self):
+        """Return True if jobs are waiting only because of the limits on
+        how many may run at once
+        """
+        with self.cond:
+            if self.active_today + self.active_backlog >= self.limit:
+                return bool(self.today or self.backlog)
+            return (bool(self.backlog) and 
+                    self.active_backlog >= self.backlog_limit)
+            
+    def put(self, job, today):
+        """Queue a job.  Backlog jobs block while backlog_size are waiting."""
+        with self.cond:
+            if today:
+                self.today.append(job)
+            else:
+                while len(self.backlog) >= self.backlog_size:
+                    self.cond.wait()
+                self.backlog.append((time.time(), job))
+            self.cond.notify_all()
+            
+    def put_later(self, job, today, delay, queued=None):
+        """Queue a job once delay seconds have passed.
+        :param queued: the time the job was first queued, by which a backlog
+        job is ordered and aged; by default, when it's released
+        """
+        with self.cond:
+            heapq.heappush(self.delayed, (time.time() + delay, 
+                                          next(self.seq), job, today, queued))
+            self.cond.notify_all()
+            
+    def _release_delayed(self):
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            (unused_due, unused_seq, job, today, 
+             queued) = heapq.heappop(self.delayed)
+            if today:
+                self.today.append(job)
+            elif queued == None:
+                self.backlog.append((now, job))
+            else:
+                self._requeue_backlog(queued, job)
+                
+    def _requeue_backlog(self, queued, job):
+        # put the job back in the order it was first queued in, so that it
+        # ages from then
+        i = 0
+        for (other, unused_job) in self.backlog:
+            if other > queued:
+                break
+            i += 1
+        self.backlog.rotate(-i)
+        self.backlog.appendleft((queued, job))
+        self.backlog.rotate(i)
+    
+    def get(self):
+        """Take the next job to run, blocking until there is one.
+        :return: (job, today), or None once the scheduler has been closed
+        and has no more jobs.
+        """
+        with self.cond:
+            while True:
+                task = self._take()
+                if task != None:
+                    return task
+                if self.closed and not self.backlog:
+                    return None     # delayed jobs wait for the next run
+                timeout = None
+                if self.delayed:
+                    timeout = max(0, self.delayed[0][0] - time.time())
+                self.cond.wait(timeout)
+                
+    def poll(self):
+        """Take the next job to run if there is one, without blocking.
+        :return: (job, today), or None
+        """
+        with self.cond:
+            return self._take()
+        
+    def finished(self):
+        """Return True once the scheduler is closed and get() would return 
+        None
+        """
+        with self.cond:
+            return self.closed and not self.today and not self.backlog
+    
+    def _take(self):
+        self._release_delayed()
+        if self.active_today + self.active_backlog >= self.limit:
+            return None
+        backlog_ok = (self.backlog and 
+                      self.active_backlog < self.backlog_limit)
+        if backlog_ok and (not self.today or 
+                time.time() - self.backlog[0][0] >= self.max_wait):
+            if self.today:
+                self.aged += 1
+            unused_queued, job = self.backlog.popleft()
+            self.active_backlog += 1
+            self.cond.notify_all()  # room for a blocked put()
+            return (job, False)
+        if self.today:
+            self.active_today += 1
+            return (self.today.popleft(), True)
+        return None
+                
+    def get_batch(self, size, key, flush):
+        """Take up to size jobs that belong together, e.g., files for the
+        same remote directory, to be run by one worker.  The first job is
+        the one get() would return; queued jobs with the same key(job) are
+        added to it.  A backlog batch that isn't full waits up to flush
+        seconds for more jobs, but a batch of today's jobs never waits.
+        The batch counts as a single job for the limits and task_done().
+        :return: (jobs, today), or None as for get()
+        """
+        task = self.get()
+        if task == None:
+            return None
+        (job, today) = task
+        jobs = [job]
+        batch_key = key(job)
+        deadline = time.time() + flush
+        with self.cond:
+            while True:
+                self._take_matching(jobs, size, batch_key, key, today)
+                if len(jobs) >= size or today or self.closed:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+        return (jobs, today)
+    
+    def _take_matching(self, jobs, size, batch_key, key, today):
+        if today:
+            queue = self.today
+        else:
+            queue = self.backlog
+        kept = []
+        taken = False
+        for entry in queue:
+            if today:
+                job = entry
+            else:
+                (unused_queued, job) = entry
+            if len(jobs) < size and key(job) == batch_key:
+                jobs.append(job)
+                taken = True
+            else:
+                kept.append(entry)
+        if taken:
+            queue.clear()
+            queue.extend(kept)
+            self.cond.notify_all()  # room for a blocked put()
+            
+    def task_done(self, today):
+        """Tell the scheduler a job returned by get() is finished"""
+        with self.cond:
+            if today:
+                self.active_today -= 1
+            else:
+                self.active_backlog -= 1
+            self.cond.notify_all()
+            
+    def join(self):
+        """Wait until every queued job is finished"""
+        with self.cond:
+            while (self.today or self.backlog or self.delayed
+                   or self.active_today or self.active_backlog):
+                self.cond.wait()
+                
+    def close(self):
+        """Make get() return None once the queued jobs are gone"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+            
+    def counts(self):
+        with self.cond:
+            return {'queued_today': len(self.today),
+                    'queued_backlog': len(self.backlog),
+                    'active_today': self.active_today,
+                    'active_backlog': self.active_backlog,
+                    'delayed': len(self.delayed),
+                    'aged': self.aged,
+                    'limit': self.limit}
+
+
+class UploadExecutor():
+    """A fixed number of long-lived upload threads fed by an UploadScheduler.
+    
+    The directory walkers submit one job per file and the workers run
+    storefiles() for each job.  With batch_size greater than one, a worker
+    takes up to batch_size queued files for the same remote directory and
+    sends them one after another over one FTP session; a batch of previous
+    days' files waits up to batch_flush seconds to fill.  A file that is
+    already queued or being uploaded is not queued again, so rescanning a
+    directory before its uploads finish doesn't upload anything twice.
+    
+    A failed upload is put back in the queue to be retried after a backoff
+    delay from policy, rather than the worker sleeping.  Connection and
+    login failures also count against the breaker, which holds back all
+    the workers while the server is down.  A file the server refuses 
+    (FAIL_PERMANENT) max_attempts times is given up on until it changes
+    or ftp_upload is restarted.
+    """
+    thread_prefix = "upload"
+    
+    def __init__(self, nthreads, reserved, max_wait, policy, breaker, 
+                 max_attempts, batch_size=1, batch_flush=0, backlog_size=None):
+        if backlog_size == None:
+            backlog_size = max(nthreads, batch_size) * 4
+        self.scheduler = UploadScheduler(nthreads, reserved, max_wait,
+                                         backlog_size)
+        self.batch_size = batch_size
+        self.batch_flush = batch_flush
+        self.policy = policy
+        self.breaker = breaker
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.pending = set()    # paths of files queued or being uploaded
+        self.attempts = {}      # path -> number of failed uploads
+        self.queued = {}        # path -> time it was first queued
+        self.given_up = {}      # path -> mtime when it was given up on
+        self.controller = None  # a ConcurrencyController, if adaptive
+        self.threads = []
+        self._start_workers(nthreads)
+        
+    def _start_workers(self, nthreads):
+        for i in range(nthreads):
+            thread = threading.Thread(target=self._worker, 
+                                      name="%s-%d" % (self.thread_prefix, 
+                                                      i + 1))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+            
+    def submit(self, ftp_dir, filepath, donepath, filename, today):
+        """Queue a file for upload.  Previous days' files block while the
+        backlog queue is full.
+        :return: False if the file was already queued, otherwise True
+        """
+        with self.lock:
+            if filepath in self.pending:
+                return False
+            if filepath in self.given_up:
+                try:
+                    mtime = os.path.getmtime(filepath)
+                except OSError:
+                    mtime = None
+                if mtime == self.given_up[filepath]:
+                    return False
+                del self.given_up[filepath]
+            self.pending.add(filepath)
+            self.queued[filepath] = time.time()
+        journal_record(filepath, UploadJournal.QUEUED)
+        self.scheduler.put((ftp_dir, filepath, donepath, filename, today),
+                           today)
+        return True
+    
+    def is_pending(self, filepath):
+        with self.lock:
+            return filepath in self.pending
+    
+    def join(self):
+        """Wait until every queued file has been dealt with"""
+        self.scheduler.join()
+        
+    def shutdown(self):
+        """Stop the workers once they have finished the queued jobs"""
+        self.scheduler.close()
+        for thread in self.threads:
+            thread.join()
+            
+    def _worker(self):
+        while True:
+            task = self.scheduler.get_batch(self.batch_size, 
+                                            lambda job: job[0],
+                                            self.batch_flush)
+            if task == None:
+                return
+            jobs, today = task
+            if not self.breaker.allow():
+                for job in jobs:
+                    self._hold(job, today)
+                self.scheduler.task_done(today)
+                continue
+            try:
+                results = self.store(jobs)
+            except Exception, e:
+                logging.error("Unexpected exception uploading %s", 
+                              ", ".join(job[1] for job in jobs))
+                logging.exception(e)
+                results = [FAIL_TRANSIENT] * len(jobs)
+                
+            # the batch shared a session, so it counts once with the breaker
+            for (job, result) in zip(jobs, results):
+                self._finished(job, today, result, report=False)
+            self._report(batch_result(results))
+            self.scheduler.task_done(today)
+            
+    def store(self, jobs):
+        return storefiles(jobs)
+            
+    def _hold(self, job, today):
+        # the server is down; hold the file until the breaker lets uploads
+        # through again
+        with self.lock:
+            queued = self.queued.get(job[1])
+        self.scheduler.put_later(job, today, 
+                max(self.breaker.remaining(), self.policy.base), queued)
+            
+    def _finished(self, job, today, result, report=True):
+        if self.controller != None:
+            self.controller.record(result)
+        if report:
+            self._report(result)
+        if result == UPLOAD_OK:
+            with self.lock:
+                self.pending.discard(job[1])
+                self.attempts.pop(job[1], None)
+                self.queued.pop(job[1], None)
+        else:
+            self._retry(job, today, result)
+            
+    def _report(self, result):
+        """Tell the circuit breaker the outcome of an upload session"""
+        # too many connections is left to the controller, if there is one,
+        # rather than holding back every worker
+        if (result in (FAIL_TRANSIENT, FAIL_AUTH) or 
+                (result == FAIL_BUSY and self.controller == None)):
+            self.breaker.failure(result)
+        elif result == FAIL_BUSY:
+            self.breaker.busy()
+        else:
+            self.breaker.success()
+            
+    def _retry(self, job, today, result):
+        filepath = job[1]
+        if not os.path.exists(upload_source(filepath)):
+            # deleted under us, e.g. evicted by another process
+            logging.warning("%s has gone, not trying it again", filepath)
+            with self.lock:
+                self.attempts.pop(filepath, None)
+                self.pending.discard(filepath)
+                self.queued.pop(filepath, None)
+            return
+        with self.lock:
+            attempts = self.attempts.get(filepath, 0) + 1
+            if result == FAIL_PERMANENT and attempts >= self.max_attempts:
+                logging.error("giving up on %s after %d attempts", filepath,
+                              attempts)
+                self.attempts.pop(filepath, None)
+                self.pending.discard(filepath)
+                self.queued.pop(filepath, None)
+                try:
+                    self.given_up[filepath] = os.path.getmtime(filepath)
+                except OSError:
+                    pass
+                return
+            self.attempts[filepath] = attempts
+            queued = self.queued.get(filepath)
+        delay = max(self.policy.delay(attempts), self.breaker.remaining())
+        logging.info("will try %s again in %.0f seconds", filepath, delay)
+        metrics.inc("ftp_upload_retries_total")
+        self.scheduler.put_later(job, today, delay, queued)
+
+
+class ConcurrencyController():
+    """Tunes how many uploads a scheduler lets run at once, between low and
+    high, by additive increase and multiplicative decrease (AIMD).
+    
+    Every interval seconds it looks at the results of the uploads finished
+    since the last look.  If the server refused connections (421) or more
+    than max_error_rate of the uploads failed, the limit is halved and the
+    idle pooled sessions beyond it are logged out.  If throughput fell
+    after the last increase, the increase is undone.  Otherwise, if files
+    were waiting for a free upload slot, the limit goes up by one.
+    Throughput is measured in bytes uploaded per second.
+    """
+    decrease = 0.5
+    max_error_rate = 0.2
+    
+    def __init__(self, scheduler, low, high, start, interval, pool=None):
+        self.scheduler = scheduler
+        self.low = max(1, low)
+        self.high = max(self.low, high)
+        self.interval = interval
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.limit = min(max(start, self.low), self.high)
+        self.throughput = None
+        self.increased = False
+        self._start_interval()
+        scheduler.set_limit(self.limit)
+        metrics.set("ftp_upload_concurrency_limit", self.limit)
+        
+    def _start_interval(self):
+        self.started = time.time()
+        self.start_bytes = metrics.total("ftp_upload_bytes_total")
+        self.ok = 0
+        self.busy = 0
+        self.failed = 0
+        
+    def record(self, result):
+        """Count the result of an upload, adjusting the limit at the end of
+        each interval
+        """
+        with self.lock:
+            if result == UPLOAD_OK:
+                self.ok += 1
+            elif result == FAIL_BUSY:
+                self.busy += 1
+            else:
+                self.failed += 1
+            if time.time() - self.started >= self.interval:
+                self._adjust()
+                
+    def _adjust(self):
+        elapsed = max(time.time() - self.started, 0.001)
+        throughput = (metrics.total("ftp_upload_bytes_total") - 
+                      self.start_bytes) / elapsed
+        total = self.ok + self.busy + self.failed
+        counts = self.scheduler.counts()
+        active = counts['active_today'] + counts['active_backlog']
+        limit = self.limit
+        increased = False
+        if self.busy or self.failed > total * self.max_error_rate:
+            limit = max(self.low, int(limit * self.decrease))
+            reason = ("%d of %d uploads were refused as too many "
+                      "connections and %d failed otherwise" % 
+                      (self.busy, total, self.failed))
+        elif (self.increased and self.throughput != None and 
+              throughput < self.throughput * 0.9):
+            limit = max(self.low, limit - 1)
+            reason = ("throughput fell from %.0f to %.0f bytes/s" % 
+                      (self.throughput, throughput))
+        elif self.scheduler.saturated() and limit < self.high:
+            limit += 1
+            increased = True
+            reason = ("%d files are waiting" % 
+                      (counts['queued_today'] + counts['queued_backlog']))
+        if limit != self.limit:
+            direction = "up" if limit > self.limit else "down"
+            logging.info("upload concurrency %s from %d to %d: %s", 
+                         direction, self.limit, limit, reason)
+            metrics.inc("ftp_upload_concurrency_changes_total", 
+                        labels={'direction': direction})
+            self.scheduler.set_limit(limit)
+            if limit < self.limit and self.pool != None:
+                self.pool.trim(max(0, limit - active))
+            self.limit = limit
+        self.increased = increased
+        self.throughput = throughput
+        metrics.set("ftp_upload_concurrency_limit", self.limit)
+        metrics.set("ftp_upload_throughput_bytes", throughput)
+        self._start_interval()
+
+
+def reply_error(line):
+    """Return the ftplib exception for an FTP error reply line, so that it
+    can be classified like the errors ftplib raises
+    """
+    if line[:1] == "4":
+        return ftplib.error_temp(line)
+    if line[:1] == "5":
+        return ftplib.error_perm(line)
+    return ftplib.error_reply(line)
+
+
+class FileProducer():
+    """An asynchat producer that reads a file a block at a time"""
+    def __init__(self, filehandle, blocksize):
+        self.filehandle = filehandle
+        self.blocksize = blocksize
+        self.done = False       # set once the whole file has been read
+        
+    def more(self):
+        data = self.filehandle.read(self.blocksize)
+        if not data:
+            self.done = True
+        return data
+
+
+class AsyncDataChannel(asynchat.async_chat):
+    """The passive-mode data connection an AsyncFTPSession sends a file on.
+    The file isn't sent until start() is called, when the server has
+    accepted the STOR.  complete is set only if the whole file was sent,
+    since the server acknowledges a transfer cut short by an error at our
+    end as readily as a finished one.
+    """
+    ac_out_buffer_size = 65536
+    
+    def __init__(self, session, address, filepath):
+        asynchat.async_chat.__init__(self, map=session.engine.map)
+        self.session = session
+        self.filehandle = open(filepath, "rb")
+        self.started = False
+        self.producer = None
+        self.complete = False
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+        
+    def start(self):
+        self.started = True
+        if self.connected:
+            self._send_file()
+            
+    def _send_file(self):
+        self.producer = FileProducer(self.filehandle, self.ac_out_buffer_size)
+        self.push_with_producer(self.producer)
+        self.close_when_done()
+        
+    def handle_connect(self):
+        if self.started:
+            self._send_file()
+            
+    def handle_write(self):
+        self.session.last_activity = time.time()
+        asynchat.async_chat.handle_write(self)
+        
+    def collect_incoming_data(self, data):
+        pass    # nothing is expected from the server on a STOR
+    
+    def found_terminator(self):
+        pass
+    
+    def handle_close(self):
+        # asynchat calls this when everything pushed has been sent, and 
+        # asyncore when the server closes the connection, perhaps early
+        self.complete = (self.producer != None and self.producer.done and
+                         not self.producer_fifo)
+        self.close()
+        
+    def handle_error(self):
+        logging.warning("FTP data connection failed: %s", sys.exc_info()[1])
+        self.complete = False
+        self.close()
+        
+    def close(self):
+        self.filehandle.close()
+        asynchat.async_chat.close(self)
+        
+
+class AsyncFTPSession(asynchat.async_chat):
+    """One FTP control connection driven by an AsyncUploadEngine's event
+    loop.
+    
+    The session logs in, then uploads the jobs the engine hands it with
+    start(), one at a time: change to the job's directory, creating it if
+    need be, open a passive data connection and STOR the file.  Each step
+    is sent when the reply to the one before arrives, so nothing blocks.
+    """
+    def __init__(self, engine):
+        asynchat.async_chat.__init__(self, map=engine.map)
+        self.engine = engine
+        self.set_terminator("\r\n")
+        self.line = []
+        self.reply_lines = []   # the lines so far of a multi-line reply
+        self.state = "connecting"
+        self.ready = False      # logged in and waiting for a job
+        self.cwd = None
+        self.job = None
+        self.today = None
+        self.made_dirs = False
+        self.to_make = []
+        self.data = None
+        self.failure = FAIL_TRANSIENT   # what to report if the session dies
+        self.last_activity = time.time()
+        self.started = self.last_activity   # of the connection, then the job
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect((cfg.ftp_server, cfg.ftp_port))
+        except:
+            self.close()
+            raise
+        
+    def start(self, job, today):
+        """Upload job, as soon as the session is logged in"""
+        self.job = job
+        self.today = today
+        self.made_dirs = False
+        self.last_activity = time.time()
+        if self.ready:
+            self._begin()
+            
+    def quit(self):
+        self.ready = False
+        self.state = "quit"
+        self.push("QUIT\r\n")
+        self.close_when_done()
+        
+    def _send(self, command, state):
+        self.state = state
+        self.push(command + "\r\n")
+        
+    def _begin(self):
+        self.ready = False
+        self.started = time.time()
+        journal_record(self.job[1], UploadJournal.UPLOADING)
+        if self.cwd == self.job[0]:
+            remote_dirs.count_saved()
+            self._send("PASV", "pasv")
+        else:
+            self._send("CWD " + self.job[0], "cwd")
+            
+    def _job_finished(self, result):
+        (job, today) = (self.job, self.today)
+        if result == UPLOAD_OK:
+            record_upload(job[1], self.started, "primary", 
+                          upload_source(job[1]))
+        else:
+            record_failure(result, "primary")
+        self.job = None
+        self.state = "idle"
+        self.ready = True
+        self.last_activity = time.time()
+        self.engine.upload_done(job, today, result)
+        
+    def _job_failed(self, line):
+        e = reply_error(line)
+        logging.error("Failed to store ftp file: %s: %s", self.job[1], line)
+        if isinstance(e, ftplib.error_perm):
+            remote_dirs.forget(self.job[0])
+            self.cwd = None
+        if self.data != None:
+            self.data.close()
+            self.data = None
+        self._job_finished(classify_failure(e))
+            
+    def collect_incoming_data(self, data):
+        self.line.append(data)
+        
+    def found_terminator(self):
+        line = "".join(self.line)
+        self.line = []
+        self.last_activity = time.time()
+        if self.reply_lines:
+            if not (line[:3] == self.reply_lines[0][:3] and line[3:4] == " "):
+                self.reply_lines.append(line)
+                return
+            self.reply_lines = []
+        elif line[3:4] == "-":
+            self.reply_lines = [line]
+            return
+        
+        if line.startswith("421"):
+            logging.warning("FTP server closing the connection: %s", line)
+            self.close()
+        elif line.startswith("1"):
+            if self.state == "stor" and self.data != None:
+                self.data.start()
+        else:
+            getattr(self, "_reply_" + self.state)(line)
+            
+    def _reply_connecting(self, line):
+        if not line.startswith("2"):
+            logging.error("Failed to open FTP connection, %s", line)
+            self.close()
+            return
+        self._send("USER " + cfg.ftp_username, "user")
+        
+    def _reply_user(self, line):
+        if line.startswith("331"):
+            self._send("PASS " + cfg.ftp_password, "password")
+        else:
+            self._reply_password(line)
+            
+    def _reply_password(self, line):
+        if line.startswith("2"):
+            self._send("TYPE I", "type")
+            return
+        logging.error("Failed to open FTP connection, %s", line)
+        if line.startswith("530"):
+            self.failure = FAIL_AUTH
+        self.close()
+        
+    def _reply_type(self, line):
+        if not line.startswith("2"):
+            logging.error("FTP server refused binary mode: %s", line)
+            self.close()
+            return
+        metrics.observe("ftp_upload_connect_seconds", 
+                        time.time() - self.started, {'target': "primary"})
+        self.ready = True
+        self.state = "idle"
+        if self.job != None:
+            self._begin()
+            
+    def _reply_cwd(self, line):
+        ftp_dir = self.job[0]
+        if line.startswith("2"):
+            self.cwd = ftp_dir
+            remote_dirs.add(ftp_dir)
+            self._send("PASV", "pasv")
+            return
+        remote_dirs.forget(ftp_dir)
+        if self.made_dirs:
+            logging.warning("can't make/change to ftp directory %s: %s",
+                            ftp_dir, line)
+            self._job_finished(FAIL_TRANSIENT)
+            return
+        # create each directory along the path that isn't known to exist
+        self.made_dirs = True
+        self.to_make = []
+        path = ""
+        for part in ftp_dir.strip("/").split("/"):
+            path += "/" + part
+            if not remote_dirs.known(path):
+                self.to_make.append(path)
+        self._make_next()
+        
+    def _make_next(self):
+        if self.to_make:
+            self._send("MKD " + self.to_make.pop(0), "mkd")
+        else:
+            self._send("CWD " + self.job[0], "cwd")
+            
+    def _reply_mkd(self, line):
+        self._make_next()   # a 550 usually means it's already there
+        
+    def _reply_pasv(self, line):
+        if not line.startswith("227"):
+            self._job_failed(line)
+            return
+        try:
+            address = ftplib.parse227(line)
+            self.data = AsyncDataChannel(self, address, 
+                                         upload_source(self.job[1]))
+        except Exception, e:
+            logging.error("Failed to store ftp file: %s: %s", self.job[1], e)
+            self._job_finished(classify_failure(e))
+            return
+        logging.debug("Uploading %s", self.job[1])
+        self._send("STOR " + self.job[3], "stor")
+        
+    def _reply_stor(self, line):
+        if not line.startswith("2"):
+            self._job_failed(line)
+            return
+        (data, self.data) = (self.data, None)
+        if data == None or not data.complete:
+            logging.warning("FTP data connection for %s ended before the "
+                            "whole file was sent", self.job[1])
+            if data != None:
+                data.close()
+            self._job_finished(FAIL_TRANSIENT)
+            return
+        journal_record(self.job[1], UploadJournal.UPLOADED)
+        self._job_finished(UPLOAD_OK)
+        
+    def _reply_idle(self, line):
+        pass
     
-max_threads = 8 # max number of total threads when needed one thread will be used for purging job, rest of time all threads will be used for upload.
-reserved_priority_threads = 3 # previousdays can only upload multithreaded when running today threads fall below this number.
-current_priority_threads=0 # global variable shared between threads keeping track of running priority threads.
-
-
-def mkdir(dirname):
-    try:
-        os.mkdir(dirname)
-    except:
+    def _reply_quit(self, line):
         pass
+        
+    def handle_connect(self):
+        pass    # wait for the server's greeting
+        
+    def handle_close(self):
+        self.close()
+        
+    def handle_error(self):
+        logging.warning("FTP session failed: %s", sys.exc_info()[1])
+        self.close()
+        
+    def close(self):
+        if self.data != None:
+            self.data.close()
+            self.data = None
+        asynchat.async_chat.close(self)
+        if self in self.engine.sessions:
+            self.engine.sessions.remove(self)
+        if self.job != None:
+            (job, today) = (self.job, self.today)
+            self.job = None
+            self.engine.upload_done(job, today, self.failure)
 
 
-def rmdir(dirname):
-    try:
-        os.rmdir(dirname)
-    except:
-        pass
-
+class AsyncWaker(asyncore.file_dispatcher):
+    """A pipe that wakes an asyncore loop from another thread"""
+    def __init__(self, socket_map):
+        (rfd, self.wfd) = os.pipe()
+        asyncore.file_dispatcher.__init__(self, rfd, socket_map)
+        os.close(rfd)   # file_dispatcher keeps a duplicate
         
-def change_create_ftp_dir(ftp_connection, dirname):
-    # dirname is relative or absolute
-    
-    if ftp_connection != None:
+    def wake(self):
         try:
-            ftp_connection.cwd(dirname)
-        except ftplib.error_perm :
-            try:
-                ftp_connection.mkd(dirname)
-                ftp_connection.cwd(dirname)     
-            except Exception, e:
-                logging.warning("can't make/change to ftp directory %s" % dirname)
-                logging.exception(e)
-                return False
+            os.write(self.wfd, "x")
+        except OSError:
+            pass
         
-    return True
-
-def dir2date(indir):
-    #extract date from indir style z:\\ftp\\12-01-2
-    searchresult = re.search(r".*/([0-9]{4})-([0-9]{2})-([0-9]{2})", indir)
-    if searchresult == None:     #extract date from indir style 12-01-2
-        searchresult = re.search(r".*([0-9]{4})-([0-9]{2})-([0-9]{2})", indir)
+    def handle_read(self):
+        self.recv(4096)
         
-    if searchresult != None:
-        year= int(searchresult.group(1))
-        month = int(searchresult.group(2))
-        day = int(searchresult.group(3))
-    else:
-        year = None
-        month = None
-        day = None
-
-    return (year, month, day)
+    def writable(self):
+        return False
+    
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.wfd)
 
 
-def get_daydirs(location):        
-    daydirlist = os.listdir(location)
+class AsyncUploadEngine(UploadExecutor):
+    """An UploadExecutor that runs many FTP sessions on a single asyncore
+    event loop rather than one thread per upload, for small machines where
+    threads are expensive.
+    
+    Files are queued, scheduled, retried and given up on as by
+    UploadExecutor, with up to connections uploads in progress at once.
+    Idle sessions are logged out after cfg.ftp_keepalive seconds.  Partial
+    uploads are sent again from the start rather than resumed.
+    """
+    timeout = 30    # seconds of silence before a session is given up on
+    
+    def __init__(self, connections, reserved, max_wait, policy, breaker,
+                 max_attempts):
+        self.connections = connections
+        self.map = {}
+        self.sessions = []
+        self.waker = AsyncWaker(self.map)
+        UploadExecutor.__init__(self, connections, reserved, max_wait,
+                                policy, breaker, max_attempts)
+        
+    def _start_workers(self, nthreads):
+        thread = threading.Thread(target=self._worker, name="upload-async")
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+        
+    def submit(self, ftp_dir, filepath, donepath, filename, today):
+        queued = UploadExecutor.submit(self, ftp_dir, filepath, donepath,
+                                       filename, today)
+        if queued:
+            self.waker.wake()
+        return queued
+    
+    def shutdown(self):
+        self.scheduler.close()
+        self.waker.wake()
+        for thread in self.threads:
+            thread.join()
+            
+    def upload_done(self, job, today, result):
+        """Called by a session when it has finished with a job"""
+        if result == UPLOAD_OK:
+            move_stored_file(job[1], job[2], job[3])
+        self._finished(job, today, result)
+        self.scheduler.task_done(today)
+            
+    def _worker(self):
+        while True:
+            self._dispatch()
+            if (self.scheduler.finished() and 
+                    not [s for s in self.sessions if s.job != None]):
+                break
+            asyncore.loop(timeout=0.5, map=self.map, count=1)
+            self._expire()
+            
+        for session in list(self.sessions):
+            session.quit()
+        deadline = time.time() + 5
+        while self.sessions and time.time() < deadline:
+            asyncore.loop(timeout=0.5, map=self.map, count=1)
+        for session in list(self.sessions):
+            session.close()
+        self.waker.close()
+        
+    def _dispatch(self):
+        """Hand queued jobs to idle sessions, opening new sessions while
+        there are fewer than connections
+        """
+        while True:
+            idle = [s for s in self.sessions if s.ready and s.job == None]
+            if not idle and len(self.sessions) >= self.connections:
+                return
+            task = self.scheduler.poll()
+            if task == None:
+                return
+            (job, today) = task
+            if not self.breaker.allow():
+                self._hold(job, today)
+                self.scheduler.task_done(today)
+                continue
+            if journal_confirmed(job[1]):
+                logging.info("%s is already on the server; not sending it "
+                             "again", job[1])
+                self.upload_done(job, today, UPLOAD_OK)
+                continue
+            
+            same_dir = [s for s in idle if s.cwd == job[0]]
+            if same_dir:
+                session = same_dir[0]
+            elif idle:
+                session = idle[0]
+            else:
+                try:
+                    session = AsyncFTPSession(self)
+                except Exception, e:
+                    logging.error("Failed to open FTP connection, %s", e)
+                    self.upload_done(job, today, classify_failure(e))
+                    continue
+                self.sessions.append(session)
+            session.start(job, today)
+            
+    def _expire(self):
+        now = time.time()
+        for session in list(self.sessions):
+            if session.job != None or not session.ready:
+                if now - session.last_activity > self.timeout:
+                    logging.warning("FTP session timed out")
+                    session.close()
+            elif now - session.last_activity > cfg.ftp_keepalive:
+                session.quit()
 
-    daydirs=[]
-    for direc in daydirlist:
-        (year, unused_month, unused_day) = dir2date(direc)
-        dirpath = os.path.join(location, direc)
-        if os.path.isdir(dirpath) and year != None:
-            daydirs.append((dirpath,direc))
-    daydirs = sorted(daydirs)
 
-    return daydirs	
+class AckTracker():
+    """Keeps track of which required targets have stored each file when
+    mirroring, and moves a file to its donepath once they all have it.
+    """
+    def __init__(self, required):
+        self.required = set(required)   # the names of the required targets
+        self.lock = threading.Lock()
+        self.acks = {}      # filepath -> names of targets that have it
+        
+    def acked(self, filepath):
+        with self.lock:
+            return set(self.acks.get(filepath, ()))
+        
+    def ack(self, job, name):
+        (unused_dir, filepath, donepath, filename, unused_today) = job
+        if name not in self.required:
+            return
+        with self.lock:
+            names = self.acks.setdefault(filepath, set())
+            names.add(name)
+            done = self.required <= names
+            if done:
+                del self.acks[filepath]
+        if done:
+            move_stored_file(filepath, donepath, filename)
 
 
-def connect_to_ftp():
-    ftp_connection = None   
-    try:
-        ftp_connection = ftplib.FTP(cfg.ftp_server, cfg.ftp_username, 
-                                    cfg.ftp_password, timeout=30)
-        logging.debug(ftp_connection.getwelcome())
-        logging.debug("current directory is: %s", ftp_connection.pwd())
-        logging.debug("changing directory to: %s", cfg.ftp_destination)
-        ftp_connection.cwd(cfg.ftp_destination)
-        logging.debug("current directory is: %s", ftp_connection.pwd())
-    except ftplib.error_perm, e:
-        logging.error("Failed to open FTP connection, %s", e)
-        ftp_connection = None
-        logging.info("Sleeping 10 minutes before trying again")
-        time.sleep(600)
-    except Exception, e:
-        logging.error("Unexpected exception in connect_to_ftp():")
-        logging.exception(e)
-        if ftp_connection != None:
-            ftp_connection.close()  # close any connection to cloud server
-        ftp_connection = None
+class TargetExecutor(UploadExecutor):
+    """The UploadExecutor for one target of a FanOutExecutor.  The backlog
+    queue is large so that a slow target doesn't block the directory walk
+    for the others.
+    """
+    backlog_size = 100000
+    
+    def __init__(self, target, tracker, nthreads, reserved, max_wait, policy,
+                 breaker, max_attempts, batch_size, batch_flush):
+        self.target = target
+        self.tracker = tracker
+        self.thread_prefix = "upload-" + target.name
+        UploadExecutor.__init__(self, nthreads, reserved, max_wait, policy,
+                                breaker, max_attempts, batch_size, 
+                                batch_flush, self.backlog_size)
         
-    return ftp_connection
+    def store(self, jobs):
+        return storefiles(jobs, self.target, self.tracker)
 
-def quit_ftp(ftp_connection):
-    if ftp_connection != None :
-        try:
-            ftp_connection.quit()
-            logging.debug("ftp connection successfully closed")
-        except Exception, e:
-            #logging.warning("Exception during FTP.quit():", e)
-            logging.warning("Exception during FTP.quit():")
-            logging.exception(e)
 
+class FanOutExecutor():
+    """Uploads every file to each of targets.
     
-def storefile(ftp_dir, filepath, donepath, filename, today):
-    global current_priority_threads
-    if today:
-        current_priority_threads += 1
-        logging.info("current Priority threads %s", current_priority_threads)
+    Each target has its own TargetExecutor, with its own queue, workers,
+    session pool and circuit breaker, so a slow or broken target doesn't
+    hold up the others.  A file is moved to its donepath once all the
+    required targets have stored it; until then it stays in the incoming
+    tree, and a rescan queues it again only for the targets that don't have
+    it.
+    """
+    def __init__(self, targets, make_executor):
+        """:param make_executor: called with a target and the AckTracker to 
+        make the target's TargetExecutor
+        """
+        self.tracker = AckTracker([t.name for t in targets if t.required])
+        self.executors = [make_executor(t, self.tracker) for t in targets]
         
-    ftp_connection = connect_to_ftp()
-    if ftp_connection != None:
-        if not change_create_ftp_dir(ftp_connection, ftp_dir):
-            # if we can't create or change to the ftp_dir for some reason
-            # (probably transient), abort storing the file, and let it be
-            # picked up by the main loop next time around
-            logging.warn("storefile: aborting; couldn't change to %s" % ftp_dir)
-            quit_ftp(ftp_connection)
-            if today:
-                current_priority_threads -= 1
-            return
+    def submit(self, ftp_dir, filepath, donepath, filename, today):
+        if self.is_pending(filepath):
+            return False
+        acked = self.tracker.acked(filepath)
+        queued = False
+        for executor in self.executors:
+            target = executor.target
+            if target.name not in acked:
+                if executor.submit(target.remote_dir(ftp_dir), filepath, 
+                                   donepath, filename, today):
+                    queued = True
+        return queued
+    
+    def is_pending(self, filepath):
+        for executor in self.executors:
+            if executor.is_pending(filepath):
+                return True
+        return False
+    
+    def join(self):
+        for executor in self.executors:
+            executor.join()
             
-        logging.info("Uploading %s", filepath)
-        try:
-            filehandle = open(filepath, "rb")
-            ftp_connection.storbinary("STOR " + filename, filehandle)
-            filehandle.close()
-            logging.info("file : %s stored on ftp", filename)
-            logging.info("moving file to Storage")
-
-            try :
-                # if the directory we want to move the file into doesn't exist,
-                # create it.  This is a hack.  It's intended to recover from the
-                # case where the purge process has deleted an old storage day-
-                # directory, but for whatever reason, there are still files in
-                # the incoming area for that day that need to be FTP'd to the
-                # server
-                #
-                donedir = os.path.dirname(donepath)
-                if not os.path.exists(donedir):
-                    os.makedirs(donedir)
-                    
-                shutil.move(filepath, donepath)
-            except Exception, e:
-                logging.warning("can't move file %s, possible sharing violation", filepath )
-                logging.exception(e)
+    def shutdown(self):
+        for executor in self.executors:
+            executor.scheduler.close()
+        for executor in self.executors:
+            executor.shutdown()
 
-        except Exception, e:
-            logging.error("Failed to store ftp file: %s: %s", filepath, e)
-            logging.exception(e)
-            filehandle.close()
-            logging.info("Sleeping 10 minutes before trying again")
-            time.sleep(600)
-                
-        quit_ftp(ftp_connection)
-    
-    else :
-        time.sleep(600)
-    # end if
 
-    if today :
-        current_priority_threads -= 1
+upload_executor = None
+upload_executor_lock = threading.Lock()
 
-    return
+def upload_pending(filepath):
+    """Return True if filepath is queued to be recompressed or uploaded, or
+    is being, in this process
+    """
+    executor = upload_executor
+    if recompressor != None:
+        executor = recompressor
+    return executor != None and executor.is_pending(filepath)
 
-def storedir(dirpath, ftp_dir, done_dir, today):
-    global current_priority_threads
-    global reserved_priority_threads
+def get_upload_executor():
+    """Return the upload executor, starting its threads if need be"""
+    global upload_executor
+    with upload_executor_lock:
+        if upload_executor == None:
+            policy = RetryPolicy(cfg.retry_base_delay, cfg.retry_max_delay)
+            breaker = CircuitBreaker(cfg.breaker_threshold, policy)
+            if cfg.mirror_targets:
+                if cfg.upload_engine == "async":
+                    logging.warning("mirror_targets uses the threads upload "
+                                    "engine")
+                upload_executor = FanOutExecutor(
+                        [primary_target()] + cfg.mirror_targets, 
+                        lambda target, tracker: TargetExecutor(target, 
+                            tracker, cfg.upload_threads, 
+                            cfg.reserved_priority_threads,
+                            cfg.backlog_max_wait, policy,
+                            CircuitBreaker(cfg.breaker_threshold, policy),
+                            cfg.max_file_attempts, cfg.upload_batch_size,
+                            cfg.batch_flush_time))
+            elif cfg.upload_engine == "async":
+                upload_executor = AsyncUploadEngine(cfg.async_connections,
+                                            cfg.reserved_priority_threads,
+                                            cfg.backlog_max_wait, policy,
+                                            breaker, cfg.max_file_attempts)
+                if cfg.adaptive_concurrency:
+                    upload_executor.controller = ConcurrencyController(
+                            upload_executor.scheduler, 
+                            cfg.min_upload_threads, cfg.async_connections,
+                            cfg.async_connections, cfg.concurrency_interval)
+            else:
+                nthreads = cfg.upload_threads
+                # uploads beyond the pool size would only wait for a session
+                high = min(cfg.max_upload_threads, cfg.ftp_pool_size)
+                if cfg.adaptive_concurrency:
+                    nthreads = max(nthreads, high)
+                upload_executor = UploadExecutor(nthreads,
+                                             cfg.reserved_priority_threads,
+                                             cfg.backlog_max_wait, policy,
+                                             breaker, cfg.max_file_attempts,
+                                             cfg.upload_batch_size,
+                                             cfg.batch_flush_time)
+                if cfg.adaptive_concurrency:
+                    upload_executor.controller = ConcurrencyController(
+                            upload_executor.scheduler, 
+                            cfg.min_upload_threads, high,
+                            cfg.upload_threads, cfg.concurrency_interval,
+                            get_ftp_pool())
+        return upload_executor
     
-    logging.info("starting storedir")
-    logging.info("dirpath = %s", dirpath)
-    logging.info("ftp_dir = %s", ftp_dir)
-    logging.info("done_dir = %s", done_dir)
+def stop_upload_executor():
+    global upload_executor
+    with upload_executor_lock:
+        if upload_executor != None:
+            upload_executor.shutdown()
+            upload_executor = None
+
+
+def storedir(dirpath, ftp_dir, done_dir, today):
+    logging.info("storedir: %s to %s", dirpath, ftp_dir)
+    logging.debug("done_dir = %s", done_dir)
 
-    ftp_connection = connect_to_ftp()
-    dir_ok = change_create_ftp_dir(ftp_connection, ftp_dir)
-    quit_ftp(ftp_connection)
+    pool = get_ftp_pool()
+    session = None
+    if remote_dirs.known(ftp_dir):
+        remote_dirs.count_saved()
+    else:
+        try:
+            session = pool.get()
+        except Exception:
+            pass    # the upload workers will deal with the connection problem
+    dir_ok = True
+    if session != None:
+        dir_ok = change_session_dir(session, ftp_dir)
+        pool.put(session)
     if not dir_ok:
         # if we can't create or change to the ftp_dir for some reason
         # (probably transient), abort storing the dir, and let it be
@@ -233,75 +3223,393 @@ def storedir(dirpath, ftp_dir, done_dir, today):
     
     mkdir(done_dir)
     
-    files = os.listdir(dirpath)
-    for filename in files:
-        filepath = os.path.join(dirpath, filename)
-        donepath = os.path.join(done_dir, filename)
-        if os.path.isfile(filepath):
-#            storefile(ftp_dir, filepath, donepath, filename)
-
-            current_threads = threading.active_count()
-            logging.info("current threads: %s", current_threads)
-
-            if (current_threads >= max_threads) or (not today and current_priority_threads>=reserved_priority_threads):
-                # to many threads running already, upload ftp in current thread (don't move forward until upload is done)
-                storefile(ftp_dir, filepath, donepath, filename, today)
-                current_threads = threading.active_count()
-                logging.info("current threads: %s", current_threads)
-            else:
-                
-                # start new thread
-                logging.info("starting new storefile thread")
-                threading.Thread(target=storefile, args=(ftp_dir, filepath, donepath, filename, today)).start()
-                current_threads = threading.active_count()
-                logging.info("current threads: %s", current_threads)
-            #end if
-            
-        elif os.path.isdir(filepath):
-            logging.info("Handling subdirectory %s", filepath)
-            new_ftp_dir = ftp_dir + "/" + filename
-            storedir(filepath, new_ftp_dir, donepath, today)
-        # end if
-    # end for
+    # subdirectories are created on the server and in done_dir by
+    # the upload workers as their files are uploaded
+    executor = get_upload_executor()
+    if get_recompressor() != None:
+        executor = get_recompressor()   # it queues each file when it's done
+    readiness = get_readiness()
+    for (path, relpath, is_file) in walk_tree(dirpath):
+        if is_file:
+            if not in_shard(relpath) or executor.is_pending(path):
+                continue
+            if not readiness.ready(path):
+                logging.debug("%s is still being written", path)
+                continue
+            (reldir, filename) = os.path.split(relpath)
+            file_ftp_dir = ftp_dir
+            if reldir:
+                file_ftp_dir += "/" + reldir.replace(os.sep, "/")
+            donepath = os.path.join(done_dir, relpath)
+            if executor.submit(file_ftp_dir, path, donepath, filename, today):
+                logging.debug("queued %s for upload", path)
+        else:
+            rmdir(path)     # fails harmlessly if uploads are still queued
 
     rmdir(dirpath)
     
     return
 
     
-def deltree(deldir):
-    logging.info("deltree: %s", (deldir))
-    files_to_be_deleted = sorted(os.listdir(deldir))
-    for file2del in files_to_be_deleted:
-        filepath = os.path.join(deldir, file2del)
-        if os.path.isdir(filepath):
-            deltree(filepath)
+class DataConnectionWriter():
+    """A write-only file object that sends what's written to it over an
+    FTP data connection, for tarfile's stream mode
+    """
+    def __init__(self, conn, callback=None):
+        self.conn = conn
+        self.callback = callback
+        self.size = 0
+        
+    def write(self, data):
+        self.conn.sendall(data)
+        self.size += len(data)
+        if self.callback != None:
+            self.callback(len(data))
+            
+
+class HashingReader():
+    """Wraps a file being read so that hasher sees everything read from it"""
+    def __init__(self, filehandle, hasher):
+        self.filehandle = filehandle
+        self.hasher = hasher
+        
+    def read(self, size=-1):
+        data = self.filehandle.read(size)
+        self.hasher.update(data)
+        return data
+    
+
+def send_bundle(session, name, files, callback=None):
+    """Stream files into a tar archive called name in the session's current
+    directory, then store its manifest as name.manifest.  The manifest is
+    JSON, listing the path, size, mtime and SHA-1 digest of each file in the
+    archive; it's only stored once the whole archive has been, so the
+    server side should unpack an archive only when its manifest appears.
+    :param files: a list of (filepath, relpath) where relpath is the path
+    of the file in the archive
+    :return: the number of bytes in the archive
+    """
+    manifest = {'archive': name, 'created': time.time(), 'files': []}
+    session.ftp.voidcmd("TYPE I")
+    conn = session.ftp.transfercmd("STOR " + name)
+    try:
+        writer = DataConnectionWriter(conn, callback)
+        archive = tarfile.open(fileobj=writer, mode="w|", 
+                               bufsize=cfg.ftp_blocksize)
+        for (filepath, relpath) in files:
+            arcname = relpath.replace(os.sep, "/")
+            hasher = hashlib.sha1()
+            with open(upload_source(filepath), "rb") as f:
+                tarinfo = archive.gettarinfo(arcname=arcname, fileobj=f)
+                tarinfo.uid = tarinfo.gid = 0
+                tarinfo.uname = tarinfo.gname = ""
+                archive.addfile(tarinfo, HashingReader(f, hasher))
+            manifest['files'].append({'path': arcname, 
+                                      'size': tarinfo.size,
+                                      'mtime': tarinfo.mtime,
+                                      'sha1': hasher.hexdigest()})
+        archive.close()
+    finally:
+        conn.close()
+    session.ftp.voidresp()
+    session.ftp.storbinary("STOR %s.manifest" % name, 
+                           StringIO.StringIO(json.dumps(manifest, indent=1)))
+    return writer.size
+
+def store_bundles(dirpath, day, ftp_dir, done_dir):
+    """Upload a previous day's directory as tar archives of up to 
+    cfg.bundle_max_files files and cfg.bundle_max_size MB each, in place of
+    a STOR for each file, and move the files in each archive to done_dir 
+    once it has been stored.  The files in an archive that fails are left
+    for the next pass.
+    """
+    executor = get_upload_executor()
+    readiness = get_readiness()
+    chunk = []
+    chunk_bytes = 0
+    count = itertools.count()
+    stamp = time.strftime("%H%M%S")
+    if shard != None:
+        stamp += "-%d" % shard[0]   # the other processes bundle this day too
+    for (path, relpath, is_file) in walk_tree(dirpath):
+        if not is_file or not in_shard(relpath):
+            continue
+        if executor.is_pending(path) or not readiness.ready(path):
+            continue
+        try:
+            chunk_bytes += os.path.getsize(upload_source(path))
+        except OSError:
+            continue
+        chunk.append((path, relpath))
+        if (len(chunk) >= cfg.bundle_max_files or 
+            chunk_bytes >= cfg.bundle_max_size * 1048576):
+            name = "%s_%s_%03d.tar" % (day, stamp, next(count))
+            if not store_bundle(ftp_dir, name, chunk, done_dir):
+                return
+            chunk = []
+            chunk_bytes = 0
+    if chunk:
+        name = "%s_%s_%03d.tar" % (day, stamp, next(count))
+        if not store_bundle(ftp_dir, name, chunk, done_dir):
+            return
+    for (path, unused_relpath, is_file) in walk_tree(dirpath):
+        if not is_file:
+            rmdir(path)
+    rmdir(dirpath)
+    
+def store_bundle(ftp_dir, name, files, done_dir):
+    """Upload files as the archive name in ftp_dir with send_bundle() and
+    move them to done_dir.
+    :return: True if the archive was stored
+    """
+    target = primary_target()
+    pool = target.get_pool()
+    try:
+        session = pool.get()
+    except Exception, e:
+        logging.warning("can't connect to upload archive %s: %s", name, e)
+        record_failure(classify_failure(e), target.name)
+        return False
+    started = time.time()
+    try:
+        if not change_session_dir(session, ftp_dir):
+            logging.warning("store_bundle: couldn't change to %s", ftp_dir)
+            return False
+        nbytes = send_bundle(session, name, files, 
+                             upload_callback(ftp_dir, False))
+    except Exception, e:
+        record_failure(classify_failure(e), target.name)
+        logging.warning("failed to store archive %s: %s", name, e)
+        session.cwd = None
+        session.broken = connection_lost(e)
+        return False
+    finally:
+        pool.put(session)
+    logging.info("stored %d files, %.1f MB, as %s/%s in %.1f seconds", 
+                 len(files), nbytes / 1048576.0, ftp_dir, name, 
+                 time.time() - started)
+    metrics.inc("ftp_upload_bundles_total")
+    for (filepath, relpath) in files:
+        record_upload(filepath, started, target.name, 
+                      upload_source(filepath))
+        move_stored_file(filepath, os.path.join(done_dir, relpath), 
+                         os.path.basename(filepath))
+    return True
+
+    
+def deltree(deldir, bucket=None, keep=None):
+    """Delete deldir and everything in it, streaming through the tree 
+    rather than listing it first.
+    :param bucket: a TokenBucket that paces the deletions, in files
+    :param keep: a function that returns True for the path of a file that
+    is to be left, with the directories above it
+    :return: the number of files and the number of bytes deleted
+    """
+    logging.debug("deltree: %s", (deldir))
+    nfiles = 0
+    nbytes = 0
+    for (filepath, unused_relpath, is_file) in walk_tree(deldir):
+        if not is_file:
             rmdir(filepath)
-        else:
-            logging.info("deleting %s", filepath)
-            if cfg.delete == False :
-                logging.info("would have deleted %s here - to really delete change delete flag to True", filepath)
-            else :
-                os.remove(filepath)
+            continue
+        if keep != None and keep(filepath):
+            continue
+        if cfg.delete == False :
+            logging.debug("would have deleted %s here - to really delete change delete flag to True", filepath)
+            continue
+        if bucket != None:
+            time.sleep(bucket.take(1))
+        try:
+            size = os.lstat(filepath).st_size
+            os.remove(filepath)
+        except OSError, e:
+            logging.warning("deltree: couldn't delete %s: %s", filepath, e)
+            continue
+        logging.debug("deleted %s", filepath)
+        nfiles += 1
+        nbytes += size
     rmdir(deldir)
-    return
+    return (nfiles, nbytes)
+
+def disk_usage(path):
+    """Return the percentage of the space on path's file system that is in
+    use, counting the space reserved for root as used, as df does
+    """
+    st = os.statvfs(path)
+    if st.f_blocks == 0:
+        return 0.0
+    return 100.0 * (st.f_blocks - st.f_bavail) / st.f_blocks
+
+def purge_bucket():
+    """Return a TokenBucket to pace a purge, or None if it's unlimited"""
+    if cfg.purge_rate_limit <= 0:
+        return None
+    return TokenBucket(cfg.purge_rate_limit, 
+                       burst=max(1, cfg.purge_rate_limit / 10))
+
+def purge_daydir(dirpath, bucket, reason):
+    global files_purged
+    start = time.time()
+    (nfiles, nbytes) = deltree(dirpath, bucket)
+    logging.info("purged %s (%s): %d files, %.1f MB in %.1f seconds", 
+                 dirpath, reason, nfiles, nbytes / 1048576.0, 
+                 time.time() - start)
+    files_purged = True
 
 files_purged = False    # only used by testing code
 
 def purge_old_images(purge_dir):
+    """Purge the day directories in purge_dir that are older than 
+    retain_days, then, if the disk is fuller than purge_high_water, the 
+    oldest of the rest until it's below purge_low_water.  The newest day is
+    never purged for space.  Does not delete purge_dir itself.
+    """
     global files_purged
-    # Purge directories in Purge_dir, does not delete purge_dir itself
     purge_daydirs=get_daydirs(purge_dir)
     logging.debug("list of directories to be purged: %s", purge_daydirs[0:-cfg.retain_days])
     files_purged = False
-    for purge_daydir in purge_daydirs[0:-cfg.retain_days]:
-        (dirpath, unused_direc) = purge_daydir
-        logging.info("purging directory %s", dirpath)
-        deltree(dirpath)
-        files_purged = True
+    bucket = purge_bucket()
+    for (dirpath, unused_direc) in purge_daydirs[0:-cfg.retain_days]:
+        purge_daydir(dirpath, bucket, "older than %d days" % cfg.retain_days)
+    
+    if cfg.purge_high_water <= 0:
+        return
+    usage = disk_usage(purge_dir)
+    if usage < cfg.purge_high_water:
+        return
+    logging.warning("disk is %.1f%% full, purging down to %.1f%%", usage,
+                    cfg.purge_low_water)
+    for (dirpath, unused_direc) in get_daydirs(purge_dir)[0:-1]:
+        purge_daydir(dirpath, bucket, "disk %.1f%% full" % usage)
+        usage = disk_usage(purge_dir)
+        if usage < cfg.purge_low_water:
+            break
+    else:
+        logging.warning("disk is still %.1f%% full after purging", usage)
     return
 
 
+def free_space(path):
+    """Return the bytes and inodes free for ordinary users on path's file
+    system
+    """
+    st = os.statvfs(path)
+    return (st.f_bavail * st.f_frsize, st.f_favail)
+
+def under_pressure(path):
+    """Return True if path's file system is short of space or inodes"""
+    (free_bytes, free_inodes) = free_space(path)
+    return (free_bytes < cfg.min_free_space * 1048576 
+            or free_inodes < cfg.min_free_inodes)
+
+def thin_daydir(daydir, keep=None):
+    """Delete every other image in each directory of daydir, oldest first.
+    :param keep: as for deltree()
+    :return: the number of files and the number of bytes deleted
+    """
+    nfiles = 0
+    nbytes = 0
+    found = {}      # directory -> the files found in it so far
+    for (path, unused_relpath, is_file) in walk_tree(daydir):
+        if is_file:
+            if keep == None or not keep(path):
+                found.setdefault(os.path.dirname(path), []).append(path)
+            continue
+        # a directory comes after everything in it, so it's complete
+        (n, size) = thin_files(found.pop(path, []))
+        nfiles += n
+        nbytes += size
+    for filepaths in found.values():
+        (n, size) = thin_files(filepaths)
+        nfiles += n
+        nbytes += size
+    return (nfiles, nbytes)
+
+def thin_files(filepaths):
+    """Delete every other one of the files in filepaths, in name order.
+    :return: the number of files and the number of bytes deleted
+    """
+    nfiles = 0
+    nbytes = 0
+    for filepath in sorted(filepaths)[1::2]:
+        if cfg.delete == False :
+            logging.debug("would have deleted %s here - to really delete change delete flag to True", filepath)
+            continue
+        try:
+            size = os.lstat(filepath).st_size
+            os.remove(filepath)
+        except OSError, e:
+            logging.warning("thin_daydir: couldn't delete %s: %s", 
+                            filepath, e)
+            continue
+        nfiles += 1
+        nbytes += size
+    return (nfiles, nbytes)
+
+def relieve_disk_pressure():
+    """If the incoming or processed trees are short of space or inodes,
+    purge the processed days early, oldest first, then, if the incoming 
+    tree is still short, evict its oldest days other than today's as the 
+    eviction_policy says: "delete" deletes whole days, "thin" deletes 
+    every other image of a day, and "none" leaves them alone.  Files 
+    that are queued or being uploaded are never evicted.
+    :return: a dict of what was done, or None if there was no pressure
+    """
+    if cfg.min_free_space <= 0 and cfg.min_free_inodes <= 0:
+        return None
+    if not (under_pressure(cfg.incoming_location) 
+            or under_pressure(cfg.processed_location)):
+        return None
+    
+    report = {'processed_days': 0, 'incoming_days': 0, 'thinned_days': 0,
+              'files': 0, 'bytes': 0}
+    for (dirpath, unused_direc) in get_daydirs(cfg.processed_location):
+        if not (under_pressure(cfg.incoming_location) 
+                or under_pressure(cfg.processed_location)):
+            break
+        (nfiles, nbytes) = deltree(dirpath)
+        if nfiles or not os.path.isdir(dirpath):
+            report['processed_days'] += 1
+        report['files'] += nfiles
+        report['bytes'] += nbytes
+    
+    if cfg.eviction_policy != "none":
+        for (dirpath, unused_direc) in get_daydirs(cfg.incoming_location):
+            if not under_pressure(cfg.incoming_location):
+                break
+            if isdir_today(dirpath):
+                continue
+            # files that are queued or being uploaded are left for the 
+            # upload workers
+            if cfg.eviction_policy == "thin":
+                (nfiles, nbytes) = thin_daydir(dirpath, upload_pending)
+                if nfiles:
+                    report['thinned_days'] += 1
+            else:
+                (nfiles, nbytes) = deltree(dirpath, keep=upload_pending)
+                if nfiles or not os.path.isdir(dirpath):
+                    report['incoming_days'] += 1
+            report['files'] += nfiles
+            report['bytes'] += nbytes
+    
+    logging.warning("disk pressure: purged %d processed days early, "
+                    "evicted %d incoming days and thinned %d, deleting "
+                    "%d files, %.1f MB", report['processed_days'], 
+                    report['incoming_days'], report['thinned_days'], 
+                    report['files'], report['bytes'] / 1048576.0)
+    for path in (cfg.incoming_location, cfg.processed_location):
+        if under_pressure(path):
+            (free_bytes, free_inodes) = free_space(path)
+            logging.error("disk pressure: %s still has only %.1f MB and %d "
+                          "inodes free", path, free_bytes / 1048576.0, 
+                          free_inodes)
+    return report
+
+def purge_and_relieve(purge_dir):
+    purge_old_images(purge_dir)
+    relieve_disk_pressure()
+
+
 def isdir_today(indir):
     (processingyear,processingmonth, processingday) = dir2date(indir)
     current = datetime.date.today()
@@ -315,7 +3623,11 @@ def storeday(daydir, today=False):
         logging.info("processing directory %s", direc)
         ftp_dir = cfg.ftp_destination + "/" + direc
         done_dir = os.path.join(cfg.processed_location, direc)
-        storedir(dirpath, ftp_dir, done_dir, today)
+        if cfg.bundle_backlog and not today and not cfg.mirror_targets:
+            mkdir(done_dir)
+            store_bundles(dirpath, direc, ftp_dir, done_dir)
+        else:
+            storedir(dirpath, ftp_dir, done_dir, today)
     except Exception, e:
         logging.exception(e)
     
@@ -332,6 +3644,252 @@ def storedays(daydirs):
     logging.info("Returning from storedays()")
     return
 
+shard = None        # (index, count) when this is one of the upload processes
+shard_stop = None   # the supervisor's shared flag to stop them
+
+def shard_of(location, nshards):
+    """Return the upload process that handles the camera location.  This
+    must be the same in every process, so hash() won't do, and camera names
+    like cam1, cam2, ... must be spread evenly, so crc32 won't either.
+    """
+    return int(int(hashlib.md5(location).hexdigest(), 16) % nshards)
+
+def shard_stopping():
+    """Return True if this is an upload process that has been asked to stop"""
+    return shard_stop != None and shard_stop.value != 0
+
+def in_shard(relpath):
+    """Return True if this process uploads relpath, the path of a file 
+    relative to its day directory
+    """
+    if shard == None:
+        return True
+    return shard_of(relpath.split(os.sep)[0], shard[1]) == shard[0]
+
+
+def upload_job(filepath):
+    """Work out where a file in the incoming tree goes.
+    :param filepath: the path of a file under incoming_location
+    :return: the (ftp_dir, filepath, donepath, filename, today) job for 
+    UploadExecutor.submit(), or None if the file isn't in a day directory
+    or is uploaded by another process.
+    """
+    relpath = os.path.relpath(filepath, cfg.incoming_location)
+    parts = relpath.split(os.sep)
+    if len(parts) < 2 or parts[0] == os.pardir:
+        return None
+    if not in_shard(os.sep.join(parts[1:])):
+        return None
+    (year, unused_month, unused_day) = dir2date(parts[0])
+    if year == None:
+        return None
+    ftp_dir = cfg.ftp_destination + "/" + "/".join(parts[:-1])
+    donepath = os.path.join(cfg.processed_location, relpath)
+    return (ftp_dir, filepath, donepath, parts[-1], isdir_today(parts[0]))
+
+
+class ReadinessTracker():
+    """Decides when a file in the incoming tree has been completely written
+    by the camera, so that a partly written image is never uploaded.
+    
+    A file the watcher has seen created is being written until its 
+    close-write event arrives, and files the scan finds are ready once
+    their size and mtime have stayed the same for quiet_period seconds.  A
+    file whose mtime is already that old when it's first seen is ready
+    straight away, so a backlog isn't held up.  Only the files that aren't
+    ready yet are kept in the table, so most of the tree is stat'ed only
+    once before it's queued.
+    """
+    def __init__(self, quiet_period):
+        self.lock = threading.Lock()
+        self.quiet_period = quiet_period
+        self.files = {}     # path -> [size, mtime, stable since, opened]
+        
+    def opened(self, filepath):
+        """Note that filepath has been created and is being written"""
+        with self.lock:
+            self.files[filepath] = [None, None, time.time(), True]
+            
+    def forget(self, filepath):
+        """Forget filepath, e.g., when its close-write event arrives"""
+        with self.lock:
+            self.files.pop(filepath, None)
+            
+    def ready(self, filepath):
+        """Return True if filepath has been completely written"""
+        if self.quiet_period <= 0:
+            return True
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            self.forget(filepath)
+            return False
+        now = time.time()
+        with self.lock:
+            entry = self.files.get(filepath)
+            if entry == None:
+                if now - st.st_mtime >= self.quiet_period:
+                    return True
+                self.files[filepath] = [st.st_size, st.st_mtime, now, False]
+                return False
+            if (entry[0], entry[1]) != (st.st_size, st.st_mtime):
+                entry[:3] = [st.st_size, st.st_mtime, now]
+                return False
+            if now - entry[2] < self.quiet_period:
+                return False
+            del self.files[filepath]
+            if entry[3]:
+                logging.info("%s hasn't changed for %d seconds; treating it"
+                             " as written", filepath, self.quiet_period)
+            return True
+        
+    def prune(self, max_age=3600):
+        """Forget the files that haven't been looked at for max_age seconds
+        and have gone, e.g., deleted by the camera
+        """
+        cutoff = time.time() - max_age
+        with self.lock:
+            old = [path for (path, entry) in self.files.items() 
+                   if entry[2] < cutoff]
+        for path in old:
+            if not os.path.exists(path):
+                self.forget(path)
+                
+    def count(self):
+        with self.lock:
+            return len(self.files)
+        
+
+readiness = None
+readiness_lock = threading.Lock()
+
+def get_readiness():
+    global readiness
+    with readiness_lock:
+        if readiness == None:
+            readiness = ReadinessTracker(cfg.quiet_period)
+        return readiness
+    
+def reset_readiness():
+    global readiness
+    with readiness_lock:
+        readiness = None
+
+
+class InotifyWatcher():
+    """Watch the incoming tree with Linux inotify so that new images can be
+    queued as soon as the cameras finish writing them, rather than when the
+    main loop next scans the tree.
+    
+    Every directory in the tree is watched, and directories created later
+    are added as they appear.  Files written into a new directory before
+    its watch is in place are left for the main loop's scan to find.  Files
+    that are created are reported to readiness, if given, a 
+    ReadinessTracker, so that the scan leaves them until they are closed.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0x00080000
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    event_header = struct.Struct("iIII")
+    
+    def __init__(self, top, readiness=None):
+        self.readiness = readiness
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.inotify_add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}          # watch descriptor -> directory path
+        self.add_tree(top)
+        
+    def add_tree(self, top):
+        for (dirpath, unused_dirnames, unused_filenames) in os.walk(top):
+            wd = self.inotify_add_watch(self.fd, dirpath, self.mask)
+            if wd < 0:
+                logging.warning("can't watch %s: %s", dirpath,
+                                os.strerror(ctypes.get_errno()))
+            else:
+                self.dirs[wd] = dirpath
+                
+    def read(self, timeout):
+        """Wait up to timeout seconds for files to be written.
+        :return: a list of the paths of files that have been closed after
+        writing or moved into the tree.
+        """
+        try:
+            (readable, unused_w, unused_x) = select.select([self.fd], [], [],
+                                                           timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        if not readable:
+            return []
+        
+        buf = os.read(self.fd, 65536)
+        files = []
+        offset = 0
+        while offset < len(buf):
+            (wd, mask, unused_cookie, length) = \
+                    self.event_header.unpack_from(buf, offset)
+            offset += self.event_header.size
+            name = buf[offset:offset + length].rstrip("\0")
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                logging.warning("inotify queue overflowed; "
+                                "waiting for the next scan")
+            elif mask & self.IN_IGNORED:
+                self.dirs.pop(wd, None)     # directory was removed
+            elif wd in self.dirs:
+                path = os.path.join(self.dirs[wd], name)
+                if mask & self.IN_ISDIR:
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        self.add_tree(path)
+                elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                    files.append(path)
+                elif mask & self.IN_CREATE and self.readiness != None:
+                    self.readiness.opened(path)
+        return files
+    
+    def close(self):
+        os.close(self.fd)
+        
+
+def start_watcher(top, readiness=None):
+    """Start watching top for new files.
+    :return: an InotifyWatcher, or None if inotify isn't available, in which
+    case the main loop falls back to scanning the tree periodically.
+    """
+    try:
+        return InotifyWatcher(top, readiness)
+    except (OSError, AttributeError, TypeError), e:
+        logging.warning("inotify not available (%s); polling instead", e)
+        return None
+    
+def watch_incoming(watcher, seconds):
+    """Queue new files for upload as the watcher reports them, for the
+    given number of seconds.
+    """
+    deadline = time.time() + seconds
+    executor = get_upload_executor()
+    if get_recompressor() != None:
+        executor = get_recompressor()
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        for filepath in watcher.read(remaining):
+            get_readiness().forget(filepath)    # it's been closed
+            job = upload_job(filepath)
+            if job != None and executor.submit(*job):
+                logging.debug("queued new file %s for upload", filepath)
+
+
 def dumpstacks():
     '''For debugging purposes, dump a stack trace for each running thread
     to the log'''
@@ -348,11 +3906,242 @@ def dumpstacks():
 def sighandler(signum, frame):
     dumpstacks()
 
+class QueueLogHandler(logging.Handler):
+    """Passes log records to a writer thread, which hands them on to 
+    handlers, so that a thread that logs doesn't wait for the disk or for
+    the other threads that are logging.
+    
+    The message is formatted before it's queued, since its arguments may
+    change afterwards.  If the queue is full, records below WARNING are
+    dropped and counted rather than holding up the caller.
+    """
+    def __init__(self, handlers, maxsize=10000):
+        logging.Handler.__init__(self, min(h.level for h in handlers))
+        self.handlers = handlers
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._write, name="log-writer")
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                # the traceback may be gone by the time the record is written
+                record.exc_text = logging.Formatter().formatException(
+                                                            record.exc_info)
+                record.exc_info = None
+            try:
+                self.queue.put_nowait(record)
+            except Queue.Full:
+                if record.levelno < logging.WARNING:
+                    with self.dropped_lock:
+                        self.dropped += 1
+                    metrics.inc("ftp_upload_log_records_dropped_total")
+                else:
+                    self.queue.put(record)
+        except Exception:
+            self.handleError(record)
+            
+    def _write(self):
+        while True:
+            record = self.queue.get()
+            if record == None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    try:
+                        handler.handle(record)
+                    except Exception:
+                        handler.handleError(record)
+                    
+    def close(self):
+        """Write out the records that are queued, then close the handlers"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+class ProcessLogHandler(logging.Handler):
+    """Sends the log records of an upload process to the supervisor, which
+    writes them to its own handlers, so there's one log for all the 
+    processes.
+    """
+    def __init__(self, queue, index):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.index = index
+        
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(
+                                                            record.exc_info)
+                record.exc_info = None
+            record.threadName = "%d:%s" % (self.index, record.threadName)
+            self.queue.put(("log", record))
+        except Exception:
+            self.handleError(record)
+            
+
+def run_shard(index, nshards, queue, stop):
+    """The body of an upload process: run the main loop for the camera
+    locations in shard index of nshards, sending the log and the metrics to
+    the supervisor through queue, until the shared flag stop is set.
+    """
+    global shard, shard_stop
+    shard = (index, nshards)
+    shard_stop = stop
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if platform.system() == "Linux":
+        # don't outlive the supervisor
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"))
+            libc.prctl(1, signal.SIGTERM)      # PR_SET_PDEATHSIG
+        except (OSError, AttributeError):
+            pass
+    logger = logging.getLogger()
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)   # its thread wasn't forked
+    logger.addHandler(ProcessLogHandler(queue, index))
+    set_up_logging.not_done = False
+    metrics.reset()     # the supervisor's, with every shard's in them
+    cfg.metrics_port = 0
+    cfg.metrics_snapshot_path = ''
+    
+    def report():
+        while not shard_stopping():
+            time.sleep(ShardSupervisor.report_interval)
+            queue.put(("metrics", index, metrics.export()))
+    thread = threading.Thread(target=report, name="metrics-report")
+    thread.daemon = True
+    thread.start()
+    main()
+    queue.put(("metrics", index, metrics.export()))
+    
+
+class ShardSupervisor():
+    """Runs the uploader as nshards processes, so that it isn't held to one
+    core by the GIL.  The camera locations are shared out between the
+    processes by shard_of(), and each process has its own upload threads 
+    and FTP sessions.
+    
+    The supervisor restarts a process that dies, writes the log records 
+    the processes send it, and merges their metrics, labelled with the
+    shard, for the metrics endpoint.  Purging is left to the supervisor.
+    """
+    restart_delay = 10      # minimum seconds between starts of a process
+    report_interval = 5     # seconds between metrics reports from a process
+    # metrics kept by the supervisor rather than reported by the processes
+    own_metrics = ("ftp_upload_process_restarts_total",)
+    
+    def __init__(self, nshards):
+        self.nshards = nshards
+        self.queue = multiprocessing.Queue()
+        # a flag rather than a multiprocessing.Event, which can hang
+        # set() if a process dies waiting on it
+        self.stop = multiprocessing.RawValue('b', 0)
+        self.processes = [None] * nshards
+        self.started = [0] * nshards
+        self.reader = threading.Thread(target=self._read, name="shard-reader")
+        self.reader.daemon = True
+        self.reader.start()
+        
+    def _read(self):
+        while True:
+            message = self.queue.get()
+            if message == None:
+                break
+            try:
+                if message[0] == "log":
+                    record = message[1]
+                    logging.getLogger(record.name).handle(record)
+                elif message[0] == "metrics":
+                    metrics.merge(message[2], {'shard': str(message[1])},
+                                  self.own_metrics)
+            except Exception, e:
+                logging.error("bad message from an upload process: %s", e)
+                
+    def check(self):
+        """Start the processes that aren't running, restarting any that have
+        died no more often than restart_delay
+        """
+        for index in range(self.nshards):
+            process = self.processes[index]
+            if process != None:
+                if process.is_alive():
+                    continue
+                if time.time() - self.started[index] < self.restart_delay:
+                    continue
+                process.join()
+                logging.warning("upload process %d exited with code %s; "
+                                "restarting it", index, process.exitcode)
+                metrics.inc("ftp_upload_process_restarts_total", 
+                            labels={'shard': str(index)})
+            process = multiprocessing.Process(target=run_shard, 
+                                              name="shard%d" % index,
+                                              args=(index, self.nshards,
+                                                    self.queue, self.stop))
+            process.start()
+            self.processes[index] = process
+            self.started[index] = time.time()
+            
+    def run(self, stop=None):
+        """Supervise the processes, and purge processed_location, until stop,
+        a threading.Event, is set
+        """
+        logging.info("starting %d upload processes", self.nshards)
+        start_metrics()
+        purge_thread = None
+        next_pass = 0
+        while not terminate_main_loop and not (stop and stop.is_set()):
+            self.check()
+            if time.time() >= next_pass:
+                next_pass = time.time() + cfg.rescan_interval
+                if purge_thread == None or not purge_thread.is_alive():
+                    purge_thread = threading.Thread(target=purge_and_relieve,
+                                            args=(cfg.processed_location,))
+                    purge_thread.start()
+                if cfg.metrics_port or cfg.metrics_snapshot_path:
+                    measure_backlog(cfg.incoming_location)
+            time.sleep(1)
+            
+    def shutdown(self, timeout=None):
+        """Ask the processes to stop at the end of their pass, and wait for
+        them; those still running after timeout seconds are terminated
+        """
+        if timeout == None:
+            timeout = cfg.rescan_interval + 30
+        self.stop.value = 1
+        deadline = time.time() + timeout
+        for process in self.processes:
+            if process != None:
+                process.join(max(0, deadline - time.time()))
+                if process.is_alive():
+                    logging.warning("terminating upload process %s", 
+                                    process.name)
+                    process.terminate()
+                    process.join()
+        self.queue.put(None)
+        self.reader.join()
+        stop_metrics()
+        logging.info("upload processes stopped")
+        
+
 def set_up_logging():
     if set_up_logging.not_done:
-        # get the root logger and set its level to DEBUG
+        # get the root logger and set its level to that of the most verbose
+        # handler, so that the messages nobody wants are dropped straight
+        # away
         logger = logging.getLogger()
-        logger.setLevel(logging.DEBUG)
+        logger.setLevel(min(cfg.logfile_log_level, cfg.console_log_level))
         
         # set up the rotating log file handler
         #
@@ -362,7 +4151,6 @@ def set_up_logging():
         logfile.setFormatter(logging.Formatter(
                 '%(asctime)s %(levelname)-8s %(threadName)-10s %(message)s',
                 '%m-%d %H:%M:%S'))
-        logger.addHandler(logfile)
         
         # define a Handler which writes messages equal to or greater than
         # console_log_level to the sys.stderr
@@ -372,8 +4160,14 @@ def set_up_logging():
         formatter = logging.Formatter('%(levelname)-8s %(message)s')
         # tell the handler to use this format
         console.setFormatter(formatter)
-        # add the handler to the root logger
-        logging.getLogger('').addHandler(console)
+        # add the handlers to the root logger, behind a queue if logging
+        # is to be asynchronous
+        if cfg.async_logging:
+            handler = QueueLogHandler([logfile, console])
+            logger.addHandler(handler)     # logging.shutdown() closes it
+        else:
+            logger.addHandler(logfile)
+            logger.addHandler(console)
         set_up_logging.not_done = False 
 set_up_logging.not_done = True  # logging should only be set up once, but
                                 # set_up_logging() may be called multiple times when testing
@@ -394,6 +4188,55 @@ def conf_log_level(level_str):
         }
     return d.get(level_str)
 
+def parse_location_rates(value):
+    """Parse location_rate_limits, "location:KB/s, ...", into a dict of
+    location -> bytes per second
+    """
+    rates = {}
+    for item in value.split(","):
+        if item.strip():
+            (location, rate) = item.rsplit(":", 1)
+            rates[location.strip()] = int(rate) * 1024
+    return rates
+
+def parse_rate_schedule(value):
+    """Parse rate_limit_schedule, "HH:MM-HH:MM=KB/s, ...", into a list of
+    (start, end, bytes per second), with the times in minutes since midnight
+    """
+    schedule = []
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        match = re.match(r"\s*([0-9]{1,2}):([0-9]{2})\s*-\s*"
+                         r"([0-9]{1,2}):([0-9]{2})\s*=\s*([0-9]+)\s*$", item)
+        if match == None:
+            raise ValueError("bad rate_limit_schedule entry: %s" % item)
+        (h1, m1, h2, m2, rate) = [int(g) for g in match.groups()]
+        schedule.append((h1 * 60 + m1, h2 * 60 + m2, rate * 1024))
+    return schedule
+
+def get_mirror_target(cp, sect, name):
+    """Return an UploadTarget for the mirror called name, whose config items
+    are name_ftp_server, name_ftp_port, name_ftp_username, 
+    name_ftp_password, name_ftp_destination and name_required.  Only
+    name_ftp_server is needed; the others default to the primary target's
+    values, and the mirror is required by default.
+    """
+    def item(suffix, default):
+        option = name + "_" + suffix
+        if cp.has_option(sect, option):
+            return cp.get(sect, option)
+        return default
+    
+    required = item("required", "True").lower() in ("1", "yes", "true", "on")
+    return UploadTarget(name, cp.get(sect, name + "_ftp_server"),
+                        int(item("ftp_port", cfg.ftp_port)),
+                        item("ftp_username", cfg.ftp_username),
+                        item("ftp_password", cfg.ftp_password),
+                        "/" + item("ftp_destination", 
+                                   cfg.ftp_destination.lstrip("/")),
+                        required)
+
 def get_config(confpath=None):
     global cfg
     
@@ -404,9 +4247,65 @@ def get_config(confpath=None):
     defaults = {
         'delete': 'True',
         'retain_days': '6',
+        'purge_rate_limit': '200',
+        'purge_high_water': '0',
+        'purge_low_water': '0',
+        'min_free_space': '0',
+        'min_free_inodes': '0',
+        'eviction_policy': 'none',
+        'metrics_port': '0',
+        'metrics_address': '127.0.0.1',
+        'metrics_snapshot_path': '',
+        'metrics_snapshot_interval': '60',
+        'async_logging': 'True',
+        'dedup': 'none',
+        'dedup_index_path': 'ftp_upload_dedup.db',
+        'dedup_index_size': '100000',
+        'dedup_prehash_limit': '4194304',
+        'quiet_period': '5',
+        'recompress': 'False',
+        'staging_location': '',
+        'recompress_quality': '80',
+        'recompress_max_size': '0',
+        'recompress_strip_metadata': 'True',
+        'recompress_processes': '0',
+        'bundle_backlog': 'False',
+        'bundle_max_files': '1000',
+        'bundle_max_size': '64',
+        'upload_processes': '1',
+        'adaptive_concurrency': 'False',
+        'min_upload_threads': '1',
+        'max_upload_threads': '16',
+        'concurrency_interval': '10',
         'console_log_level': 'info',
         'logfile_log_level': 'info',
-        'logfile_max_days': '10'
+        'logfile_max_days': '10',
+        'ftp_port': '21',
+        'ftp_pool_size': '8',
+        'ftp_keepalive': '60',
+        'upload_threads': '8',
+        'reserved_priority_threads': '3',
+        'backlog_max_wait': '600',
+        'use_inotify': 'False',
+        'rescan_interval': '60',
+        'journal_path': '',
+        'resume_threshold': '0',
+        'retry_base_delay': '10',
+        'retry_max_delay': '600',
+        'breaker_threshold': '5',
+        'max_file_attempts': '10',
+        'upload_batch_size': '1',
+        'batch_flush_time': '0',
+        'upload_engine': 'threads',
+        'async_connections': '64',
+        'mirror_targets': '',
+        'upload_rate_limit': '0',
+        'today_rate_limit': '0',
+        'backlog_rate_limit': '0',
+        'location_rate_limits': '',
+        'rate_limit_schedule': '',
+        'ftp_blocksize': '65536',
+        'transfer_method': 'auto',
         }
     
     # if the confpath has been supplied, use it. Otherwise,
@@ -452,14 +4351,81 @@ def get_config(confpath=None):
     cfg.incoming_location = cp.get(sect, "incoming_location")
     cfg.processed_location = cp.get(sect, "processed_location")
     cfg.ftp_server = cp.get(sect, "ftp_server")
+    cfg.ftp_port = cp.getint(sect, "ftp_port")
     cfg.ftp_username = cp.get(sect, "ftp_username")
     cfg.ftp_password = cp.get(sect, "ftp_password")
     cfg.ftp_destination = "/" + cp.get(sect, "ftp_destination")
     cfg.delete = cp.getboolean(sect, "delete")
     cfg.retain_days = cp.getint(sect, "retain_days")
+    cfg.purge_rate_limit = cp.getint(sect, "purge_rate_limit")
+    cfg.purge_high_water = cp.getfloat(sect, "purge_high_water")
+    cfg.purge_low_water = cp.getfloat(sect, "purge_low_water")
+    if cfg.purge_low_water <= 0 or cfg.purge_low_water > cfg.purge_high_water:
+        cfg.purge_low_water = cfg.purge_high_water
+    cfg.min_free_space = cp.getint(sect, "min_free_space")
+    cfg.min_free_inodes = cp.getint(sect, "min_free_inodes")
+    cfg.eviction_policy = cp.get(sect, "eviction_policy")
+    cfg.metrics_port = cp.getint(sect, "metrics_port")
+    cfg.metrics_address = cp.get(sect, "metrics_address")
+    cfg.metrics_snapshot_path = cp.get(sect, "metrics_snapshot_path")
+    cfg.metrics_snapshot_interval = cp.getint(sect, 
+                                              "metrics_snapshot_interval")
+    cfg.async_logging = cp.getboolean(sect, "async_logging")
+    cfg.dedup = cp.get(sect, "dedup")
+    cfg.dedup_index_path = cp.get(sect, "dedup_index_path")
+    cfg.dedup_index_size = cp.getint(sect, "dedup_index_size")
+    cfg.dedup_prehash_limit = cp.getint(sect, "dedup_prehash_limit")
+    cfg.quiet_period = cp.getint(sect, "quiet_period")
+    cfg.recompress = cp.getboolean(sect, "recompress")
+    cfg.staging_location = cp.get(sect, "staging_location")
+    cfg.recompress_quality = cp.getint(sect, "recompress_quality")
+    cfg.recompress_max_size = cp.getint(sect, "recompress_max_size")
+    cfg.recompress_strip_metadata = cp.getboolean(sect, 
+                                                  "recompress_strip_metadata")
+    cfg.recompress_processes = cp.getint(sect, "recompress_processes")
+    cfg.bundle_backlog = cp.getboolean(sect, "bundle_backlog")
+    cfg.bundle_max_files = cp.getint(sect, "bundle_max_files")
+    cfg.bundle_max_size = cp.getint(sect, "bundle_max_size")
+    cfg.upload_processes = cp.getint(sect, "upload_processes")
+    cfg.adaptive_concurrency = cp.getboolean(sect, "adaptive_concurrency")
+    cfg.min_upload_threads = cp.getint(sect, "min_upload_threads")
+    cfg.max_upload_threads = cp.getint(sect, "max_upload_threads")
+    cfg.concurrency_interval = cp.getint(sect, "concurrency_interval")
     cfg.console_log_level = conf_log_level(cp.get(sect, "console_log_level"))
     cfg.logfile_log_level = conf_log_level(cp.get(sect, "logfile_log_level"))
     cfg.logfile_max_days = cp.getint(sect, "logfile_max_days")
+    cfg.ftp_pool_size = cp.getint(sect, "ftp_pool_size")
+    cfg.ftp_keepalive = cp.getint(sect, "ftp_keepalive")
+    cfg.upload_threads = cp.getint(sect, "upload_threads")
+    cfg.reserved_priority_threads = cp.getint(sect, 
+                                              "reserved_priority_threads")
+    cfg.backlog_max_wait = cp.getint(sect, "backlog_max_wait")
+    cfg.use_inotify = cp.getboolean(sect, "use_inotify")
+    cfg.rescan_interval = cp.getint(sect, "rescan_interval")
+    cfg.journal_path = cp.get(sect, "journal_path")
+    cfg.resume_threshold = cp.getint(sect, "resume_threshold")
+    cfg.retry_base_delay = cp.getfloat(sect, "retry_base_delay")
+    cfg.retry_max_delay = cp.getfloat(sect, "retry_max_delay")
+    cfg.breaker_threshold = cp.getint(sect, "breaker_threshold")
+    cfg.max_file_attempts = cp.getint(sect, "max_file_attempts")
+    cfg.upload_batch_size = max(1, cp.getint(sect, "upload_batch_size"))
+    cfg.batch_flush_time = cp.getfloat(sect, "batch_flush_time")
+    cfg.upload_engine = cp.get(sect, "upload_engine")
+    cfg.async_connections = cp.getint(sect, "async_connections")
+    cfg.upload_rate_limit = cp.getint(sect, "upload_rate_limit") * 1024
+    cfg.today_rate_limit = cp.getint(sect, "today_rate_limit") * 1024
+    cfg.backlog_rate_limit = cp.getint(sect, "backlog_rate_limit") * 1024
+    cfg.location_rate_limits = parse_location_rates(
+                                    cp.get(sect, "location_rate_limits"))
+    cfg.rate_limit_schedule = parse_rate_schedule(
+                                    cp.get(sect, "rate_limit_schedule"))
+    cfg.ftp_blocksize = cp.getint(sect, "ftp_blocksize")
+    cfg.transfer_method = cp.get(sect, "transfer_method")
+    cfg.mirror_targets = []
+    for name in cp.get(sect, "mirror_targets").split(","):
+        name = name.strip()
+        if name:
+            cfg.mirror_targets.append(get_mirror_target(cp, sect, name))
     
     get_config.done = True
     return True
@@ -482,6 +4448,7 @@ uploads_to_do = False
 #
 def main():
     global uploads_to_do    # for testing only
+    global journal
     
     if not get_config():
         print >> sys.stderr, "ftp_upload: Can't open config file!"
@@ -492,6 +4459,16 @@ def main():
     signal.signal(signal.SIGINT, sighandler)    # dump thread stacks on Ctl-C
     logging.info("Program Started, version %s", version_string)
     try:
+        if cfg.upload_processes > 1 and shard == None:
+            supervisor = ShardSupervisor(cfg.upload_processes)
+            # stop the upload processes on "service ftp_upload stop"
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            try:
+                supervisor.run()
+            finally:
+                supervisor.shutdown()
+            return
+        
         mkdir(cfg.processed_location)
         # Setup the threads, don't actually run them yet used to test if the threads are alive.
         processtoday_thread = threading.Thread(target=storeday, args=())
@@ -499,6 +4476,16 @@ def main():
 
         purge_thread = threading.Thread(target=purge_old_images, args=())
 
+        if cfg.journal_path:
+            journal = UploadJournal(cfg.journal_path)
+            resume_from_journal()
+        
+        start_metrics()
+        get_recompressor()      # start its processes before they're needed
+            
+        watcher = None
+        if cfg.use_inotify:
+            watcher = start_watcher(cfg.incoming_location, get_readiness())
         
         while True:
             
@@ -528,23 +4515,58 @@ def main():
                     process_previous_days_thread.start()
 
 
-            if not purge_thread.is_alive():
-                purge_thread = threading.Thread(target=purge_old_images, 
+            if shard == None and not purge_thread.is_alive():
+                purge_thread = threading.Thread(target=purge_and_relieve, 
                                                 args=(cfg.processed_location,))
                 purge_thread.start()
                     
+            # keep the pooled FTP sessions from timing out on the server
+            get_ftp_pool().keepalive()
+            for target in cfg.mirror_targets:
+                target.get_pool().keepalive()
+            journal_prune()
+            logging.info("Remote directory cache has saved %d round trips",
+                         remote_dirs.saved)
+            log_upload_summary()
+            if cfg.metrics_port or cfg.metrics_snapshot_path:
+                measure_backlog(cfg.incoming_location)
+            get_readiness().prune()
             
-            logging.info("Sleeping 1 minute for upload")
             logging.info("Time is %s", time.ctime() )          
             try:
-                time.sleep(60) # sleep 1 minute
+                if watcher != None:
+                    # upload new files as they arrive, and rescan the whole
+                    # tree every rescan_interval to catch anything missed
+                    logging.info("Watching for new files for %d seconds",
+                                 cfg.rescan_interval)
+                    watch_incoming(watcher, cfg.rescan_interval)
+                else:
+                    logging.info("Sleeping %d seconds for upload",
+                                 cfg.rescan_interval)
+                    if shard_stop != None:
+                        deadline = time.time() + cfg.rescan_interval
+                        while time.time() < deadline and not shard_stopping():
+                            time.sleep(min(1, deadline - time.time()))
+                    else:
+                        time.sleep(cfg.rescan_interval)
                 
             # hitting Ctl-C to dump the thread stacks will interrupt
             # MainThread's sleep and raise IOError, so catch it here
             except IOError, e:
                 logging.warn("Main loop sleep interrupted")
                 
-            if terminate_main_loop:     # for testing purposes only
+            # terminate_main_loop is for testing purposes only
+            if terminate_main_loop or shard_stopping():
+                if watcher != None:
+                    watcher.close()
+                stop_recompressor()
+                stop_upload_executor()
+                close_ftp_pool()
+                stop_metrics()
+                close_dedup_index()
+                if journal != None:
+                    journal.close()
+                    journal = None
                 break
     except Exception, e:
         logging.error("Unexpected exception in main()")
@@ -0,0 +1,128 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+import unittest
+import os.path
+import threading
+import time
+from ftpserver import StandInTestCase
+
+
+class TestAsyncEngine(StandInTestCase):
+
+    extra_config = {"upload_engine": "async", "async_connections": 16,
+                    "reserved_priority_threads": 4,
+                    "retry_base_delay": 0.05, "retry_max_delay": 0.2}
+
+    def queueImages(self, day, location, count, size=None):
+        executor = self.mod.get_upload_executor()
+        paths = []
+        for i in range(count):
+            path = self.make_image(day, location, "12-00-00-%05d.jpg" % i,
+                                   size)
+            assert executor.submit(*self.mod.upload_job(path))
+            paths.append(path)
+        return paths
+
+    def waitForUploads(self, timeout):
+        executor = self.mod.get_upload_executor()
+        t = threading.Thread(target=executor.join)
+        t.daemon = True
+        t.start()
+        t.join(timeout)
+        assert not t.is_alive(), executor.scheduler.counts()
+
+    def checkUploaded(self, paths):
+        for path in paths:
+            relpath = os.path.relpath(path, self.incoming)
+            assert os.path.exists(os.path.join(self.processed, relpath))
+            with open(os.path.join(self.cloud, relpath), "rb") as f:
+                with open(os.path.join(self.processed, relpath), "rb") as g:
+                    assert f.read() == g.read()
+
+    def testOneThreadManyConnections(self):
+        executor = self.mod.get_upload_executor()
+        assert isinstance(executor, self.mod.AsyncUploadEngine)
+        self.server.latency = 0.02
+        paths = (self.queueImages("2013-07-01", "downhill", 40) +
+                 self.queueImages("2013-07-02", "uphill", 40))
+        self.waitForUploads(60)
+        self.checkUploaded(paths)
+        assert len(executor.threads) == 1
+        assert 1 < self.server.count("PASS") <= 16
+        assert self.server.count("STOR") == 80
+
+    def testLargeFiles(self):
+        paths = self.queueImages("2013-07-01", "downhill", 4, size=3000000)
+        self.waitForUploads(60)
+        self.checkUploaded(paths)
+
+    def testFailuresAreRetried(self):
+        self.server.fail_rate = 0.3
+        paths = self.queueImages("2013-07-01", "downhill", 30)
+        self.waitForUploads(60)
+        self.checkUploaded(paths)
+        assert self.server.count("STOR") > 30
+
+    def testReadErrorIsNotUploaded(self):
+        mod = self.mod
+        more = mod.FileProducer.more
+        calls = []
+        def failing_more(producer):
+            calls.append(producer)
+            if len(calls) == 2:
+                raise IOError("read error")
+            return more(producer)
+        mod.FileProducer.more = failing_more
+        try:
+            paths = self.queueImages("2013-07-01", "downhill", 1, 
+                                     size=300000)
+            self.waitForUploads(30)
+        finally:
+            mod.FileProducer.more = more
+        # the server acknowledged the short file, but it was sent again
+        assert self.server.count("STOR") == 2
+        self.checkUploaded(paths)
+
+    def testBadLoginOpensBreaker(self):
+        self.server.password = "changed"
+        paths = self.queueImages("2013-07-01", "downhill", 5)
+        executor = self.mod.get_upload_executor()
+        deadline = time.time() + 5
+        while executor.breaker.trips == 0 and time.time() < deadline:
+            time.sleep(0.05)
+        assert executor.breaker.trips > 0
+        self.server.password = self.mod.cfg.ftp_password
+        self.waitForUploads(30)
+        self.checkUploaded(paths)
+
+    def testShutdownLogsOut(self):
+        paths = self.queueImages("2013-07-01", "downhill", 5)
+        self.waitForUploads(30)
+        self.mod.stop_upload_executor()
+        self.checkUploaded(paths)
+        assert self.server.count("QUIT") == self.server.count("PASS")
+
+
+if __name__ == "__main__":
+    unittest.main()
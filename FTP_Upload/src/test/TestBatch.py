@@ -0,0 +1,118 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+import unittest
+import os.path
+import socket
+import time
+from ftpserver import StandInTestCase, days_ago
+
+
+class TestBatch(StandInTestCase):
+
+    extra_config = {"upload_threads": 1, "reserved_priority_threads": 0,
+                    "upload_batch_size": 5, "batch_flush_time": 0.2}
+
+    def queueImages(self, day, location, count):
+        executor = self.mod.get_upload_executor()
+        paths = []
+        for i in range(count):
+            path = self.make_image(day, location, "12-00-00-%05d.jpg" % i)
+            assert executor.submit(*self.mod.upload_job(path))
+            paths.append(path)
+        return paths
+
+    def testBatchesShareASession(self):
+        mod = self.mod
+        pool = mod.get_ftp_pool()
+        self.queueImages("2013-07-01", "downhill", 10)
+        mod.get_upload_executor().join()
+        for i in range(10):
+            name = "12-00-00-%05d.jpg" % i
+            assert os.path.exists(os.path.join(self.cloud, "2013-07-01",
+                                               "downhill", name))
+            assert os.path.exists(os.path.join(self.processed, "2013-07-01",
+                                               "downhill", name))
+        # two batches of five, each a single checkout of one session
+        assert pool.created == 1
+        assert pool.reused <= 2
+        assert self.server.count("STOR") == 10
+
+    def testFailureInBatchOnlyAffectsThatFile(self):
+        mod = self.mod
+        os.makedirs(os.path.join(self.cloud, "2013-07-01", "downhill",
+                                 "12-00-00-00002.jpg"))
+        jobs = [mod.upload_job(path) for path in
+                [self.make_image("2013-07-01", "downhill", "12-00-00-%05d.jpg"
+                                 % i) for i in range(4)]]
+        results = mod.storefiles(jobs)
+        assert results == [mod.UPLOAD_OK, mod.UPLOAD_OK, mod.FAIL_PERMANENT,
+                           mod.UPLOAD_OK]
+        assert os.path.exists(jobs[2][1])
+        assert os.path.exists(jobs[3][2])
+
+    def testBatchCarriesOnAfterDeadSession(self):
+        mod = self.mod
+        pool = mod.get_ftp_pool()
+        session = pool.get()
+        session.ftp.sock.shutdown(socket.SHUT_RDWR)
+        pool.put(session)
+        jobs = [mod.upload_job(path) for path in
+                [self.make_image("2013-07-01", "uphill", "12-00-00-%05d.jpg"
+                                 % i) for i in range(3)]]
+        assert mod.storefiles(jobs) == [mod.UPLOAD_OK] * 3
+        assert pool.created == 2
+
+    def testFailedBatchCountsOnceWithBreaker(self):
+        mod = self.mod
+        mod.cfg.breaker_threshold = 3
+        mod.cfg.retry_base_delay = 60
+        executor = mod.get_upload_executor()
+        batches = []
+        def store(jobs):
+            batches.append(len(jobs))
+            return [mod.FAIL_TRANSIENT] * len(jobs)
+        executor.store = store
+        self.queueImages(days_ago(1), "downhill", 5)
+        deadline = time.time() + 5
+        while executor.breaker.failures == 0 and time.time() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.1)
+        assert batches == [5]
+        # one failed session, not five failed files
+        assert executor.breaker.failures == 1
+        assert executor.breaker.allow()
+
+    def testBatchResult(self):
+        mod = self.mod
+        assert mod.batch_result([mod.UPLOAD_OK, mod.FAIL_TRANSIENT]) \
+                                                            == mod.UPLOAD_OK
+        assert mod.batch_result([mod.FAIL_TRANSIENT] * 3) \
+                                                        == mod.FAIL_TRANSIENT
+        assert mod.batch_result([mod.UPLOAD_OK, mod.FAIL_AUTH]) \
+                                                            == mod.FAIL_AUTH
+        assert mod.batch_result([mod.FAIL_PERMANENT]) == mod.FAIL_PERMANENT
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+import unittest
+import benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def testEnginesUploadEverything(self):
+        options = benchmark.parse_args(["--files", "40", "--days", "2",
+                                        "--fail-rate", "0.05"])
+        results = benchmark.run_benchmark(options)
+        assert [r['engine'] for r in results] == list(benchmark.ENGINES)
+        for r in results:
+            assert r['files'] == 40, r
+            assert r['missing'] == 0, r
+            assert r['files_per_sec'] > 0
+            assert r['p50_ms'] <= r['p99_ms']
+
+    def testCustomEngine(self):
+        engine = "pool1:ftp_pool_size=1,upload_threads=1"
+        options = benchmark.parse_args(["--files", "10", "--engine", engine])
+        (result,) = benchmark.run_benchmark(options)
+        assert result['engine'] == "pool1"
+        assert result['files'] == 10
+
+    def testFailedEngineIsReported(self):
+        engine = "broken:upload_threads=many"
+        options = benchmark.parse_args(["--files", "10", "--engine", engine])
+        self.assertRaises(RuntimeError, benchmark.run_benchmark, options)
+
+
+if __name__ == "__main__":
+    unittest.main()
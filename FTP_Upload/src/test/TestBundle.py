@@ -0,0 +1,113 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+import unittest
+import os.path
+import tarfile
+import json
+import hashlib
+import datetime
+from ftpserver import StandInTestCase
+
+
+class TestBundle(StandInTestCase):
+
+    extra_config = {"bundle_backlog": True, "bundle_max_files": 3}
+
+    def makeDay(self, day):
+        paths = []
+        for (location, n) in (("downhill", 3), ("uphill", 2)):
+            for i in range(n):
+                paths.append(self.make_image(day, location, 
+                                             "12-00-00-%05d.jpg" % i, 
+                                             size=1000 + i))
+        return paths
+
+    def testBacklogIsBundled(self):
+        paths = self.makeDay("2013-07-01")
+        contents = dict((os.path.relpath(path, self.incoming), 
+                         open(path, "rb").read()) for path in paths)
+        self.mod.storeday((os.path.join(self.incoming, "2013-07-01"), 
+                           "2013-07-01"))
+        
+        clouddir = os.path.join(self.cloud, "2013-07-01")
+        names = sorted(os.listdir(clouddir))
+        assert len(names) == 4
+        assert self.server.count("STOR") == 4
+        unpacked = {}
+        for name in names[::2]:
+            assert name.endswith(".tar")
+            assert names[names.index(name) + 1] == name + ".manifest"
+            manifest = json.load(open(os.path.join(clouddir, 
+                                                   name + ".manifest")))
+            assert manifest['archive'] == name
+            archive = tarfile.open(os.path.join(clouddir, name))
+            members = archive.getmembers()
+            assert [m.name for m in members] == [f['path'] for f 
+                                                 in manifest['files']]
+            for (member, entry) in zip(members, manifest['files']):
+                data = archive.extractfile(member).read()
+                assert entry['size'] == len(data)
+                assert entry['sha1'] == hashlib.sha1(data).hexdigest()
+                unpacked[os.path.join("2013-07-01", member.name)] = data
+        assert unpacked == contents
+        
+        # moved to processed, and the day is done with
+        for relpath in contents:
+            assert os.path.exists(os.path.join(self.processed, relpath))
+        assert not os.path.exists(os.path.join(self.incoming, "2013-07-01"))
+        assert self.mod.metrics.total("ftp_upload_bundles_total") == 2
+        assert self.mod.metrics.total("ftp_upload_files_total") == 5
+
+    def testFailedBundleIsLeft(self):
+        paths = self.makeDay("2013-07-01")
+        self.server.drop_after_bytes = 2000
+        self.server.drop_count = 1
+        self.mod.storeday((os.path.join(self.incoming, "2013-07-01"), 
+                           "2013-07-01"))
+        for path in paths:
+            assert os.path.exists(path)
+        assert self.server.count("STOR") == 1
+        assert self.mod.metrics.total("ftp_upload_failures_total") == 1
+        
+        # it's all sent next time
+        self.mod.storeday((os.path.join(self.incoming, "2013-07-01"), 
+                           "2013-07-01"))
+        assert not os.path.exists(os.path.join(self.incoming, "2013-07-01"))
+        assert len([name for name in os.listdir(os.path.join(self.cloud, 
+                                                             "2013-07-01"))
+                    if name.endswith(".manifest")]) == 2
+
+    def testTodayIsntBundled(self):
+        today = datetime.date.today().strftime("%Y-%m-%d")
+        paths = self.makeDay(today)
+        self.mod.storeday((os.path.join(self.incoming, today), today), True)
+        self.mod.get_upload_executor().join()
+        for path in paths:
+            relpath = os.path.relpath(path, self.incoming)
+            assert os.path.exists(os.path.join(self.cloud, relpath))
+        assert self.server.count("STOR") == 5
+
+
+if __name__ == "__main__":
+    unittest.main()
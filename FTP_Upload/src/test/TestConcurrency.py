@@ -0,0 +1,172 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+import unittest
+import os.path
+import time
+import threading
+import ftp_upload
+from ftpserver import StandInTestCase
+from ftp_upload import UploadScheduler, ConcurrencyController
+
+
+class TestConcurrencyController(unittest.TestCase):
+
+    def setUp(self):
+        ftp_upload.metrics.reset()
+        self.sched = UploadScheduler(nworkers=8, reserved=1, max_wait=600,
+                                     backlog_size=100)
+
+    def tearDown(self):
+        ftp_upload.metrics.reset()
+
+    def testSchedulerLimit(self):
+        sched = self.sched
+        sched.set_limit(2)
+        for i in range(4):
+            sched.put("new%d" % i, today=True)
+        assert sched.poll() == ("new0", True)
+        assert sched.poll() == ("new1", True)
+        assert sched.poll() == None
+        sched.task_done(True)
+        assert sched.poll() == ("new2", True)
+        assert sched.counts()['limit'] == 2
+
+    def testBusyHalvesLimit(self):
+        ctl = ConcurrencyController(self.sched, 1, 8, 8, interval=0)
+        ctl.record(ftp_upload.UPLOAD_OK)
+        ctl.record(ftp_upload.FAIL_BUSY)
+        assert ctl.limit == 4
+        assert self.sched.limit == 4
+        ctl.record(ftp_upload.FAIL_BUSY)
+        ctl.record(ftp_upload.FAIL_BUSY)
+        ctl.record(ftp_upload.FAIL_BUSY)
+        assert ctl.limit == 1       # never below low
+        assert ftp_upload.metrics.get("ftp_upload_concurrency_limit") == 1
+        assert ftp_upload.metrics.get("ftp_upload_concurrency_changes_total",
+                                      {'direction': "down"}) == 3
+
+    def testIncreasesWhenSaturated(self):
+        sched = self.sched
+        ctl = ConcurrencyController(sched, 1, 3, 2, interval=0)
+        for i in range(4):
+            sched.put("old%d" % i, today=False)
+        sched.poll()
+        sched.poll()
+        # both slots are busy and files are waiting
+        ftp_upload.metrics.inc("ftp_upload_bytes_total", 1000)
+        ctl.record(ftp_upload.UPLOAD_OK)
+        assert ctl.limit == 3
+        assert sched.poll() != None
+        ftp_upload.metrics.inc("ftp_upload_bytes_total", 1000000)
+        ctl.record(ftp_upload.UPLOAD_OK)
+        assert ctl.limit == 3       # never above high
+
+    def testThroughputDropUndoesIncrease(self):
+        sched = self.sched
+        ctl = ConcurrencyController(sched, 1, 8, 2, interval=0)
+        for i in range(4):
+            sched.put("old%d" % i, today=False)
+        sched.poll()
+        sched.poll()
+        ftp_upload.metrics.inc("ftp_upload_bytes_total", 1000000)
+        ctl.record(ftp_upload.UPLOAD_OK)
+        assert ctl.limit == 3
+        ctl.record(ftp_upload.UPLOAD_OK)    # nothing sent since
+        assert ctl.limit == 2
+
+    def testIdleStaysPut(self):
+        ctl = ConcurrencyController(self.sched, 1, 8, 2, interval=0)
+        ctl.record(ftp_upload.UPLOAD_OK)
+        assert ctl.limit == 2
+
+
+class TestAdaptiveUpload(StandInTestCase):
+
+    extra_config = {"adaptive_concurrency": True, "upload_threads": 6,
+                    "min_upload_threads": 1, "max_upload_threads": 6,
+                    "concurrency_interval": 0, "ftp_pool_size": 6,
+                    "retry_base_delay": 0.05, "retry_max_delay": 0.2}
+
+    def testBacksOffFromTooManyConnections(self):
+        self.server.max_connections = 2
+        executor = self.mod.get_upload_executor()
+        assert executor.controller != None
+        assert len(executor.threads) == 6
+        assert executor.controller.high == 6
+        names = ["12-00-00-%05d.jpg" % i for i in range(30)]
+        for name in names:
+            path = self.make_image("2013-07-01", "downhill", name)
+            executor.submit(*self.mod.upload_job(path))
+        t = threading.Thread(target=executor.join)
+        t.daemon = True
+        t.start()
+        t.join(60)
+        assert not t.is_alive(), executor.scheduler.counts()
+        assert self.mod.metrics.get("ftp_upload_concurrency_changes_total",
+                                    {'direction': "down"}) > 0
+        assert executor.breaker.trips == 0
+        for name in names:
+            assert os.path.exists(os.path.join(self.processed, "2013-07-01",
+                                               "downhill", name))
+
+    def testLimitBoundedByPool(self):
+        self.mod.cfg.max_upload_threads = 12
+        executor = self.mod.get_upload_executor()
+        assert executor.controller.high == 6
+        assert len(executor.threads) == 6
+
+    def testBusyProbeAfterOutage(self):
+        executor = self.mod.get_upload_executor()
+        self.server.password = "changed"
+        path = self.make_image("2013-07-01", "downhill", "12-00-00-00000.jpg")
+        executor.submit(*self.mod.upload_job(path))
+        deadline = time.time() + 10
+        while executor.breaker.trips == 0 and time.time() < deadline:
+            time.sleep(0.05)
+        assert executor.breaker.trips > 0
+        # the server comes back too busy to take the probe, then recovers
+        breaker = executor.breaker
+        busy = []
+        def probe_busy():
+            busy.append(breaker.probing)
+            ftp_upload.CircuitBreaker.busy(breaker)
+        breaker.busy = probe_busy
+        self.server.max_connections = 0
+        self.server.password = self.mod.cfg.ftp_password
+        deadline = time.time() + 10
+        while True not in busy and time.time() < deadline:
+            time.sleep(0.05)
+        assert True in busy
+        self.server.max_connections = None
+        t = threading.Thread(target=executor.join)
+        t.daemon = True
+        t.start()
+        t.join(30)
+        assert not t.is_alive(), executor.scheduler.counts()
+        assert os.path.exists(os.path.join(self.processed, "2013-07-01",
+                                           "downhill", "12-00-00-00000.jpg"))
+
+
+if __name__ == "__main__":
+    unittest.main()
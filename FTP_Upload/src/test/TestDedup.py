@@ -0,0 +1,170 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+import unittest
+import os.path
+import shutil
+import sqlite3
+from ftpserver import StandInTestCase
+
+
+class TestDedup(StandInTestCase):
+
+    extra_config = {"dedup": "copy", "resume_threshold": 100000,
+                    "dedup_prehash_limit": 200000}
+
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        self.mod.cfg.dedup_index_path = os.path.join(self.root, "dedup.db")
+
+    def upload(self, day, location, name, copy_of=None, size=None):
+        if copy_of != None:
+            path = os.path.join(self.incoming, day, location, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            shutil.copy(copy_of, path)
+        else:
+            path = self.make_image(day, location, name, size)
+        content = open(path, "rb").read()
+        assert self.mod.storefile(*self.mod.upload_job(path)) == \
+                                                        self.mod.UPLOAD_OK
+        return (path, content)
+
+    def remote(self, day, location, name):
+        return os.path.join(self.cloud, day, location, name)
+
+    def saved(self):
+        return self.mod.metrics.get("ftp_upload_dedup_bytes_saved_total",
+                                    {'target': "primary"})
+
+    def testDuplicateCopiedOnServer(self):
+        (first, content) = self.upload("2013-07-01", "downhill", "a.jpg")
+        done = os.path.join(self.processed, "2013-07-01", "downhill", "a.jpg")
+        self.server.reset_counts()
+        self.upload("2013-07-01", "uphill", "b.jpg", copy_of=done)
+        assert self.server.count("STOR") == 0
+        assert self.server.count("SITE") == 2
+        assert open(self.remote("2013-07-01", "uphill", "b.jpg"), 
+                    "rb").read() == content
+        assert os.path.exists(os.path.join(self.processed, "2013-07-01", 
+                                           "uphill", "b.jpg"))
+        assert self.saved() == len(content)
+
+    def testDuplicateSkipped(self):
+        self.mod.cfg.dedup = "skip"
+        (first, content) = self.upload("2013-07-01", "downhill", "a.jpg")
+        done = os.path.join(self.processed, "2013-07-01", "downhill", "a.jpg")
+        self.server.reset_counts()
+        self.upload("2013-07-01", "uphill", "b.jpg", copy_of=done)
+        assert self.server.count("STOR") == 0
+        assert self.server.count("SITE") == 0
+        assert not os.path.exists(self.remote("2013-07-01", "uphill", 
+                                              "b.jpg"))
+        assert self.saved() == len(content)
+
+    def testReuploadSkipped(self):
+        # e.g., after a crash between the upload and the move
+        (path, content) = self.upload("2013-07-01", "downhill", "a.jpg")
+        done = os.path.join(self.processed, "2013-07-01", "downhill", "a.jpg")
+        self.server.reset_counts()
+        self.upload("2013-07-01", "downhill", "a.jpg", copy_of=done)
+        assert self.server.count("STOR") == 0
+        assert self.server.count("SITE") == 0
+
+    def testDifferentContentSent(self):
+        self.upload("2013-07-01", "downhill", "a.jpg", size=1000)
+        self.server.reset_counts()
+        self.upload("2013-07-01", "downhill", "b.jpg", size=1000)
+        assert self.server.count("STOR") == 1
+        assert self.saved() == 0
+
+    def testNoSiteCopy(self):
+        self.server.allow_site_copy = False
+        (first, content) = self.upload("2013-07-01", "downhill", "a.jpg")
+        done = os.path.join(self.processed, "2013-07-01", "downhill", "a.jpg")
+        for name in ("b.jpg", "c.jpg"):
+            self.upload("2013-07-01", "uphill", name, copy_of=done)
+            assert open(self.remote("2013-07-01", "uphill", name), 
+                        "rb").read() == content
+        # the server only has to refuse once
+        assert self.server.count("SITE") == 1
+        assert self.server.count("STOR") == 3
+
+    def testOriginalGone(self):
+        (first, content) = self.upload("2013-07-01", "downhill", "a.jpg")
+        done = os.path.join(self.processed, "2013-07-01", "downhill", "a.jpg")
+        os.remove(self.remote("2013-07-01", "downhill", "a.jpg"))
+        self.upload("2013-07-01", "uphill", "b.jpg", copy_of=done)
+        assert open(self.remote("2013-07-01", "uphill", "b.jpg"), 
+                    "rb").read() == content
+        assert self.saved() == 0
+
+    def testLargeFilesHashedAsSent(self):
+        for method in ("read", "mmap", "sendfile"):
+            self.mod.cfg.transfer_method = method
+            name = method + ".mp4"
+            (path, content) = self.upload("2013-07-01", "downhill", name,
+                                          size=300000)
+            done = os.path.join(self.processed, "2013-07-01", "downhill", 
+                                name)
+            self.server.reset_counts()
+            # too big to hash first, so the first copy is sent
+            self.upload("2013-07-01", "uphill", name, copy_of=done)
+            assert self.server.count("STOR") == 1, method
+            self.mod.cfg.dedup_prehash_limit = 1000000
+            self.upload("2013-07-02", "uphill", name, copy_of=done)
+            assert self.server.count("STOR") == 1, method
+            self.mod.cfg.dedup_prehash_limit = 200000
+
+    def testIndexBounded(self):
+        index = self.mod.DedupIndex(os.path.join(self.root, "bounded.db"), 
+                                    10)
+        index.trim_every = 5
+        for i in range(30):
+            index.add("primary", "%040d" % i, 100, "/cloud/%d.jpg" % i)
+        assert index.count("primary") <= 15
+        assert index.lookup("primary", "%040d" % 29, 100) == "/cloud/29.jpg"
+        assert index.lookup("primary", "%040d" % 0, 100) == None
+        index.close()
+
+    def testLockedIndex(self):
+        path = os.path.join(self.root, "locked.db")
+        index = self.mod.DedupIndex(path, 10)
+        index.add("primary", "%040d" % 1, 100, "/cloud/1.jpg")
+        index.db.execute("PRAGMA busy_timeout=10")
+        # another upload process holds the lock on the shared index
+        other = sqlite3.connect(path, isolation_level=None)
+        other.execute("BEGIN EXCLUSIVE")
+        try:
+            assert index.lookup("primary", "%040d" % 1, 100) == None
+            index.add("primary", "%040d" % 2, 100, "/cloud/2.jpg")
+            index.forget("primary", "%040d" % 1)
+        finally:
+            other.execute("ROLLBACK")
+            other.close()
+        assert index.lookup("primary", "%040d" % 1, 100) == "/cloud/1.jpg"
+        index.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
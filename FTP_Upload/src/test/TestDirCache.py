@@ -0,0 +1,169 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+import unittest
+import os.path
+import shutil
+import ftplib
+from ftpserver import StandInTestCase
+import ftp_upload
+from ftp_upload import RemoteDirCache
+
+
+class TestRemoteDirCache(unittest.TestCase):
+
+    def testParentsAreKnown(self):
+        cache = RemoteDirCache()
+        cache.add("/cloud/2013-07-01/downhill")
+        assert cache.known("/cloud/2013-07-01/downhill")
+        assert cache.known("/cloud/2013-07-01")
+        assert cache.known("/cloud")
+        assert not cache.known("/cloud/2013-07-01/uphill")
+        cache.add("relative/dir")
+        assert not cache.known("relative/dir")
+
+    def testForgetTakesSubdirectories(self):
+        cache = RemoteDirCache()
+        cache.add("/cloud/2013-07-01/downhill")
+        cache.add("/cloud/2013-07-01x")
+        cache.forget("/cloud/2013-07-01")
+        assert not cache.known("/cloud/2013-07-01/downhill")
+        assert not cache.known("/cloud/2013-07-01")
+        assert cache.known("/cloud/2013-07-01x")
+        assert cache.known("/cloud")
+
+
+class RacingFTP():
+    """Stands in for an ftplib.FTP whose every MKD loses the race to
+    another session, which makes the directory first
+    """
+    def __init__(self):
+        self.dirs = set(["/cloud"])
+
+    def cwd(self, path):
+        if path not in self.dirs:
+            raise ftplib.error_perm("550 %s: No such directory" % path)
+
+    def mkd(self, path):
+        self.dirs.add(path)
+        raise ftplib.error_perm("550 %s: File exists" % path)
+
+
+class TestMakeFTPPath(unittest.TestCase):
+
+    def testLostMkdRaceIsOK(self):
+        ftp = RacingFTP()
+        ftp_upload.make_ftp_path(ftp, "/cloud/2013-07-01/downhill",
+                                 use_cache=False, dirs=RemoteDirCache())
+        assert "/cloud/2013-07-01/downhill" in ftp.dirs
+        assert ftp_upload.change_create_ftp_dir(ftp,
+                                "/cloud/2013-07-02/uphill", RemoteDirCache())
+
+
+class TestDirCache(StandInTestCase):
+
+    extra_config = {"ftp_pool_size": 2}
+
+    def ftp_dir(self, day, location):
+        return self.mod.cfg.ftp_destination + "/" + day + "/" + location
+
+    def storeImage(self, day, location, name):
+        mod = self.mod
+        filepath = self.make_image(day, location, name)
+        return mod.storefile(ftp_dir=self.ftp_dir(day, location),
+                             filepath=filepath,
+                             donepath=os.path.join(self.processed, day,
+                                                   location, name),
+                             filename=name, today=False)
+
+    def testSecondSessionDoesntProbe(self):
+        mod = self.mod
+        pool = mod.get_ftp_pool()
+        s1 = pool.get()
+        s2 = pool.get()
+        ftp_dir = self.ftp_dir("2013-07-01", "downhill")
+        assert mod.change_session_dir(s1, ftp_dir)
+        assert self.server.count("MKD") == 3
+        self.server.reset_counts()
+        # the second session goes straight to the directory, without a
+        # failed CWD or MKD, and doesn't probe the parent directories
+        assert mod.change_session_dir(s2, ftp_dir)
+        assert self.server.count("CWD") == 1
+        assert self.server.count("MKD") == 0
+        assert mod.change_session_dir(s2, ftp_dir)
+        assert self.server.count("CWD") == 1
+        assert mod.remote_dirs.saved >= 1
+        pool.put(s1)
+        pool.put(s2)
+
+    def testKnownDayRemovedFromServer(self):
+        mod = self.mod
+        pool = mod.get_ftp_pool()
+        session = pool.get()
+        assert mod.change_session_dir(session,
+                                      self.ftp_dir("2013-07-01", "downhill"))
+        # the cache still has the day directory after it's removed from the
+        # server, so creating a new location in it has to fall back to
+        # checking each level
+        shutil.rmtree(os.path.join(self.cloud, "2013-07-01"))
+        assert mod.remote_dirs.known(mod.cfg.ftp_destination + "/2013-07-01")
+        assert mod.change_session_dir(session,
+                                      self.ftp_dir("2013-07-01", "uphill"))
+        assert os.path.isdir(os.path.join(self.cloud, "2013-07-01", "uphill"))
+        pool.put(session)
+
+    def testStoredirSkipsKnownDir(self):
+        mod = self.mod
+        assert self.storeImage("2013-07-01", "downhill", "a.jpg") \
+                                                            == mod.UPLOAD_OK
+        mod.close_ftp_pool()
+        mod.remote_dirs.add(mod.cfg.ftp_destination + "/2013-07-01")
+        self.make_image("2013-07-01", "downhill", "b.jpg")
+        self.server.reset_counts()
+        mod.storedir(os.path.join(self.incoming, "2013-07-01"),
+                     mod.cfg.ftp_destination + "/2013-07-01",
+                     os.path.join(self.processed, "2013-07-01"), False)
+        mod.get_upload_executor().join()
+        # one session logged in for the file, with no directory check first
+        assert self.server.count("PASS") == 1
+        assert os.path.exists(os.path.join(self.processed, "2013-07-01",
+                                           "downhill", "b.jpg"))
+
+    def testRemovedDirIsForgotten(self):
+        mod = self.mod
+        assert self.storeImage("2013-07-01", "downhill", "a.jpg") \
+                                                            == mod.UPLOAD_OK
+        # the directory disappears from the server behind our back
+        shutil.rmtree(os.path.join(self.cloud, "2013-07-01"))
+        assert self.storeImage("2013-07-01", "downhill", "b.jpg") \
+                                                            != mod.UPLOAD_OK
+        assert not mod.remote_dirs.known(self.ftp_dir("2013-07-01",
+                                                      "downhill"))
+        assert self.storeImage("2013-07-01", "downhill", "b.jpg") \
+                                                            == mod.UPLOAD_OK
+        assert os.path.exists(os.path.join(self.cloud, "2013-07-01",
+                                           "downhill", "b.jpg"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+import unittest
+import os.path
+import datetime
+from ftpserver import StandInTestCase, days_ago
+
+
+class PendingExecutor():
+    """Stands in for the upload executor, with a fixed set of files queued"""
+    
+    def __init__(self, pending):
+        self.pending = set(pending)
+        
+    def is_pending(self, filepath):
+        return filepath in self.pending
+
+
+class TestDiskPressure(StandInTestCase):
+
+    extra_config = {"min_free_inodes": 60}
+
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        self.today = datetime.date.today().strftime("%Y-%m-%d")
+        self.days = (days_ago(3), days_ago(2), days_ago(1))
+        for day in self.days:
+            for i in range(10):
+                self.make_image(day, "downhill", "%02d.jpg" % i, 100)
+                path = os.path.join(self.processed, day, "downhill", 
+                                    "%02d.jpg" % i)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                open(path, "wb").close()
+        for i in range(10):
+            self.make_image(self.today, "downhill", "%02d.jpg" % i, 100)
+        # both trees share a file system with 100 inodes
+        self.orig_free_space = self.mod.free_space
+        self.mod.free_space = lambda path: (1 << 30, 100 - self.nfiles())
+
+    def tearDown(self):
+        self.mod.free_space = self.orig_free_space
+        StandInTestCase.tearDown(self)
+
+    def nfiles(self):
+        return sum(len(files) for root in (self.incoming, self.processed)
+                   for (unused, unused_dirs, files) in os.walk(root))
+
+    def incoming_files(self, day):
+        return sorted(os.listdir(os.path.join(self.incoming, day, 
+                                              "downhill")))
+
+    def testNoPressure(self):
+        self.mod.cfg.min_free_inodes = 30
+        assert self.mod.relieve_disk_pressure() == None
+        assert self.nfiles() == 70
+
+    def testProcessedPurgedFirst(self):
+        self.mod.cfg.min_free_inodes = 50
+        report = self.mod.relieve_disk_pressure()
+        assert report['processed_days'] == 2
+        assert report['incoming_days'] == 0
+        assert os.listdir(self.processed) == [self.days[2]]
+        assert self.nfiles() == 50
+
+    def testPolicyNone(self):
+        report = self.mod.relieve_disk_pressure()
+        assert report['processed_days'] == 3
+        assert report['incoming_days'] == 0
+        assert self.nfiles() == 40
+
+    def testPolicyDelete(self):
+        self.mod.cfg.eviction_policy = "delete"
+        self.mod.cfg.min_free_inodes = 65
+        report = self.mod.relieve_disk_pressure()
+        assert report['incoming_days'] == 1
+        assert report['files'] == 40
+        assert sorted(os.listdir(self.incoming)) == [self.days[1], 
+                                                     self.days[2], self.today]
+
+    def testPolicyThin(self):
+        self.mod.cfg.eviction_policy = "thin"
+        self.mod.cfg.min_free_inodes = 68
+        report = self.mod.relieve_disk_pressure()
+        assert report['thinned_days'] == 2
+        assert self.incoming_files(self.days[0]) == ["00.jpg", "02.jpg",
+                                    "04.jpg", "06.jpg", "08.jpg"]
+        assert len(self.incoming_files(self.days[2])) == 10
+
+    def testPendingNotEvicted(self):
+        pending = os.path.join(self.incoming, self.days[0], "downhill", 
+                               "03.jpg")
+        orig_executor = self.mod.upload_executor
+        self.mod.upload_executor = PendingExecutor([pending])
+        try:
+            self.mod.cfg.eviction_policy = "delete"
+            self.mod.cfg.min_free_inodes = 65
+            report = self.mod.relieve_disk_pressure()
+            assert report['files'] == 39
+            assert self.incoming_files(self.days[0]) == ["03.jpg"]
+            self.mod.cfg.eviction_policy = "thin"
+            self.make_image(self.days[0], "downhill", "02.jpg", 100)
+            self.mod.relieve_disk_pressure()
+            assert self.incoming_files(self.days[0]) == ["02.jpg", "03.jpg"]
+        finally:
+            self.mod.upload_executor = orig_executor
+
+    def testTodayNeverEvicted(self):
+        self.mod.cfg.eviction_policy = "delete"
+        self.mod.cfg.min_free_inodes = 100
+        self.mod.relieve_disk_pressure()
+        assert os.listdir(self.incoming) == [self.today]
+        assert len(self.incoming_files(self.today)) == 10
+
+    def testNothingDeletedWhenDeleteIsOff(self):
+        self.mod.cfg.delete = False
+        for policy in ("thin", "delete"):
+            self.mod.cfg.eviction_policy = policy
+            report = self.mod.relieve_disk_pressure()
+            assert report['processed_days'] == 0
+            assert report['incoming_days'] == 0
+            assert report['thinned_days'] == 0
+            assert report['files'] == 0
+            assert self.nfiles() == 70
+
+
+if __name__ == "__main__":
+    unittest.main()
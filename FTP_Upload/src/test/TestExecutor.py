@@ -0,0 +1,98 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+import unittest
+import os.path
+import threading
+from ftpserver import StandInTestCase
+
+
+class TestExecutor(StandInTestCase):
+
+    extra_config = {"upload_threads": 3, "upload_batch_size": 1}
+    day = "2013-07-01"
+
+    def storeday(self):
+        mod = self.mod
+        mod.storedir(os.path.join(self.incoming, self.day),
+                     mod.cfg.ftp_destination + "/" + self.day,
+                     os.path.join(self.processed, self.day), False)
+
+    def makeImages(self, count):
+        return ["%02d.jpg" % i for i in range(count)
+                if self.make_image(self.day, "downhill", "%02d.jpg" % i)]
+
+    def waitForUploads(self, timeout):
+        executor = self.mod.get_upload_executor()
+        t = threading.Thread(target=executor.join)
+        t.daemon = True
+        t.start()
+        t.join(timeout)
+        assert not t.is_alive(), executor.scheduler.counts()
+
+    def testWorkerCountIsFixed(self):
+        self.server.latency = 0.01
+        names = self.makeImages(20)
+        executor = self.mod.get_upload_executor()
+        threads = list(executor.threads)
+        assert len(threads) == 3
+        self.storeday()
+        # files are queued for the workers rather than given threads
+        uploaders = [t for t in threading.enumerate()
+                     if t.name.startswith(executor.thread_prefix)]
+        assert sorted(uploaders) == sorted(threads)
+        self.waitForUploads(30)
+        assert executor.threads == threads
+        assert [t for t in threads if t.is_alive()] == threads
+        for name in names:
+            assert os.path.exists(os.path.join(self.processed, self.day,
+                                               "downhill", name))
+
+    def testRescanDoesntQueueTwice(self):
+        self.server.latency = 0.05
+        names = self.makeImages(10)
+        self.storeday()
+        executor = self.mod.get_upload_executor()
+        path = os.path.join(self.incoming, self.day, "downhill", names[-1])
+        assert executor.is_pending(path)
+        self.storeday()     # a rescan while the files are still queued
+        self.waitForUploads(30)
+        assert self.server.count("STOR") == len(names)
+        assert not executor.is_pending(path)
+
+    def testJoinDrainsQueue(self):
+        self.makeImages(10)
+        self.storeday()
+        self.waitForUploads(30)
+        counts = self.mod.get_upload_executor().scheduler.counts()
+        for name in ('queued_today', 'queued_backlog', 'active_today',
+                     'active_backlog', 'delayed'):
+            assert counts[name] == 0
+        assert os.listdir(os.path.join(self.incoming, self.day)) in \
+                                                            ([], ["downhill"])
+        assert len(os.listdir(os.path.join(self.processed, self.day,
+                                           "downhill"))) == 10
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import unittest
+import os.path
+import sqlite3
+from ftpserver import StandInTestCase
+
+
+class TestJournal(StandInTestCase):
+
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        self.journal_path = os.path.join(self.root, "journal.db")
+        self.mod.journal = self.mod.UploadJournal(self.journal_path)
+        self.day = "2013-07-01"
+        self.loc = "downhill"
+        self.name = "12-00-00-00001.jpg"
+        self.filepath = self.make_image(self.day, self.loc, self.name)
+        self.donepath = os.path.join(self.processed, self.day, self.loc,
+                                     self.name)
+
+    def tearDown(self):
+        self.mod.journal.close()
+        self.mod.journal = None
+        StandInTestCase.tearDown(self)
+
+    def store(self):
+        self.mod.storefile(*self.mod.upload_job(self.filepath))
+
+    def state(self):
+        row = self.mod.journal.db.execute(
+                "SELECT state FROM files WHERE path=?",
+                (self.filepath,)).fetchone()
+        return row and row[0]
+
+    def testStatesAreRecorded(self):
+        journal = self.mod.journal
+        journal.record(self.filepath, journal.QUEUED)
+        assert journal.unfinished() == [self.filepath]
+        self.store()
+        assert self.state() == journal.MOVED
+        assert journal.unfinished() == []
+        assert os.path.exists(self.donepath)
+        journal.prune()
+        assert self.state() == None
+
+    def testUploadedFileIsNotResent(self):
+        # as if ftp_upload died between the STOR and the move
+        journal = self.mod.journal
+        journal.record(self.filepath, journal.UPLOADED)
+        self.store()
+        assert self.server.count("STOR") == 0
+        assert os.path.exists(self.donepath)
+        assert not os.path.exists(self.filepath)
+
+    def testChangedFileIsResent(self):
+        journal = self.mod.journal
+        journal.record(self.filepath, journal.UPLOADED)
+        with open(self.filepath, "ab") as f:
+            f.write("more")
+        self.store()
+        assert self.server.count("STOR") == 1
+        assert os.path.getsize(os.path.join(self.cloud, self.day, self.loc,
+                                            self.name)) == \
+               os.path.getsize(self.donepath)
+
+    def testResume(self):
+        journal = self.mod.journal
+        journal.record(self.filepath, journal.UPLOADING)
+        other = self.make_image(self.day, "uphill", self.name)
+        journal.record(other, journal.UPLOADED)
+        gone = os.path.join(self.incoming, self.day, "uphill", "gone.jpg")
+        journal.record(gone, journal.QUEUED)    # no such file; skipped
+
+        # reopen, as a restarted ftp_upload would
+        journal.close()
+        self.mod.journal = self.mod.UploadJournal(self.journal_path)
+        self.mod.resume_from_journal()
+        self.mod.get_upload_executor().join()
+        assert os.path.exists(self.donepath)
+        assert os.path.exists(os.path.join(self.processed, self.day, "uphill",
+                                           self.name))
+        assert self.server.count("STOR") == 1
+
+    def testLockedJournal(self):
+        # another upload process holds the lock on the shared journal
+        other = sqlite3.connect(self.journal_path, isolation_level=None)
+        other.execute("BEGIN EXCLUSIVE")
+        self.mod.journal.db.execute("PRAGMA busy_timeout=10")
+        try:
+            self.mod.journal_prune()
+            self.mod.resume_from_journal()
+            self.store()
+        finally:
+            other.execute("ROLLBACK")
+            other.close()
+        assert os.path.exists(self.donepath)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+import unittest
+import logging
+import threading
+import time
+from ftp_upload import QueueLogHandler, metrics
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self, level=logging.DEBUG):
+        logging.Handler.__init__(self, level)
+        self.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        self.lines = []
+        self.go = threading.Event()
+        self.go.set()
+
+    def emit(self, record):
+        self.go.wait()
+        self.lines.append(self.format(record))
+
+
+class TestQueueLogHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger("TestQueueLogHandler")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+
+    def testRecordsWrittenInOrder(self):
+        debug = ListHandler()
+        info = ListHandler(logging.INFO)
+        handler = QueueLogHandler([debug, info])
+        self.logger.addHandler(handler)
+        args = ["a"]
+        self.logger.debug("file %s", args)
+        args.append("b")    # formatted when logged, not when written
+        self.logger.info("done %d", 2)
+        handler.close()
+        assert debug.lines == ["DEBUG file ['a']", "INFO done 2"]
+        assert info.lines == ["INFO done 2"]
+
+    def testTracebackKept(self):
+        target = ListHandler()
+        handler = QueueLogHandler([target])
+        self.logger.addHandler(handler)
+        try:
+            raise ValueError("boom")
+        except ValueError, e:
+            self.logger.exception(e)
+        handler.close()
+        assert "Traceback" in target.lines[0]
+        assert "ValueError: boom" in target.lines[0]
+
+    def testFullQueueDropsOnlyMinorRecords(self):
+        target = ListHandler()
+        target.go.clear()  # hold up the writer
+        handler = QueueLogHandler([target], maxsize=2)
+        self.logger.addHandler(handler)
+        dropped = metrics.total("ftp_upload_log_records_dropped_total")
+        self.logger.debug("debug 0")
+        while not handler.queue.empty():   # until the writer is held up
+            time.sleep(0.01)
+        for i in range(1, 5):
+            self.logger.debug("debug %d", i)
+        t = threading.Thread(target=self.logger.warning, args=("warning",))
+        t.start()
+        t.join(0.2)
+        assert t.is_alive()     # warnings wait for room rather than drop
+        target.go.set()
+        t.join(5)
+        handler.close()
+        assert handler.dropped == 2
+        assert metrics.total("ftp_upload_log_records_dropped_total") \
+                                                            == dropped + 2
+        assert target.lines[-1] == "WARNING warning"
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+import unittest
+import os.path
+import json
+import threading
+import urllib2
+import BaseHTTPServer
+from ftpserver import StandInTestCase
+from ftp_upload import Metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.counter("files_total", "Files")
+        self.metrics.gauge("queued", "Queued")
+        self.metrics.histogram("seconds", "Seconds", (1, 5))
+
+    def testPrometheus(self):
+        m = self.metrics
+        m.inc("files_total", labels={'target': "primary"})
+        m.inc("files_total", 2, {'target': "primary"})
+        m.set("queued", 7)
+        for value in (0.5, 3, 9):
+            m.observe("seconds", value)
+        text = m.prometheus()
+        assert "# TYPE files_total counter\n" in text
+        assert 'files_total{target="primary"} 3\n' in text
+        assert "queued 7\n" in text
+        assert 'seconds_bucket{le="1"} 1\n' in text
+        assert 'seconds_bucket{le="5"} 2\n' in text
+        assert 'seconds_bucket{le="+Inf"} 3\n' in text
+        assert "seconds_sum 12.5\n" in text
+        assert "seconds_count 3\n" in text
+
+    def testSnapshot(self):
+        m = self.metrics
+        m.inc("files_total", labels={'target': "primary"})
+        m.observe("seconds", 2)
+        snap = json.loads(json.dumps(m.snapshot()))
+        files = snap['metrics']['files_total']
+        assert files['type'] == "counter"
+        assert files['values'] == [{'labels': {'target': "primary"}, 
+                                    'value': 1}]
+        assert snap['metrics']['seconds']['values'][0]['buckets'] == \
+                                                            [[1, 0], [5, 1]]
+
+    def testCollectorAndClear(self):
+        m = self.metrics
+        m.set("queued", 1, {'day': "2013-07-01"})
+        m.add_collector(lambda: m.clear("queued"))
+        assert "queued{" not in m.prometheus()
+
+
+class TestUploadMetrics(StandInTestCase):
+
+    def testUploadsCounted(self):
+        mod = self.mod
+        path = self.make_image("2013-07-01", "downhill", "a.jpg", 1000)
+        mod.storefile(*mod.upload_job(path))
+        labels = {'target': "primary"}
+        assert mod.metrics.get("ftp_upload_files_total", labels) == 1
+        assert mod.metrics.get("ftp_upload_bytes_total", labels) == 1000
+        assert 'ftp_upload_connect_seconds_count{target="primary"} 1\n' \
+                    in mod.metrics.prometheus()
+
+    def testBacklog(self):
+        mod = self.mod
+        self.make_image("2013-07-01", "downhill", "a.jpg", 1000)
+        self.make_image("2013-07-01", "uphill", "b.jpg", 500)
+        self.make_image("2013-07-02", "uphill", "c.jpg", 10)
+        mod.measure_backlog(self.incoming)
+        assert mod.metrics.get("ftp_upload_backlog_files", 
+                               {'day': "2013-07-01"}) == 2
+        assert mod.metrics.get("ftp_upload_backlog_bytes", 
+                               {'day': "2013-07-01"}) == 1500
+        assert mod.metrics.get("ftp_upload_backlog_files", 
+                               {'day': "2013-07-02"}) == 1
+
+    def testHTTPEndpoint(self):
+        mod = self.mod
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), 
+                                           mod.MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = "http://127.0.0.1:%d" % server.server_address[1]
+            text = urllib2.urlopen(url + "/metrics").read()
+            assert "# TYPE ftp_upload_files_total counter" in text
+            snap = json.loads(urllib2.urlopen(url + "/metrics.json").read())
+            assert "ftp_upload_bytes_total" in snap['metrics']
+            self.assertRaises(urllib2.HTTPError, urllib2.urlopen, url + "/")
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def testSnapshotFile(self):
+        mod = self.mod
+        mod.cfg.metrics_snapshot_path = os.path.join(self.root, 
+                                                     "metrics.json")
+        mod.start_metrics()
+        mod.stop_metrics()
+        with open(mod.cfg.metrics_snapshot_path) as f:
+            assert "ftp_upload_files_total" in json.load(f)['metrics']
+
+
+if __name__ == "__main__":
+    unittest.main()
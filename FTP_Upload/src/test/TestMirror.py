@@ -0,0 +1,128 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+import unittest
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+from ftpserver import StandInFTPServer, StandInTestCase
+
+
+class TestMirror(StandInTestCase):
+
+    backup_required = True
+
+    def setUp(self):
+        self.backup_root = tempfile.mkdtemp(prefix="ftp_upload_test")
+        os.mkdir(os.path.join(self.backup_root, "mirror"))
+        self.backup = StandInFTPServer(self.backup_root, 
+                                       password="backuppw").start()
+        self.extra_config = {
+            "retry_base_delay": 0.05, "retry_max_delay": 0.2,
+            "upload_threads": 2, "reserved_priority_threads": 1,
+            "mirror_targets": "backup",
+            "backup_ftp_server": self.backup.host,
+            "backup_ftp_port": self.backup.port,
+            "backup_ftp_password": "backuppw",
+            "backup_ftp_destination": "mirror",
+            "backup_required": self.backup_required}
+        StandInTestCase.setUp(self)
+
+    def tearDown(self):
+        StandInTestCase.tearDown(self)
+        self.backup.stop()
+        shutil.rmtree(self.backup_root, True)
+
+    def queueImages(self, count):
+        executor = self.mod.get_upload_executor()
+        paths = []
+        for i in range(count):
+            path = self.make_image("2013-07-01", "downhill",
+                                   "12-00-00-%05d.jpg" % i)
+            executor.submit(*self.mod.upload_job(path))
+            paths.append(path)
+        return paths
+
+    def waitFor(self, test, timeout=20):
+        deadline = time.time() + timeout
+        while not test() and time.time() < deadline:
+            time.sleep(0.05)
+        return test()
+
+    def onServer(self, root, dest, count):
+        return all(os.path.exists(os.path.join(root, dest, "2013-07-01",
+                                               "downhill",
+                                               "12-00-00-%05d.jpg" % i))
+                   for i in range(count))
+
+    def allProcessed(self, count):
+        return all(os.path.exists(os.path.join(self.processed, "2013-07-01",
+                                               "downhill",
+                                               "12-00-00-%05d.jpg" % i))
+                   for i in range(count))
+
+    def testFilesGoToBothServers(self):
+        self.queueImages(10)
+        self.mod.get_upload_executor().join()
+        assert self.onServer(self.root, "cloud", 10)
+        assert self.onServer(self.backup_root, "mirror", 10)
+        assert self.allProcessed(10)
+
+    def testSlowTargetDoesntHoldUpOthers(self):
+        self.backup.password = "changed"    # the backup refuses logins
+        paths = self.queueImages(10)
+        assert self.waitFor(lambda: self.onServer(self.root, "cloud", 10))
+        # the files wait for the backup before being moved
+        time.sleep(0.2)
+        assert not self.allProcessed(1)
+        for path in paths:
+            assert os.path.exists(path)
+        # a rescan doesn't send them to the primary again
+        stors = self.server.count("STOR")
+        for path in paths:
+            self.mod.get_upload_executor().submit(*self.mod.upload_job(path))
+        self.backup.password = "backuppw"
+        self.mod.get_upload_executor().join()
+        assert self.onServer(self.backup_root, "mirror", 10)
+        assert self.allProcessed(10)
+        assert self.server.count("STOR") == stors
+
+
+class TestOptionalMirror(TestMirror):
+
+    backup_required = False
+
+    def testSlowTargetDoesntHoldUpOthers(self):
+        self.backup.latency = 0.1
+        self.queueImages(10)
+        assert self.waitFor(lambda: self.allProcessed(10))
+        assert not self.onServer(self.backup_root, "mirror", 10)
+        # the backup still gets the files after they have been moved
+        self.mod.get_upload_executor().join()
+        assert self.onServer(self.backup_root, "mirror", 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
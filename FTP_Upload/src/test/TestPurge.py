@@ -0,0 +1,103 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+import unittest
+import os.path
+import time
+from ftpserver import StandInTestCase
+
+
+class TestPurge(StandInTestCase):
+
+    extra_config = {"retain_days": 2, "purge_rate_limit": 0}
+    days = ("2013-07-01", "2013-07-02", "2013-07-03", "2013-07-04")
+
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        for day in self.days:
+            for i in range(10):
+                path = os.path.join(self.processed, day, "downhill", 
+                                    "%02d.jpg" % i)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, "wb") as f:
+                    f.write("x" * 100)
+        self.orig_disk_usage = self.mod.disk_usage
+
+    def tearDown(self):
+        self.mod.disk_usage = self.orig_disk_usage
+        StandInTestCase.tearDown(self)
+
+    def remaining(self):
+        return sorted(os.listdir(self.processed))
+
+    def testDeltreeCounts(self):
+        daydir = os.path.join(self.processed, "2013-07-01")
+        assert self.mod.deltree(daydir) == (10, 1000)
+        assert not os.path.exists(daydir)
+
+    def testRetainDays(self):
+        self.mod.purge_old_images(self.processed)
+        assert self.remaining() == ["2013-07-03", "2013-07-04"]
+        assert self.mod.files_purged
+
+    def testDeleteFlag(self):
+        self.mod.cfg.delete = False
+        self.mod.purge_old_images(self.processed)
+        assert self.remaining() == list(self.days)
+
+    def testRateLimit(self):
+        self.mod.cfg.purge_rate_limit = 50
+        start = time.time()
+        self.mod.purge_old_images(self.processed)
+        # 20 files at 50 a second, less a burst of 5
+        assert time.time() - start >= 0.25
+        assert self.remaining() == ["2013-07-03", "2013-07-04"]
+
+    def testHighWater(self):
+        self.mod.cfg.retain_days = 10
+        self.mod.cfg.purge_high_water = 90
+        self.mod.cfg.purge_low_water = 80
+        # each day purged frees up 8%
+        self.mod.disk_usage = lambda path: 60 + 8 * len(self.remaining())
+        self.mod.purge_old_images(self.processed)
+        assert self.remaining() == ["2013-07-03", "2013-07-04"]
+
+    def testHighWaterKeepsNewestDay(self):
+        self.mod.cfg.retain_days = 10
+        self.mod.cfg.purge_high_water = 90
+        self.mod.cfg.purge_low_water = 80
+        self.mod.disk_usage = lambda path: 99
+        self.mod.purge_old_images(self.processed)
+        assert self.remaining() == ["2013-07-04"]
+
+    def testBelowHighWater(self):
+        self.mod.cfg.retain_days = 10
+        self.mod.cfg.purge_high_water = 90
+        self.mod.disk_usage = lambda path: 89
+        self.mod.purge_old_images(self.processed)
+        assert self.remaining() == list(self.days)
+
+
+if __name__ == "__main__":
+    unittest.main()
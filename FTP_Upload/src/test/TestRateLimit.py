@@ -0,0 +1,149 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+import unittest
+import os.path
+import datetime
+import threading
+import time
+from ftpserver import StandInTestCase
+import ftp_upload
+from ftp_upload import TokenBucket, RateLimiter
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def testRate(self):
+        bucket = TokenBucket(100000, burst=10000)
+        start = time.time()
+        for i in range(50):
+            time.sleep(bucket.take(10000))
+        elapsed = time.time() - start
+        # 500,000 bytes less the initial burst at 100,000 bytes/second
+        assert 4.5 <= elapsed < 5.5, elapsed
+
+    def testSharedByThreads(self):
+        bucket = TokenBucket(200000, burst=10000)
+        def send():
+            for i in range(20):
+                time.sleep(bucket.take(10000))
+        threads = [threading.Thread(target=send) for i in range(4)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        assert 3.6 <= elapsed < 4.5, elapsed
+
+
+class TestRateConfig(unittest.TestCase):
+
+    def testParseSchedule(self):
+        schedule = ftp_upload.parse_rate_schedule("22:00-06:30=0, 9:00-17:00 "
+                                                  "= 100")
+        assert schedule == [(22 * 60, 6 * 60 + 30, 0),
+                            (9 * 60, 17 * 60, 100 * 1024)]
+        self.assertRaises(ValueError, ftp_upload.parse_rate_schedule, "22-6")
+
+    def testParseLocations(self):
+        assert ftp_upload.parse_location_rates("downhill:200, uphill : 50") \
+                            == {"downhill": 200 * 1024, "uphill": 50 * 1024}
+
+    def testWindows(self):
+        limiter = RateLimiter(1000, 0, 500, {"downhill": 100},
+                              [(22 * 60, 6 * 60, 0), (12 * 60, 13 * 60, 2000)])
+        at = lambda h, m: datetime.datetime(2013, 7, 1, h, m)
+        assert limiter.scheduled_window(at(23, 0)) == (22 * 60, 6 * 60, 0)
+        assert limiter.scheduled_window(at(5, 59)) == (22 * 60, 6 * 60, 0)
+        assert limiter.scheduled_window(at(6, 0)) == None
+        assert limiter.scheduled_window(at(12, 30))[2] == 2000
+
+    def testLocation(self):
+        assert ftp_upload.upload_location("/cloud/2013-07-01/downhill") \
+                                                                == "downhill"
+        assert ftp_upload.upload_location("/cloud/2013-07-01/downhill/x") \
+                                                                == "downhill"
+        assert ftp_upload.upload_location("/cloud/2013-07-01") == None
+
+
+class TestRateLimit(StandInTestCase):
+
+    size = 100 * 1024
+
+    def upload(self, day, location, count, today=False):
+        executor = self.mod.get_upload_executor()
+        for i in range(count):
+            path = self.make_image(day, location, "12-00-00-%05d.jpg" % i,
+                                   self.size)
+            job = list(self.mod.upload_job(path))
+            job[4] = today
+            executor.submit(*job)
+
+    def timeUploads(self, uploads):
+        start = time.time()
+        for args in uploads:
+            self.upload(*args)
+        self.mod.get_upload_executor().join()
+        return time.time() - start
+
+    def configure(self, **limits):
+        for name, value in limits.items():
+            setattr(self.mod.cfg, name, value)
+        self.mod.reset_rate_limiter()
+
+    def testUnlimited(self):
+        assert self.mod.get_rate_limiter() == None
+        assert self.timeUploads([("2013-07-01", "downhill", 10)]) < 2
+
+    def testGlobalLimit(self):
+        self.configure(upload_rate_limit=500 * 1024)
+        # 2000 KB at 500 KB/s, spread over several threads and locations
+        elapsed = self.timeUploads([("2013-07-01", "downhill", 10),
+                                    ("2013-07-01", "uphill", 10)])
+        assert 3.5 <= elapsed < 5.5, elapsed
+
+    def testLocationLimit(self):
+        self.configure(location_rate_limits={"downhill": 250 * 1024})
+        elapsed = self.timeUploads([("2013-07-01", "downhill", 10),
+                                    ("2013-07-01", "uphill", 10)])
+        assert 3.5 <= elapsed < 5.5, elapsed
+
+    def testBacklogBudget(self):
+        self.configure(backlog_rate_limit=250 * 1024)
+        elapsed = self.timeUploads([("2013-07-01", "downhill", 5)])
+        assert 1.5 <= elapsed < 3, elapsed
+        # today's uploads aren't held back by the backlog's budget
+        elapsed = self.timeUploads([("2013-07-02", "downhill", 10, True)])
+        assert elapsed < 1.5, elapsed
+
+    def testScheduleLiftsLimit(self):
+        now = datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        self.configure(upload_rate_limit=100 * 1024,
+                       rate_limit_schedule=[(minute, (minute + 2) % 1440, 0)])
+        assert self.timeUploads([("2013-07-01", "downhill", 10)]) < 2
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,161 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+import unittest
+import os.path
+import time
+import platform
+import tempfile
+import shutil
+from ftp_upload import ReadinessTracker
+from ftpserver import StandInTestCase
+
+
+class TestReadinessTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="ftp_upload_test")
+        self.path = os.path.join(self.root, "a.jpg")
+        with open(self.path, "wb") as f:
+            f.write("x" * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, True)
+
+    def testOldFileIsReady(self):
+        past = time.time() - 60
+        os.utime(self.path, (past, past))
+        tracker = ReadinessTracker(5)
+        assert tracker.ready(self.path)
+        assert tracker.count() == 0
+
+    def testNewFileWaitsForQuietPeriod(self):
+        tracker = ReadinessTracker(0.3)
+        assert not tracker.ready(self.path)
+        assert tracker.count() == 1
+        time.sleep(0.4)
+        assert tracker.ready(self.path)
+        assert tracker.count() == 0
+
+    def testGrowingFileIsntReady(self):
+        tracker = ReadinessTracker(0.3)
+        assert not tracker.ready(self.path)
+        for i in range(3):
+            time.sleep(0.2)
+            with open(self.path, "ab") as f:
+                f.write("x" * 100)
+            assert not tracker.ready(self.path)
+        time.sleep(0.4)
+        assert tracker.ready(self.path)
+
+    def testOpenedFileWaitsEvenIfOld(self):
+        past = time.time() - 60
+        os.utime(self.path, (past, past))
+        tracker = ReadinessTracker(0.3)
+        tracker.opened(self.path)
+        assert not tracker.ready(self.path)
+        tracker.forget(self.path)       # closed
+        assert tracker.ready(self.path)
+
+    def testOpenedFileIsReadyWhenStable(self):
+        # in case the close event is lost
+        tracker = ReadinessTracker(0.3)
+        tracker.opened(self.path)
+        assert not tracker.ready(self.path)
+        time.sleep(0.4)
+        assert tracker.ready(self.path)
+
+    def testMissingFileIsForgotten(self):
+        tracker = ReadinessTracker(5)
+        assert not tracker.ready(self.path)
+        os.remove(self.path)
+        assert not tracker.ready(self.path)
+        assert tracker.count() == 0
+
+    def testPrune(self):
+        tracker = ReadinessTracker(5)
+        assert not tracker.ready(self.path)
+        tracker.prune(0)
+        assert tracker.count() == 1     # still there
+        os.remove(self.path)
+        tracker.prune(0)
+        assert tracker.count() == 0
+
+    def testZeroQuietPeriod(self):
+        tracker = ReadinessTracker(0)
+        tracker.opened(self.path)
+        assert tracker.ready(self.path)
+
+
+class TestReadinessStage(StandInTestCase):
+
+    extra_config = {"quiet_period": 1}
+
+    def testStoredirSkipsFilesBeingWritten(self):
+        mod = self.mod
+        daydir = os.path.join(self.incoming, "2013-07-01")
+        old = self.make_image("2013-07-01", "downhill", "12-00-00-00001.jpg")
+        past = time.time() - 60
+        os.utime(old, (past, past))
+        new = self.make_image("2013-07-01", "downhill", "12-00-00-00002.jpg")
+        mod.storedir(daydir, "/cloud/2013-07-01",
+                     os.path.join(self.processed, "2013-07-01"), False)
+        mod.get_upload_executor().join()
+        cloud = os.path.join(self.cloud, "2013-07-01", "downhill")
+        assert os.listdir(cloud) == ["12-00-00-00001.jpg"]
+        assert os.path.exists(new)
+        assert mod.get_readiness().count() == 1
+
+        time.sleep(1.1)
+        mod.storedir(daydir, "/cloud/2013-07-01",
+                     os.path.join(self.processed, "2013-07-01"), False)
+        mod.get_upload_executor().join()
+        assert sorted(os.listdir(cloud)) == ["12-00-00-00001.jpg",
+                                             "12-00-00-00002.jpg"]
+        assert mod.get_readiness().count() == 0
+
+    @unittest.skipUnless(platform.system() == "Linux", "inotify is Linux only")
+    def testWatcherTracksOpenFiles(self):
+        mod = self.mod
+        dirpath = os.path.join(self.incoming, "2013-07-01", "downhill")
+        os.makedirs(dirpath)
+        watcher = mod.start_watcher(self.incoming, mod.get_readiness())
+        try:
+            watcher.read(0.1)
+            path = os.path.join(dirpath, "12-00-00-00001.jpg")
+            f = open(path, "wb")
+            f.write("x" * 100)
+            f.flush()
+            assert watcher.read(0.5) == []
+            past = time.time() - 60
+            os.utime(path, (past, past))
+            # it looks old, but it's still open
+            assert not mod.get_readiness().ready(path)
+            f.close()
+            assert watcher.read(1) == [path]
+        finally:
+            watcher.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+import unittest
+import os.path
+import ftp_upload
+from ftpserver import StandInTestCase
+
+
+def shrink(filepath, stagedpath, quality, max_size, strip):
+    """Stands in for recompress_image() in the worker processes"""
+    try:
+        os.makedirs(os.path.dirname(stagedpath))
+    except OSError:
+        pass    # the other worker made it
+    with open(stagedpath, "wb") as f:
+        f.write("small")
+    return (os.path.getsize(filepath), 5, 0.25, None)
+
+def fail(filepath, stagedpath, quality, max_size, strip):
+    return (os.path.getsize(filepath), None, 0.25, "not an image")
+
+
+class TestRecompress(StandInTestCase):
+
+    extra_config = {"recompress": True}
+
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        self.staging = os.path.join(self.root, "staging")
+        self.mod.cfg.staging_location = self.staging
+        self.orig_image = self.mod.Image
+
+    def tearDown(self):
+        self.mod.Image = self.orig_image
+        StandInTestCase.tearDown(self)
+
+    def upload(self, convert):
+        mod = self.mod
+        mod.recompressor = mod.Recompressor(2, 80, 0, True, convert)
+        mod.storedir(os.path.join(self.incoming, "2013-07-01"),
+                     "/cloud/2013-07-01",
+                     os.path.join(self.processed, "2013-07-01"), False)
+        mod.stop_recompressor()
+        mod.get_upload_executor().join()
+
+    def testStagedCopyIsSent(self):
+        self.make_image("2013-07-01", "downhill", "a.jpg", size=1000)
+        self.make_image("2013-07-01", "downhill", "b.jpg", size=1000)
+        self.upload(shrink)
+        for name in ("a.jpg", "b.jpg"):
+            cloud = os.path.join(self.cloud, "2013-07-01", "downhill", name)
+            assert open(cloud, "rb").read() == "small"
+            # the original is kept
+            done = os.path.join(self.processed, "2013-07-01", "downhill", name)
+            assert os.path.getsize(done) == 1000
+        assert os.listdir(self.staging) == []
+        metrics = self.mod.metrics
+        assert metrics.total("ftp_upload_recompress_files_total") == 2
+        assert metrics.total("ftp_upload_recompress_bytes_saved_total") \
+                                                                == 2 * 995
+        assert metrics.total("ftp_upload_recompress_cpu_seconds_total") == 0.5
+        assert metrics.total("ftp_upload_bytes_total") == 10
+
+    def testAgeIsTheOriginals(self):
+        path = self.make_image("2013-07-01", "downhill", "a.jpg", size=1000)
+        written = os.path.getmtime(path) - 3600
+        os.utime(path, (written, written))
+        self.upload(shrink)
+        # the age is from when the camera wrote the image, not from when
+        # the staged copy was made
+        (unused_buckets, total, count) = self.mod.metrics.get(
+                            "ftp_upload_age_seconds", {'target': "primary"})
+        assert count == 1
+        assert total >= 3600
+
+    def testOriginalIsSentIfRecompressionFails(self):
+        self.make_image("2013-07-01", "downhill", "a.jpg", size=1000)
+        self.upload(fail)
+        cloud = os.path.join(self.cloud, "2013-07-01", "downhill", "a.jpg")
+        assert os.path.getsize(cloud) == 1000
+        assert self.mod.metrics.total(
+                                "ftp_upload_recompress_failures_total") == 1
+
+    def testStagedCopyFromEarlierRun(self):
+        path = self.make_image("2013-07-01", "downhill", "a.jpg", size=1000)
+        stagedpath = self.mod.staged_path(path)
+        assert stagedpath == os.path.join(self.staging, "2013-07-01", 
+                                          "downhill", "a.jpg")
+        shrink(path, stagedpath, 80, 0, True)
+        self.upload(fail)   # isn't run
+        cloud = os.path.join(self.cloud, "2013-07-01", "downhill", "a.jpg")
+        assert open(cloud, "rb").read() == "small"
+        assert self.mod.metrics.total(
+                                "ftp_upload_recompress_failures_total") == 0
+
+    def testNeedsPIL(self):
+        self.mod.Image = None
+        assert self.mod.get_recompressor() == None
+        assert not self.mod.cfg.recompress
+
+    @unittest.skipIf(ftp_upload.Image == None, "PIL isn't installed")
+    def testRecompressImage(self):
+        path = self.make_image("2013-07-01", "downhill", "a.jpg")
+        stagedpath = os.path.join(self.staging, "a.jpg")
+        (size, staged_size, unused_cpu, error) = self.mod.recompress_image(
+                                            path, stagedpath, 30, 320, True)
+        assert error == None
+        assert size == os.path.getsize(path)
+        assert staged_size == os.path.getsize(stagedpath) < size
+        image = self.mod.Image.open(stagedpath)
+        assert max(image.size) <= 320
+        assert "exif" not in image.info
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import unittest
+import os.path
+from ftpserver import StandInTestCase
+
+
+class TestResume(StandInTestCase):
+
+    extra_config = {"resume_threshold": 100000}
+    size = 400000
+
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        self.filepath = self.make_image("2013-07-01", "downhill", "clip.mp4",
+                                        self.size)
+        self.content = open(self.filepath, "rb").read()
+        self.remote = os.path.join(self.cloud, "2013-07-01", "downhill",
+                                   "clip.mp4")
+
+    def store(self):
+        self.mod.storefile(*self.mod.upload_job(self.filepath))
+
+    def checkUploaded(self):
+        assert open(self.remote, "rb").read() == self.content
+        assert os.path.exists(os.path.join(self.processed, "2013-07-01",
+                                           "downhill", "clip.mp4"))
+
+    def testResumeAfterDrop(self):
+        self.server.drop_after_bytes = 150000
+        self.server.drop_count = 1
+        self.store()
+        self.checkUploaded()
+        assert self.server.count("REST") == 1
+        # only the part that didn't make it the first time was sent again
+        assert self.server.bytes_received == self.size
+
+    def testAppendWhenRestRefused(self):
+        self.server.drop_after_bytes = 150000
+        self.server.drop_count = 1
+        self.server.allow_rest = False
+        self.store()
+        self.checkUploaded()
+        assert self.server.count("APPE") == 1
+        assert self.server.bytes_received == self.size
+
+    def testCompleteFileNotResent(self):
+        os.makedirs(os.path.dirname(self.remote))
+        with open(self.remote, "wb") as f:
+            f.write(self.content)
+        self.store()
+        self.checkUploaded()
+        assert self.server.count("STOR") == 0
+
+    def testSmallFilesAreNotResumed(self):
+        small = self.make_image("2013-07-01", "downhill", "small.jpg", 1000)
+        self.mod.storefile(*self.mod.upload_job(small))
+        assert self.server.count("SIZE") == 0
+        assert self.server.count("STOR") == 1
+
+
+if __name__ == "__main__":
+    unittest.main()
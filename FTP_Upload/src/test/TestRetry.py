@@ -0,0 +1,185 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+import unittest
+import os.path
+import time
+import socket
+import threading
+import ftplib
+from ftpserver import StandInTestCase
+import ftp_upload
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def testDelayGrowsAndIsCapped(self):
+        policy = ftp_upload.RetryPolicy(base=1, cap=10)
+        for attempt, full in ((1, 1), (2, 2), (3, 4), (4, 8), (5, 10),
+                              (20, 10)):
+            for i in range(20):
+                delay = policy.delay(attempt)
+                assert full / 2.0 <= delay <= full
+
+    def testClassifyFailure(self):
+        classify = ftp_upload.classify_failure
+        assert classify(ftplib.error_perm("530 Login incorrect")) \
+                                                    == ftp_upload.FAIL_AUTH
+        assert classify(ftplib.error_perm("550 Permission denied")) \
+                                                    == ftp_upload.FAIL_PERMANENT
+        assert classify(ftplib.error_temp("451 Aborted")) \
+                                                    == ftp_upload.FAIL_TRANSIENT
+        assert classify(ftplib.error_temp("421 Too many connections")) \
+                                                    == ftp_upload.FAIL_BUSY
+        assert classify(socket.error(111, "Connection refused")) \
+                                                    == ftp_upload.FAIL_TRANSIENT
+        assert classify(EOFError()) == ftp_upload.FAIL_TRANSIENT
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = ftp_upload.CircuitBreaker(3,
+                                        ftp_upload.RetryPolicy(0.2, 0.2))
+
+    def testOpensAfterThreshold(self):
+        breaker = self.breaker
+        for i in range(2):
+            breaker.failure(ftp_upload.FAIL_TRANSIENT)
+            assert breaker.allow()
+        breaker.failure(ftp_upload.FAIL_TRANSIENT)
+        assert not breaker.allow()
+        assert 0 < breaker.remaining() <= 0.2
+
+    def testLoginFailureOpensAtOnce(self):
+        self.breaker.failure(ftp_upload.FAIL_AUTH)
+        assert not self.breaker.allow()
+
+    def testSuccessResetsCount(self):
+        breaker = self.breaker
+        breaker.failure(ftp_upload.FAIL_TRANSIENT)
+        breaker.failure(ftp_upload.FAIL_TRANSIENT)
+        breaker.success()
+        breaker.failure(ftp_upload.FAIL_TRANSIENT)
+        assert breaker.allow()
+
+    def testHalfOpenAllowsOneProbe(self):
+        breaker = self.breaker
+        breaker.failure(ftp_upload.FAIL_AUTH)
+        time.sleep(0.25)
+        assert breaker.allow()          # the probe
+        assert not breaker.allow()      # everyone else waits for it
+        breaker.success()
+        assert breaker.allow()
+        assert breaker.allow()
+
+    def testBusyProbeLetsAnotherThrough(self):
+        breaker = self.breaker
+        breaker.failure(ftp_upload.FAIL_AUTH)
+        time.sleep(0.25)
+        assert breaker.allow()
+        breaker.busy()
+        assert breaker.allow()          # another probe, not stuck
+        assert not breaker.allow()
+
+
+class TestRetry(StandInTestCase):
+
+    extra_config = {"retry_base_delay": 0.05, "retry_max_delay": 0.2,
+                    "max_file_attempts": 3}
+
+    def upload(self, count):
+        executor = self.mod.get_upload_executor()
+        paths = []
+        for i in range(count):
+            name = "12-00-00-%05d.jpg" % i
+            path = self.make_image("2013-07-01", "downhill", name)
+            executor.submit(*self.mod.upload_job(path))
+            paths.append(path)
+        return paths
+
+    def waitForUploads(self, timeout):
+        executor = self.mod.get_upload_executor()
+        t = threading.Thread(target=executor.join)
+        t.daemon = True
+        t.start()
+        t.join(timeout)
+        assert not t.is_alive(), executor.scheduler.counts()
+
+    def donepath(self, name):
+        return os.path.join(self.processed, "2013-07-01", "downhill", name)
+
+    def testTransientFailuresAreRetried(self):
+        self.server.fail_rate = 0.5
+        self.upload(20)
+        self.waitForUploads(30)
+        assert self.server.count("STOR") > 20
+        for i in range(20):
+            assert os.path.exists(self.donepath("12-00-00-%05d.jpg" % i))
+
+    def testBadLoginPausesUploads(self):
+        self.server.password = "changed"
+        self.upload(5)
+        time.sleep(0.5)
+        breaker = self.mod.get_upload_executor().breaker
+        assert breaker.trips > 0
+        # only the probes try to log in while the breaker is open, not
+        # every file in every worker
+        assert self.server.count("PASS") < 5 * breaker.trips + 5
+        assert not os.path.exists(self.donepath("12-00-00-00000.jpg"))
+        self.server.password = self.mod.cfg.ftp_password
+        self.waitForUploads(30)
+        for i in range(5):
+            assert os.path.exists(self.donepath("12-00-00-%05d.jpg" % i))
+
+    def testRefusedFileIsGivenUp(self):
+        os.makedirs(os.path.join(self.cloud, "2013-07-01", "downhill",
+                                 "12-00-00-00000.jpg"))
+        paths = self.upload(2)
+        self.waitForUploads(30)
+        executor = self.mod.get_upload_executor()
+        assert paths[0] in executor.given_up
+        assert not executor.is_pending(paths[0])
+        assert os.path.exists(paths[0])
+        assert os.path.exists(self.donepath("12-00-00-00001.jpg"))
+        # not queued again by the next scan unless it changes
+        assert not executor.submit(*self.mod.upload_job(paths[0]))
+        os.utime(paths[0], (0, 0))
+        assert executor.submit(*self.mod.upload_job(paths[0]))
+
+    def testVanishedFileIsDropped(self):
+        executor = self.mod.get_upload_executor()
+        executor.max_attempts = 100     # not just given up in the end
+        self.server.password = "changed"
+        paths = self.upload(1)
+        time.sleep(0.2)
+        os.remove(paths[0])
+        self.server.password = self.mod.cfg.ftp_password
+        self.waitForUploads(5)
+        assert not executor.is_pending(paths[0])
+        assert paths[0] not in executor.given_up
+        assert self.server.count("STOR") == 0
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,192 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import unittest
+import threading
+import random
+import time
+from ftp_upload import UploadScheduler
+
+
+class TestScheduler(unittest.TestCase):
+
+    def testTodayGoesFirst(self):
+        sched = UploadScheduler(nworkers=4, reserved=1, max_wait=600,
+                                backlog_size=100)
+        for i in range(3):
+            sched.put("old%d" % i, today=False)
+        for i in range(3):
+            sched.put("new%d" % i, today=True)
+        order = []
+        for i in range(6):
+            job, today = sched.get()
+            order.append(job)
+            sched.task_done(today)
+        assert order == ["new0", "new1", "new2", "old0", "old1", "old2"]
+
+    def testBacklogLeavesReservedWorkersFree(self):
+        sched = UploadScheduler(nworkers=4, reserved=3, max_wait=600,
+                                backlog_size=100)
+        sched.put("old0", today=False)
+        sched.put("old1", today=False)
+        assert sched.get() == ("old0", False)
+        # the one unreserved slot is busy, so old1 has to wait even though
+        # there are idle workers, but today's files still get through
+        got = []
+        t = threading.Thread(target=lambda: got.append(sched.get()))
+        t.daemon = True
+        t.start()
+        t.join(0.2)
+        assert t.is_alive()
+        sched.put("new0", today=True)
+        t.join(5)
+        assert got == [("new0", True)]
+        sched.task_done(False)
+        assert sched.get() == ("old1", False)
+
+    def testAgedBacklogGoesBeforeToday(self):
+        sched = UploadScheduler(nworkers=4, reserved=1, max_wait=0.1,
+                                backlog_size=100)
+        sched.put("old0", today=False)
+        time.sleep(0.2)
+        sched.put("new0", today=True)
+        assert sched.get() == ("old0", False)
+        assert sched.get() == ("new0", True)
+        assert sched.counts()['aged'] == 1
+
+    def testRetriedBacklogKeepsItsAge(self):
+        sched = UploadScheduler(nworkers=4, reserved=1, max_wait=60,
+                                backlog_size=100)
+        first = time.time() - 100
+        sched.put("old1", today=False)
+        sched.put("new0", today=True)
+        # old0 was first queued long ago and failed; its retry is due now
+        sched.put_later("old0", False, 0, queued=first)
+        assert sched.get() == ("old0", False)   # aged, and ahead of old1
+        assert sched.get() == ("new0", True)
+        assert sched.get() == ("old1", False)
+
+    def testBacklogPutBlocksWhenFull(self):
+        sched = UploadScheduler(nworkers=2, reserved=1, max_wait=600,
+                                backlog_size=2)
+        sched.put("old0", today=False)
+        sched.put("old1", today=False)
+        t = threading.Thread(target=sched.put, args=("old2", False))
+        t.daemon = True
+        t.start()
+        t.join(0.2)
+        assert t.is_alive()
+        sched.put("new0", today=True)   # today's files never block
+        assert sched.get() == ("new0", True)
+        assert sched.get() == ("old0", False)
+        t.join(5)
+        assert not t.is_alive()
+
+    def testBatchTakesSameKey(self):
+        sched = UploadScheduler(nworkers=4, reserved=1, max_wait=600,
+                                backlog_size=100)
+        for job in ("a/1", "b/1", "a/2", "a/3", "b/2", "a/4"):
+            sched.put(job, today=False)
+        key = lambda job: job.split("/")[0]
+        assert sched.get_batch(3, key, 0) == (["a/1", "a/2", "a/3"], False)
+        assert sched.get_batch(3, key, 0) == (["b/1", "b/2"], False)
+        assert sched.get_batch(3, key, 0) == (["a/4"], False)
+        assert sched.counts()['active_backlog'] == 3
+
+    def testBacklogBatchWaitsToFill(self):
+        sched = UploadScheduler(nworkers=4, reserved=1, max_wait=600,
+                                backlog_size=100)
+        key = lambda job: job.split("/")[0]
+        sched.put("a/1", today=False)
+        t = threading.Timer(0.1, sched.put, args=("a/2", False))
+        t.start()
+        start = time.time()
+        assert sched.get_batch(3, key, 0.5) == (["a/1", "a/2"], False)
+        assert time.time() - start >= 0.4   # waited for a third
+        t.join()
+
+    def testTodayBatchDoesntWait(self):
+        sched = UploadScheduler(nworkers=4, reserved=1, max_wait=600,
+                                backlog_size=100)
+        key = lambda job: job.split("/")[0]
+        sched.put("a/1", today=True)
+        sched.put("a/2", today=False)   # not mixed in with today's
+        start = time.time()
+        assert sched.get_batch(3, key, 5) == (["a/1"], True)
+        assert time.time() - start < 1
+
+    def testHammer(self):
+        """Many producers and consumers; check that every job is run exactly
+        once, the backlog limit is never exceeded and the counts end at zero.
+        """
+        nworkers = 16
+        reserved = 5
+        nproducers = 8
+        per_producer = 500
+        sched = UploadScheduler(nworkers, reserved, max_wait=0.01,
+                                backlog_size=20)
+        seen = []
+        seen_lock = threading.Lock()
+        errors = []
+
+        def produce(p):
+            for i in range(per_producer):
+                sched.put((p, i), today=random.random() < 0.3)
+
+        def consume():
+            while True:
+                task = sched.get()
+                if task == None:
+                    return
+                job, today = task
+                counts = sched.counts()
+                if counts['active_backlog'] > nworkers - reserved:
+                    errors.append(counts)
+                with seen_lock:
+                    seen.append(job)
+                if random.random() < 0.1:
+                    time.sleep(0.001)
+                sched.task_done(today)
+
+        consumers = [threading.Thread(target=consume) for i in range(nworkers)]
+        producers = [threading.Thread(target=produce, args=(p,))
+                     for p in range(nproducers)]
+        for t in consumers + producers:
+            t.start()
+        for t in producers:
+            t.join()
+        sched.join()
+        sched.close()
+        for t in consumers:
+            t.join()
+
+        assert errors == []
+        assert len(seen) == nproducers * per_producer
+        assert len(set(seen)) == nproducers * per_producer
+        counts = sched.counts()
+        for name in ('queued_today', 'queued_backlog', 'active_today',
+                     'active_backlog'):
+            assert counts[name] == 0
+
+
+if __name__ == "__main__":
+    unittest.main()
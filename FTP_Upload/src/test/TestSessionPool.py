@@ -0,0 +1,118 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import unittest
+import os.path
+import threading
+import socket
+import time
+from ftpserver import StandInTestCase
+
+
+class TestSessionPool(StandInTestCase):
+
+    extra_config = {"ftp_pool_size": 2}
+
+    def storeImages(self, day, location, count):
+        mod = self.mod
+        for i in range(count):
+            name = "12-00-00-%05d.jpg" % i
+            filepath = self.make_image(day, location, name)
+            mod.storefile(ftp_dir=mod.cfg.ftp_destination+"/"+day+"/"+location,
+                          filepath=filepath,
+                          donepath=os.path.join(self.processed, day, location, name),
+                          filename=name, today=False)
+
+    def testSessionsAreReused(self):
+        os.mkdir(os.path.join(self.cloud, "2013-07-01"))
+        self.storeImages("2013-07-01", "downhill", 5)
+        pool = self.mod.get_ftp_pool()
+        assert pool.created == 1
+        assert pool.reused == 4
+        assert self.server.count("PASS") == 1
+        # one CWD at login, then a failed CWD, MKD and CWD for the first
+        # file; the session stays in the image directory after that
+        assert self.server.count("CWD") == 3
+        assert self.server.count("MKD") == 1
+        for i in range(5):
+            name = "12-00-00-%05d.jpg" % i
+            assert os.path.exists(os.path.join(self.cloud, "2013-07-01",
+                                               "downhill", name))
+            assert os.path.exists(os.path.join(self.processed, "2013-07-01",
+                                               "downhill", name))
+
+    def testPoolIsBounded(self):
+        pool = self.mod.get_ftp_pool()
+        s1 = pool.get()
+        s2 = pool.get()
+        got = []
+        t = threading.Thread(target=lambda: got.append(pool.get()))
+        t.start()
+        t.join(0.5)
+        assert t.is_alive()     # blocked; both sessions are checked out
+        pool.put(s1)
+        t.join(5)
+        assert not t.is_alive()
+        assert got[0] is s1
+        pool.put(s2)
+        pool.put(got[0])
+        assert self.server.count("PASS") == 2
+
+    def testDeadSessionIsReplaced(self):
+        pool = self.mod.get_ftp_pool()
+        session = pool.get()
+        session.ftp.sock.shutdown(socket.SHUT_RDWR)
+        pool.put(session)
+        session.last_used = 0   # force a NOOP probe on the next get()
+        start = time.time()
+        fresh = pool.get()
+        assert fresh is not session
+        assert pool.discarded == 1
+        assert pool.created == 2
+        assert time.time() - start < 10
+        pool.put(fresh)
+
+    def testStoreRetriesOnFreshSession(self):
+        os.mkdir(os.path.join(self.cloud, "2013-07-01"))
+        self.storeImages("2013-07-01", "uphill", 1)
+        # kill the pooled session's connection without the pool noticing
+        pool = self.mod.get_ftp_pool()
+        session = pool.get()
+        session.ftp.sock.shutdown(socket.SHUT_RDWR)
+        pool.put(session)
+        self.storeImages("2013-07-01", "uphill", 2)
+        assert pool.created == 2
+        assert os.path.exists(os.path.join(self.processed, "2013-07-01",
+                                           "uphill", "12-00-00-00001.jpg"))
+
+    def testKeepalive(self):
+        pool = self.mod.get_ftp_pool()
+        session = pool.get()
+        pool.put(session)
+        session.last_used = 0
+        pool.keepalive()
+        assert self.server.count("NOOP") == 1
+        assert pool.get() is session
+
+
+if __name__ == "__main__":
+    unittest.main()
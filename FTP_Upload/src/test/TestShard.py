@@ -0,0 +1,140 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+import unittest
+import os.path
+import signal
+import threading
+import time
+import datetime
+from ftp_upload import Metrics, ShardSupervisor, shard_of
+from ftpserver import StandInTestCase, days_ago
+
+
+class TestShardOf(unittest.TestCase):
+
+    def testLocationsAreSharedOut(self):
+        locations = ["location%d" % n for n in range(100)]
+        counts = [0] * 4
+        for location in locations:
+            n = shard_of(location, 4)
+            assert n == shard_of(location, 4)
+            counts[n] += 1
+        assert min(counts) > 10
+
+    def testMerge(self):
+        metrics = Metrics()
+        metrics.counter("files", "Files")
+        metrics.histogram("seconds", "Seconds", (1, 10))
+        worker = Metrics()
+        worker.counter("files", "Files")
+        worker.histogram("seconds", "Seconds", (1, 10))
+        worker.inc("files", 3, {'target': "a"})
+        worker.observe("seconds", 5)
+        metrics.merge(worker.export(), {'shard': "0"})
+        worker.inc("files", 2, {'target': "a"})
+        metrics.merge(worker.export(), {'shard': "0"})  # replaces the last
+        metrics.merge(worker.export(), {'shard': "1"})
+        assert metrics.get("files", {'target': "a", 'shard': "0"}) == 5
+        assert metrics.total("files") == 10
+        assert 'seconds_count{shard="1"} 1' in metrics.prometheus()
+
+    def testMergeSkipsOwnMetrics(self):
+        metrics = Metrics()
+        metrics.counter("restarts", "Restarts")
+        metrics.inc("restarts", labels={'shard': "0"})
+        worker = Metrics()
+        worker.counter("restarts", "Restarts")
+        metrics.merge(worker.export(), {'shard': "0"}, ("restarts",))
+        assert metrics.get("restarts", {'shard': "0"}) == 1
+
+
+class TestSupervisor(StandInTestCase):
+
+    extra_config = {"upload_processes": 2, "rescan_interval": 1}
+
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        self.orig_interval = ShardSupervisor.report_interval
+        ShardSupervisor.report_interval = 0.2
+        self.supervisor = ShardSupervisor(2)
+        self.supervisor.restart_delay = 0.5
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.supervisor.run, 
+                                       args=(self.stop,))
+        self.today = datetime.date.today().strftime("%Y-%m-%d")
+
+    def tearDown(self):
+        self.stop.set()
+        self.thread.join()
+        self.supervisor.shutdown(10)
+        ShardSupervisor.report_interval = self.orig_interval
+        StandInTestCase.tearDown(self)
+
+    def waitFor(self, condition, timeout=30):
+        deadline = time.time() + timeout
+        while not condition():
+            assert time.time() < deadline
+            time.sleep(0.1)
+
+    def uploaded(self, paths):
+        return lambda: all(os.path.exists(os.path.join(self.processed, 
+                                    os.path.relpath(path, self.incoming)))
+                           for path in paths)
+
+    def testShardsUploadEverything(self):
+        locations = ["location%d" % n for n in range(8)]
+        assert set(shard_of(name, 2) for name in locations) == set([0, 1])
+        paths = []
+        for day in (days_ago(1), self.today):
+            for location in locations:
+                paths.append(self.make_image(day, location, 
+                                             "12-00-00-00001.jpg", size=100))
+        self.thread.start()
+        self.waitFor(self.uploaded(paths))
+        for path in paths:
+            relpath = os.path.relpath(path, self.incoming)
+            assert os.path.exists(os.path.join(self.cloud, relpath))
+        metrics = self.mod.metrics
+        self.waitFor(lambda: metrics.total("ftp_upload_files_total") == 16)
+        shards = set(dict(key)['shard'] for key 
+                     in metrics.values["ftp_upload_files_total"])
+        assert shards == set(["0", "1"])
+
+    def testCrashedProcessIsRestarted(self):
+        self.thread.start()
+        self.waitFor(lambda: None not in self.supervisor.processes)
+        crashed = self.supervisor.processes[0]
+        os.kill(crashed.pid, signal.SIGKILL)
+        self.waitFor(lambda: self.supervisor.processes[0] is not crashed)
+        assert self.mod.metrics.get("ftp_upload_process_restarts_total",
+                                    {'shard': "0"}) == 1
+        location = [name for name in ("downhill", "uphill", "sideways") 
+                    if shard_of(name, 2) == 0][0]
+        path = self.make_image(self.today, location, "12-00-00-00001.jpg",
+                               size=100)
+        self.waitFor(self.uploaded([path]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+import unittest
+import os.path
+from ftpserver import StandInTestCase
+
+
+class TestTransfer(StandInTestCase):
+
+    extra_config = {"resume_threshold": 100000}
+    sizes = (0, 1, 65535, 65536, 1024 * 1024 + 3)
+
+    def methods(self):
+        methods = ["read", "mmap"]
+        if self.mod.libc_sendfile() != None:
+            methods.append("sendfile")
+        return methods
+
+    def remote(self, name):
+        return os.path.join(self.cloud, "2013-07-01", "downhill", name)
+
+    def testMethods(self):
+        for method in self.methods():
+            self.mod.cfg.transfer_method = method
+            for size in self.sizes:
+                name = "%s-%d.jpg" % (method, size)
+                filepath = self.make_image("2013-07-01", "downhill", name, size)
+                content = open(filepath, "rb").read()
+                sent = []
+                job = self.mod.upload_job(filepath)
+                self.mod.send_files(job[0], [(filepath, name, job[2])],
+                                    callback=sent.append)
+                assert open(self.remote(name), "rb").read() == content, name
+                assert sum(sent) == size, (name, sent)
+
+    def testResume(self):
+        size = 400000
+        for method in self.methods():
+            self.mod.cfg.transfer_method = method
+            self.server.drop_after_bytes = 150000
+            self.server.drop_count = 1
+            self.server.bytes_received = 0
+            name = "%s.mp4" % method
+            filepath = self.make_image("2013-07-01", "downhill", name, size)
+            content = open(filepath, "rb").read()
+            self.mod.storefile(*self.mod.upload_job(filepath))
+            assert open(self.remote(name), "rb").read() == content, method
+            assert self.server.bytes_received == size, method
+
+    def testAutoPicksSendfile(self):
+        self.mod.cfg.transfer_method = "auto"
+        if self.mod.libc_sendfile() != None:
+            assert self.mod.transfer_method() == "sendfile"
+        else:
+            assert self.mod.transfer_method() == "mmap"
+
+
+if __name__ == "__main__":
+    unittest.main()
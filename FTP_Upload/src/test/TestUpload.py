@@ -139,16 +139,16 @@ class MockFTP(ftplib.FTP):
     def clearRandomConnectException(cls):
         cls.randomConnectException = False    
         
-    def connect(self, host):
+    def connect(self, host, port=0):
         if MockFTP.randomConnectException and random.randint(1,5)==1:
 #             if MockFTP.origFTP != None:
 #                 MockFTP.origFTP.quit(self)  # don't leave the test FTP server dangling
             raise Exception("Test exception to simulate failure on FTP.connect(host)")
         else:
             if MockFTP.origFTP == None:
-                ftplib.FTP.connect(self, host)
+                ftplib.FTP.connect(self, host, port)
             else:
-                MockFTP.origFTP.connect(self, host)
+                MockFTP.origFTP.connect(self, host, port)
         
     @classmethod
     def setRandomStorbinaryException(cls):
@@ -158,7 +158,8 @@ class MockFTP(ftplib.FTP):
     def clearRandomStorbinaryException(cls):
         cls.randomStorbinaryException = False    
         
-    def storbinary(self, command, filehandle):
+    def storbinary(self, command, filehandle, blocksize=8192, callback=None,
+                   rest=None):
         if MockFTP.randomConnectException and random.randint(1,5)==1:
 #            Commented out next three lines because ftp_upload will call quit 
 #            (seems like there should be a better way, though) XXX
@@ -168,9 +169,11 @@ class MockFTP(ftplib.FTP):
             raise Exception("Test exception to simulate failure on FTP.storbinary(command, file)")
         else:
             if MockFTP.origFTP == None:
-                ftplib.FTP.storbinary(self, command, filehandle)
+                ftplib.FTP.storbinary(self, command, filehandle, blocksize,
+                                      callback, rest)
             else:
-                MockFTP.origFTP.storbinary(self, command, filehandle)
+                MockFTP.origFTP.storbinary(self, command, filehandle, 
+                                           blocksize, callback, rest)
         
 def buildImages(rootPath, day, location, time, startingSeq, count):
     """Build the incoming directories and files to simulate the cameras
@@ -234,6 +237,13 @@ class Test(unittest.TestCase):
         # Set up the testing values for the ftp_upload global vars
         #
         assert mod.get_config(test_conf) == True
+        # retry the randomly failed uploads quickly
+        mod.cfg.retry_base_delay = 0.1
+        mod.cfg.retry_max_delay = 1
+        # send through MockFTP.storbinary() so its failures are injected
+        mod.cfg.transfer_method = "read"
+        # buildImages() writes each image in one go
+        mod.cfg.quiet_period = 0
         
         mod.set_up_logging()
         
@@ -402,15 +412,20 @@ class Test(unittest.TestCase):
         else:
             logging.info("terminateTestUpload (sleepHook) called from non-main thread")
 
-    def waitForThreads(self):   # XXX needs fixing: must wait until enumerate only shows main and Thread-1
+    def waitForThreads(self):
+        # wait for the day threads to finish queueing files, then for the
+        # upload workers (which never exit on their own) to drain the queue
         wait = True
         while wait:
             wait = False
             for thread in threading.enumerate():
-                if self.origThreadList.count(thread) == 0:
+                if self.origThreadList.count(thread) == 0 \
+                        and not thread.name.startswith("upload-"):
                     logging.info("waitForThreads: waiting for "+thread.name)
                     wait = True
                     thread.join()
+        if ftp_upload.upload_executor != None:
+            ftp_upload.upload_executor.join()
         logging.info("waitForThreads: done waiting for all threads")
                         
     def continueTestUpload(self, seconds):
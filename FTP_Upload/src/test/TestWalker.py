@@ -0,0 +1,79 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import unittest
+import os.path
+import tempfile
+import shutil
+import types
+import ftp_upload
+
+
+class TestWalker(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="ftp_upload_test")
+        for relpath in ("2013-07-01/downhill/a.jpg", "2013-07-01/downhill/b.jpg",
+                        "2013-07-01/uphill/c.jpg", "2013-06-30/uphill/d.jpg",
+                        "notaday/e.jpg", "f.jpg"):
+            path = os.path.join(self.root, relpath)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, "w").close()
+        self.orig_scandir = ftp_upload.scandir
+
+    def tearDown(self):
+        ftp_upload.scandir = self.orig_scandir
+        shutil.rmtree(self.root, True)
+
+    def checkWalk(self):
+        walk = ftp_upload.walk_tree(os.path.join(self.root, "2013-07-01"))
+        assert isinstance(walk, types.GeneratorType)
+        entries = [(relpath, is_file) for (unused_path, relpath, is_file)
+                   in walk]
+        assert sorted(entries) == [
+            ("downhill", False),
+            (os.path.join("downhill", "a.jpg"), True),
+            (os.path.join("downhill", "b.jpg"), True),
+            ("uphill", False),
+            (os.path.join("uphill", "c.jpg"), True)]
+        # each directory comes after everything in it
+        for relpath, is_file in entries:
+            if not is_file:
+                later = entries[entries.index((relpath, False)):]
+                assert not [r for (r, f) in later
+                            if r.startswith(relpath + os.sep)]
+
+        assert ftp_upload.get_daydirs(self.root) == [
+            (os.path.join(self.root, "2013-06-30"), "2013-06-30"),
+            (os.path.join(self.root, "2013-07-01"), "2013-07-01")]
+
+    def testWalk(self):
+        self.checkWalk()
+
+    def testWalkWithoutScandir(self):
+        ftp_upload.scandir = None
+        self.checkWalk()
+
+
+if __name__ == "__main__":
+    unittest.main()
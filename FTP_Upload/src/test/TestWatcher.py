@@ -0,0 +1,86 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import unittest
+import os.path
+import platform
+import datetime
+from ftpserver import StandInTestCase, days_ago
+
+
+@unittest.skipUnless(platform.system() == "Linux", "inotify is Linux only")
+class TestWatcher(StandInTestCase):
+
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        self.watcher = self.mod.start_watcher(self.incoming)
+        assert self.watcher != None
+
+    def tearDown(self):
+        self.watcher.close()
+        StandInTestCase.tearDown(self)
+
+    def testReportsClosedFiles(self):
+        os.makedirs(os.path.join(self.incoming, "2013-07-01", "downhill"))
+        assert self.watcher.read(0.5) == []     # directories aren't reported
+        path = self.make_image("2013-07-01", "downhill", "12-00-00-00001.jpg")
+        assert self.watcher.read(1) == [path]
+
+    def testReportsMovedFiles(self):
+        os.makedirs(os.path.join(self.incoming, "2013-07-01", "downhill"))
+        self.watcher.read(0.1)
+        tmp = os.path.join(self.root, "12-00-00-00001.jpg")
+        open(tmp, "w").close()
+        path = os.path.join(self.incoming, "2013-07-01", "downhill",
+                            "12-00-00-00001.jpg")
+        os.rename(tmp, path)
+        assert self.watcher.read(1) == [path]
+
+    def testNewFilesAreUploaded(self):
+        today = datetime.date.today().strftime("%Y-%m-%d")
+        os.makedirs(os.path.join(self.incoming, today, "uphill"))
+        self.watcher.read(0.1)
+        self.make_image(today, "uphill", "08-00-00-00001.jpg")
+        self.mod.watch_incoming(self.watcher, 1)
+        self.mod.get_upload_executor().join()
+        # the day and location directories are created on the server
+        assert os.path.exists(os.path.join(self.cloud, today, "uphill",
+                                           "08-00-00-00001.jpg"))
+        assert os.path.exists(os.path.join(self.processed, today, "uphill",
+                                           "08-00-00-00001.jpg"))
+
+    def testUploadJob(self):
+        mod = self.mod
+        day = days_ago(1)
+        path = os.path.join(self.incoming, day, "downhill", "a.jpg")
+        (ftp_dir, filepath, donepath, filename, today) = mod.upload_job(path)
+        assert ftp_dir == "/cloud/" + day + "/downhill"
+        assert donepath == os.path.join(self.processed, day, "downhill",
+                                        "a.jpg")
+        assert filename == "a.jpg"
+        assert not today
+        assert mod.upload_job(os.path.join(self.incoming, "a.jpg")) == None
+        assert mod.upload_job(os.path.join(self.incoming, "x", "a.jpg")) == None
+
+
+if __name__ == "__main__":
+    unittest.main()
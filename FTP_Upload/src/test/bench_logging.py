@@ -0,0 +1,109 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+"""Measure what logging costs the upload threads for each file, with the
+log written synchronously or through the queue, and with the per-file
+messages at INFO, as they used to be, or at DEBUG, as they are now.
+
+The log file is written to a scratch directory.  Run from this directory
+with ftp_upload on the PYTHONPATH:
+
+    python bench_logging.py [files per thread] [threads]
+"""
+
+import sys
+import os
+import time
+import tempfile
+import shutil
+import logging
+import threading
+import ftp_upload
+
+MODES = (("sync", logging.INFO), ("sync", logging.DEBUG),
+         ("async", logging.INFO), ("async", logging.DEBUG))
+
+
+def per_file(path, level):
+    # the messages logged for each file uploaded
+    logging.log(level, "queued %s for upload", path)
+    logging.log(level, "Uploading %s", path)
+    logging.log(level, "file : %s stored on ftp", os.path.basename(path))
+    logging.log(level, "moving file to Storage")
+
+def reset_logging():
+    logger = logging.getLogger()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    ftp_upload.set_up_logging.not_done = True
+
+def run(mode, level, nfiles, nthreads):
+    cfg = ftp_upload.cfg
+    cfg.async_logging = (mode == "async")
+    cfg.logfile_log_level = logging.INFO
+    cfg.console_log_level = logging.CRITICAL
+    cfg.logfile_max_days = 1
+    ftp_upload.set_up_logging()
+    
+    def upload_thread(t):
+        for i in range(nfiles):
+            per_file("/incoming/2013-07-01/downhill/12-00-00-%05d-%d.jpg" 
+                     % (i, t), level)
+    threads = [threading.Thread(target=upload_thread, args=(t,)) 
+               for t in range(nthreads)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    logged = time.time() - start
+    reset_logging()     # waits for the queue to be written
+    written = time.time() - start
+    return logged, written
+
+def main():
+    nfiles = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    nthreads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    scratch = tempfile.mkdtemp(prefix="ftp_upload_bench")
+    cwd = os.getcwd()
+    os.chdir(scratch)   # set_up_logging() writes ftp_upload.log here
+    try:
+        reset_logging()
+        total = float(nfiles * nthreads)
+        print "%d files in each of %d threads" % (nfiles, nthreads)
+        print "%-6s %-14s %16s %16s" % ("log", "per-file level", 
+                                        "us/file, caller", "us/file, total")
+        for (mode, level) in MODES:
+            logged, written = run(mode, level, nfiles, nthreads)
+            print "%-6s %-14s %16.1f %16.1f" % (mode, 
+                                                logging.getLevelName(level),
+                                                logged * 1e6 / total,
+                                                written * 1e6 / total)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch, True)
+
+
+if __name__ == "__main__":
+    main()
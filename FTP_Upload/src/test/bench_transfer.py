@@ -0,0 +1,116 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+"""Compare the CPU time ftp_upload spends per MB sent with each transfer
+method and block size.
+
+The stand-in FTP server runs in a child process so that its own CPU time
+isn't counted.  The first row is the old path: storbinary() with 8 KiB
+blocks.  Run from this directory with ftp_upload on the PYTHONPATH:
+
+    python bench_transfer.py [file MB] [files per run]
+"""
+
+import sys
+import os.path
+import time
+import tempfile
+import shutil
+import multiprocessing
+from ftpserver import StandInFTPServer
+import ftp_upload
+
+RUNS = (("read", 8192), ("read", 65536), ("read", 262144),
+        ("mmap", 65536), ("mmap", 262144),
+        ("sendfile", 65536), ("sendfile", 262144))
+
+
+def serve(root, ready):
+    server = StandInFTPServer(root)
+    ready.put(server.port)
+    server.serve_forever()
+
+def configure(root, port):
+    confpath = os.path.join(root, "ftp_upload.conf")
+    with open(confpath, "w") as f:
+        f.write("incoming_location = %s\n" % os.path.join(root, "incoming"))
+        f.write("processed_location = %s\n" % os.path.join(root, "processed"))
+        f.write("ftp_server = 127.0.0.1\n")
+        f.write("ftp_port = %d\n" % port)
+        f.write("ftp_username = testuser\n")
+        f.write("ftp_password = testpw\n")
+        f.write("ftp_destination = cloud\n")
+        f.write("console_log_level = critical\n")
+    ftp_upload.get_config(confpath)
+
+def run(root, filepath, count, method, blocksize):
+    ftp_upload.cfg.transfer_method = method
+    ftp_upload.cfg.ftp_blocksize = blocksize
+    ftp_dir = "/cloud/%s-%d" % (method, blocksize)
+    files = [(filepath, "%d.mp4" % i, filepath) for i in range(count)]
+    start = os.times()
+    wall = time.time()
+    results = ftp_upload.send_files(ftp_dir, files)
+    wall = time.time() - wall
+    end = os.times()
+    assert set(results.values()) == set([ftp_upload.UPLOAD_OK])
+    cpu = (end[0] - start[0]) + (end[1] - start[1])
+    shutil.rmtree(os.path.join(root, "cloud", ftp_dir.split("/")[-1]))
+    return cpu, wall
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    root = tempfile.mkdtemp(prefix="ftp_upload_bench")
+    for d in ("incoming", "processed", "cloud"):
+        os.mkdir(os.path.join(root, d))
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(root, ready))
+    server.daemon = True
+    server.start()
+    try:
+        configure(root, ready.get(timeout=10))
+        filepath = os.path.join(root, "incoming", "clip.mp4")
+        with open(filepath, "wb") as f:
+            for i in range(size_mb):
+                f.write(os.urandom(1024 * 1024))
+        total_mb = float(size_mb * count)
+
+        print "%d x %d MB per run" % (count, size_mb)
+        print "%-10s %9s %12s %9s" % ("method", "blocksize", "CPU ms/MB",
+                                      "MB/s")
+        for method, blocksize in RUNS:
+            if method == "sendfile" and ftp_upload.libc_sendfile() == None:
+                continue
+            cpu, wall = run(root, filepath, count, method, blocksize)
+            print "%-10s %9d %12.2f %9.1f" % (method, blocksize,
+                                              cpu * 1000 / total_mb,
+                                              total_mb / wall)
+    finally:
+        ftp_upload.close_ftp_pool()
+        server.terminate()
+        shutil.rmtree(root, True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+
+"""Benchmark ftp_upload's upload engines against the stand-in FTP server.
+
+A synthetic camera tree is generated in a scratch directory: the given
+number of images, copies of SampleImage.jpg unless --size is given, spread
+over --days day directories (the newest of which is today) and --locations
+camera locations.  For each engine the tree is queued the way the main 
+loop does it, with storeday(), and the run ends when the executor has 
+uploaded everything.
+
+The stand-in server runs in this process, with the latency, bandwidth and
+failure injection given on the command line.  Each engine runs in a child
+process of its own, so that the CPU time and peak RSS reported are the
+uploader's alone.  The engines are configurations of ftp_upload; more can
+be compared with --engine name:item=value,item=value.  Run from this 
+directory with ftp_upload on the PYTHONPATH, e.g.:
+
+    python benchmark.py --files 2000 --days 3 --latency 0.005
+"""
+
+import sys
+import os.path
+import time
+import datetime
+import shutil
+import tempfile
+import random
+import argparse
+import logging
+import resource
+import multiprocessing
+import Queue
+import json
+import collections
+from ftpserver import StandInFTPServer, SAMPLE_IMAGE
+
+ENGINES = collections.OrderedDict([
+    ("threads", {}),
+    ("batch", {"upload_batch_size": 16}),
+    ("async", {"upload_engine": "async"}),
+])
+
+BASE_CONFIG = {
+    "ftp_destination": "cloud",
+    "console_log_level": "critical",
+    "logfile_log_level": "critical",
+    "async_logging": "False",
+    "retry_base_delay": 0.1,
+    "retry_max_delay": 1,
+    "purge_rate_limit": 0,
+    "quiet_period": 0,
+}
+
+
+def make_tree(incoming, nfiles, ndays, nlocations, size=None):
+    """Fill incoming with nfiles images spread evenly over ndays days, 
+    ending today, and nlocations locations.
+    :return: the total number of bytes in the images
+    """
+    today = datetime.date.today()
+    days = [(today - datetime.timedelta(days=n)).strftime("%Y-%m-%d")
+            for n in range(ndays)]
+    locations = ["location%d" % n for n in range(nlocations)]
+    if size == None:
+        content = open(SAMPLE_IMAGE, "rb").read()
+    else:
+        content = os.urandom(size)
+    for n in range(nfiles):
+        day = days[n % ndays]
+        location = locations[(n // ndays) % nlocations]
+        dirpath = os.path.join(incoming, day, location)
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        seconds = n // (ndays * nlocations)
+        name = "%02d-%02d-%02d-%05d.jpg" % (seconds // 3600 % 24, 
+                                            seconds // 60 % 60, seconds % 60,
+                                            n)
+        with open(os.path.join(dirpath, name), "wb") as f:
+            f.write(content)
+    return nfiles * len(content)
+
+def count_files(root):
+    return sum(len(files) for (unused, unused_dirs, files) in os.walk(root))
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+def upload_tree(confpath, results):
+    """Upload the tree with the config in confpath, in a child process, and
+    put what was measured on the results queue
+    """
+    import ftp_upload
+    latencies = []
+    record_upload = ftp_upload.record_upload
+    def record(filepath, started, target_name, source=None):
+        latencies.append(time.time() - started)
+        record_upload(filepath, started, target_name, source)
+    ftp_upload.record_upload = record
+    
+    ftp_upload.get_config.done = False
+    ftp_upload.get_config(confpath)
+    cfg = ftp_upload.cfg
+    start_times = os.times()
+    start = time.time()
+    daydirs = sorted(ftp_upload.get_daydirs(cfg.incoming_location), 
+                     reverse=True)
+    for daydir in daydirs:
+        ftp_upload.storeday(daydir, ftp_upload.isdir_today(daydir[0]))
+    ftp_upload.get_upload_executor().join()
+    wall = time.time() - start
+    end_times = os.times()
+    ftp_upload.stop_upload_executor()
+    ftp_upload.close_ftp_pool()
+    results.put({
+        'wall': wall,
+        'cpu': (end_times[0] - start_times[0]) + 
+               (end_times[1] - start_times[1]),
+        'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'latencies': latencies,
+        'retries': ftp_upload.metrics.total("ftp_upload_retries_total"),
+    })
+
+def run_engine(name, config, options, server, root):
+    incoming = os.path.join(root, "incoming")
+    processed = os.path.join(root, "processed")
+    cloud = os.path.join(root, "cloud")
+    for d in (incoming, processed, cloud):
+        shutil.rmtree(d, True)
+        os.mkdir(d)
+    nbytes = make_tree(incoming, options.files, options.days, 
+                       options.locations, options.size)
+    
+    items = dict(BASE_CONFIG)
+    items.update({
+        "incoming_location": incoming,
+        "processed_location": processed,
+        "ftp_server": server.host,
+        "ftp_port": server.port,
+        "ftp_username": server.username,
+        "ftp_password": server.password,
+    })
+    items.update(config)
+    confpath = os.path.join(root, "ftp_upload.conf")
+    with open(confpath, "w") as f:
+        for item in items.items():
+            f.write("%s = %s\n" % item)
+    
+    server.reset_counts()
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=upload_tree, 
+                                    args=(confpath, results))
+    child.start()
+    measured = None
+    while measured == None:
+        try:
+            measured = results.get(timeout=1)
+        except Queue.Empty:
+            if child.is_alive():
+                continue
+            # the results may have been put just before it exited
+            try:
+                measured = results.get(timeout=1)
+            except Queue.Empty:
+                raise RuntimeError("the %s upload process exited with code "
+                                   "%s" % (name, child.exitcode))
+    child.join()
+    
+    uploaded = count_files(cloud)
+    wall = measured['wall']
+    return collections.OrderedDict([
+        ('engine', name),
+        ('files', uploaded),
+        ('missing', options.files - uploaded),
+        ('files_per_sec', uploaded / wall),
+        ('mb_per_sec', nbytes * uploaded / float(options.files) 
+                       / 1048576 / wall),
+        ('p50_ms', percentile(measured['latencies'], 50) * 1000),
+        ('p99_ms', percentile(measured['latencies'], 99) * 1000),
+        ('cpu_sec', measured['cpu']),
+        ('cpu_ms_per_file', measured['cpu'] * 1000 / max(1, uploaded)),
+        ('maxrss_mb', measured['maxrss'] / 1024.0),
+        ('retries', measured['retries']),
+        ('commands', server.count("STOR") + server.count("CWD") + 
+                     server.count("MKD") + server.count("PASV") + 
+                     server.count("EPSV")),
+    ])
+
+def parse_engine(arg):
+    """Parse "name" or "name:item=value,item=value" into (name, config)"""
+    (name, unused, items) = arg.partition(":")
+    if not items:
+        if name not in ENGINES:
+            raise argparse.ArgumentTypeError("unknown engine %s" % name)
+        return (name, ENGINES[name])
+    config = {}
+    for item in items.split(","):
+        (key, value) = item.split("=", 1)
+        config[key.strip()] = value.strip()
+    return (name, config)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark ftp_upload's "
+                                     "upload engines.")
+    parser.add_argument("--files", type=int, default=1000,
+                        help="images in the tree (default 1000)")
+    parser.add_argument("--days", type=int, default=2,
+                        help="day directories, ending today (default 2)")
+    parser.add_argument("--locations", type=int, default=2,
+                        help="camera locations (default 2)")
+    parser.add_argument("--size", type=int,
+                        help="image size in bytes; default is a copy of "
+                        "SampleImage.jpg")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds the server waits before each reply")
+    parser.add_argument("--bandwidth", type=int,
+                        help="server's bytes/second per data transfer")
+    parser.add_argument("--fail-rate", type=float, default=0.0,
+                        help="probability that a STOR fails with 451")
+    parser.add_argument("--max-connections", type=int,
+                        help="server replies 421 beyond this many sessions")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="seed for the failure injection")
+    parser.add_argument("--engine", type=parse_engine, action="append",
+                        help="an engine in %s, or name:item=value,... to "
+                        "try other config items; may be repeated.  "
+                        "Default is all of them" % ", ".join(ENGINES))
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as JSON")
+    return parser.parse_args(argv)
+
+def run_benchmark(options):
+    """Run each of the engines in options and return what was measured"""
+    engines = options.engine or ENGINES.items()
+    random.seed(options.seed)
+    root = tempfile.mkdtemp(prefix="ftp_upload_bench")
+    server = StandInFTPServer(root).start()
+    server.latency = options.latency
+    server.bandwidth = options.bandwidth
+    server.fail_rate = options.fail_rate
+    server.max_connections = options.max_connections
+    try:
+        results = [run_engine(name, config, options, server, root) 
+                   for (name, config) in engines]
+    finally:
+        server.stop()
+        shutil.rmtree(root, True)
+    return results
+
+def main(argv=None):
+    options = parse_args(argv)
+    results = run_benchmark(options)
+    if options.json:
+        print json.dumps(results, indent=1)
+        return
+    print ("%d files over %d days and %d locations; latency %gs, "
+           "fail rate %g" % (options.files, options.days, options.locations,
+                             options.latency, options.fail_rate))
+    print "%-10s %7s %8s %7s %8s %8s %8s %10s %8s %7s" % ("engine", 
+            "files", "files/s", "MB/s", "p50 ms", "p99 ms", "CPU s", 
+            "CPU ms/f", "RSS MB", "retries")
+    for r in results:
+        print "%-10s %7d %8.1f %7.2f %8.1f %8.1f %8.2f %10.2f %8.1f %7d" % (
+                r['engine'], r['files'], r['files_per_sec'], r['mb_per_sec'],
+                r['p50_ms'], r['p99_ms'], r['cpu_sec'], 
+                r['cpu_ms_per_file'], r['maxrss_mb'], r['retries'])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.CRITICAL)
+    main()
@@ -0,0 +1,577 @@
+################################################################################
+#
+# Copyright (C) 2013-2018 Neighborhood Guard, Inc.  All rights reserved.
+# Original author: Douglas Kerr
+#
+# This file is part of FTP_Upload.
+#
+# FTP_Upload is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FTP_Upload is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with FTP_Upload.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+"""A small in-process FTP server to stand in for the cloud server in tests.
+
+The server implements just enough of RFC 959 (plus SIZE, REST, EPSV and
+SITE CPFR/CPTO) for ftplib and ftp_upload to work against it.  Each 
+instance serves a single account rooted at a local directory.  Paths are
+resolved as strings against the root, so the server never changes the
+process's working directory and can safely run alongside the code under
+test.
+
+Knobs are provided to inject latency, limit bandwidth and simulate failures
+so that tests and benchmarks can exercise ftp_upload's error handling.
+StandInTestCase is a unittest base class that points ftp_upload at a fresh
+server and scratch directory tree for each test.
+"""
+
+import SocketServer
+import socket
+import threading
+import posixpath
+import os
+import time
+import random
+import errno
+import tempfile
+import shutil
+import unittest
+import datetime
+
+SAMPLE_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "SampleImage.jpg")
+
+
+def days_ago(days):
+    """Return the name of the day directory for days before today.  Call it
+    while the test runs, since TestUpload replaces datetime.date to change
+    what today is.
+    """
+    day = datetime.date.today() - datetime.timedelta(days=days)
+    return day.strftime("%Y-%m-%d")
+
+
+class StandInFTPServer(SocketServer.ThreadingTCPServer):
+    """Threaded FTP server for testing.
+
+    :param root: local directory that is the login directory of the account.
+    :param username: the account's user name.
+    :param password: the account's password.
+    :param host: address to listen on.
+    :param port: port to listen on; 0 picks a free port (see self.port).
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 64
+
+    def __init__(self, root, username="testuser", password="testpw",
+                 host="127.0.0.1", port=0):
+        SocketServer.ThreadingTCPServer.__init__(self, (host, port),
+                                                 StandInFTPHandler)
+        self.root = os.path.abspath(root)
+        self.username = username
+        self.password = password
+        self.host, self.port = self.server_address
+
+        # fault injection and shaping knobs, may be changed at any time
+        #
+        self.latency = 0.0          # seconds added before each reply
+        self.bandwidth = None       # max bytes/sec per data transfer
+        self.drop_after_bytes = None # cut STOR/APPE after this many bytes
+        self.drop_count = 0         # number of transfers to cut; -1 = all
+        self.max_connections = None # reply 421 beyond this many sessions
+        self.fail_rate = 0.0        # probability a STOR fails with 451
+        self.allow_rest = True      # False: REST is refused with 502
+        self.allow_site_copy = True # False: SITE CPFR/CPTO are refused
+
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.command_counts = {}
+        self.bytes_received = 0
+        self._thread = None
+
+    def start(self):
+        """Serve requests in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name="StandInFTPServer")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the listening socket."""
+        self.shutdown()
+        self.server_close()
+        if self._thread != None:
+            self._thread.join()
+
+    def count(self, cmd):
+        """Return the number of times cmd has been received."""
+        with self.lock:
+            return self.command_counts.get(cmd, 0)
+
+    def reset_counts(self):
+        with self.lock:
+            self.command_counts = {}
+            self.bytes_received = 0
+
+    def _note_command(self, cmd):
+        with self.lock:
+            self.command_counts[cmd] = self.command_counts.get(cmd, 0) + 1
+
+    def _should_drop(self):
+        with self.lock:
+            if self.drop_after_bytes == None or self.drop_count == 0:
+                return False
+            if self.drop_count > 0:
+                self.drop_count -= 1
+            return True
+
+
+class StandInFTPHandler(SocketServer.StreamRequestHandler):
+    """Handle one FTP control connection."""
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        # send each reply straight away, as real servers do, rather than
+        # holding it back until the client acks the one before, which 
+        # would add a delayed ack to every upload
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.user = None
+        self.logged_in = False
+        self.cwd = "/"
+        self.rest = 0
+        self.rnfr = None
+        self.cpfr = None
+        self.pasv_sock = None
+        self.counted = False
+
+    def handle(self):
+        srv = self.server
+        with srv.lock:
+            srv.connections += 1
+            self.counted = True
+            too_many = (srv.max_connections != None and
+                        srv.connections > srv.max_connections)
+        if too_many:
+            self.reply("421 Too many connections")
+            return
+        self.reply("220 FTP_Upload stand-in server ready")
+        while True:
+            try:
+                line = self.rfile.readline()
+            except socket.error:
+                return
+            if not line:
+                return
+            line = line.rstrip("\r\n")
+            cmd, _, arg = line.partition(" ")
+            cmd = cmd.upper()
+            srv._note_command(cmd)
+            method = getattr(self, "ftp_" + cmd, None)
+            if method == None:
+                self.reply("502 Command not implemented")
+                continue
+            if not self.logged_in and cmd not in ("USER", "PASS", "QUIT",
+                                                  "FEAT", "SYST"):
+                self.reply("530 Not logged in")
+                continue
+            try:
+                if method(arg) == "quit":
+                    return
+            except _Dropped:
+                return
+            except (IOError, OSError), e:
+                self.reply("550 %s" % e.strerror)
+            except socket.error:
+                return
+
+    def finish(self):
+        if self.counted:
+            with self.server.lock:
+                self.server.connections -= 1
+        self._close_pasv()
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def reply(self, text):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.wfile.write(text + "\r\n")
+        self.wfile.flush()
+
+    #
+    # path handling
+    #
+
+    def vpath(self, arg):
+        """Return the normalized virtual path for arg."""
+        return posixpath.normpath(posixpath.join(self.cwd, arg or "."))
+
+    def realpath(self, arg):
+        return os.path.join(self.server.root,
+                            self.vpath(arg).lstrip("/").replace("/", os.sep))
+
+    #
+    # commands
+    #
+
+    def ftp_USER(self, arg):
+        self.user = arg
+        self.reply("331 Password required")
+
+    def ftp_PASS(self, arg):
+        if self.user == self.server.username and arg == self.server.password:
+            self.logged_in = True
+            self.reply("230 Logged in")
+        else:
+            self.reply("530 Login incorrect")
+
+    def ftp_QUIT(self, arg):
+        self.reply("221 Goodbye")
+        return "quit"
+
+    def ftp_SYST(self, arg):
+        self.reply("215 UNIX Type: L8")
+
+    def ftp_FEAT(self, arg):
+        self.wfile.write("211-Features:\r\n SIZE\r\n REST STREAM\r\n EPSV\r\n")
+        self.reply("211 End")
+
+    def ftp_NOOP(self, arg):
+        self.reply("200 NOOP ok")
+
+    def ftp_TYPE(self, arg):
+        self.reply("200 Type set to %s" % arg)
+
+    def ftp_MODE(self, arg):
+        if arg.upper() == "S":
+            self.reply("200 Mode set to S")
+        else:
+            self.reply("504 Unsupported mode")
+
+    def ftp_PWD(self, arg):
+        self.reply('257 "%s" is the current directory' % self.cwd)
+    ftp_XPWD = ftp_PWD
+
+    def ftp_CWD(self, arg):
+        if os.path.isdir(self.realpath(arg)):
+            self.cwd = self.vpath(arg)
+            self.reply("250 CWD command successful")
+        else:
+            self.reply("550 %s: No such file or directory" % arg)
+
+    def ftp_CDUP(self, arg):
+        return self.ftp_CWD("..")
+
+    def ftp_MKD(self, arg):
+        # like ProFTPd, only one level of directory is created at a time
+        try:
+            os.mkdir(self.realpath(arg))
+        except OSError, e:
+            self.reply("550 %s: %s" % (arg, e.strerror))
+            return
+        self.reply('257 "%s" created' % self.vpath(arg))
+
+    def ftp_RMD(self, arg):
+        os.rmdir(self.realpath(arg))
+        self.reply("250 RMD command successful")
+
+    def ftp_DELE(self, arg):
+        os.remove(self.realpath(arg))
+        self.reply("250 DELE command successful")
+
+    def ftp_RNFR(self, arg):
+        if os.path.exists(self.realpath(arg)):
+            self.rnfr = self.realpath(arg)
+            self.reply("350 Ready for RNTO")
+        else:
+            self.reply("550 %s: No such file or directory" % arg)
+
+    def ftp_RNTO(self, arg):
+        if self.rnfr == None:
+            self.reply("503 Bad sequence of commands")
+            return
+        os.rename(self.rnfr, self.realpath(arg))
+        self.rnfr = None
+        self.reply("250 Rename successful")
+
+    def ftp_SIZE(self, arg):
+        path = self.realpath(arg)
+        if os.path.isfile(path):
+            self.reply("213 %d" % os.path.getsize(path))
+        else:
+            self.reply("550 %s: No such file or directory" % arg)
+
+    def ftp_REST(self, arg):
+        if not self.server.allow_rest:
+            self.reply("502 Command not implemented")
+            return
+        try:
+            self.rest = int(arg)
+        except ValueError:
+            self.reply("501 Bad offset")
+            return
+        self.reply("350 Restarting at %d" % self.rest)
+
+    def ftp_PASV(self, arg):
+        self._open_pasv()
+        host, port = self.pasv_sock.getsockname()
+        self.reply("227 Entering Passive Mode (%s,%d,%d)" %
+                   (host.replace(".", ","), port >> 8, port & 0xff))
+
+    def ftp_EPSV(self, arg):
+        self._open_pasv()
+        port = self.pasv_sock.getsockname()[1]
+        self.reply("229 Entering Extended Passive Mode (|||%d|)" % port)
+
+    def ftp_STOR(self, arg):
+        self._store(arg, "r+b" if self.rest else "wb")
+
+    def ftp_APPE(self, arg):
+        self.rest = 0
+        self._store(arg, "ab")
+
+    def ftp_RETR(self, arg):
+        path = self.realpath(arg)
+        if not os.path.isfile(path):
+            self.reply("550 %s: No such file or directory" % arg)
+            return
+        data = self._accept_data()
+        if data == None:
+            return
+        self.reply("150 Opening BINARY mode data connection")
+        with open(path, "rb") as f:
+            f.seek(self.rest)
+            self.rest = 0
+            while True:
+                buf = f.read(8192)
+                if not buf:
+                    break
+                data.sendall(buf)
+        data.close()
+        self.reply("226 Transfer complete")
+
+    def ftp_NLST(self, arg):
+        self._list(arg, lambda path, name: name)
+
+    def ftp_LIST(self, arg):
+        def fmt(path, name):
+            if os.path.isdir(path):
+                return "drwxr-xr-x 1 owner group 0 Jan 01 00:00 " + name
+            return ("-rw-r--r-- 1 owner group %d Jan 01 00:00 %s" %
+                    (os.path.getsize(path), name))
+        self._list(arg, fmt)
+
+    def ftp_SITE(self, arg):
+        # SITE CPFR/CPTO copy a file on the server, as ProFTPD's mod_copy
+        cmd, _, path = arg.partition(" ")
+        cmd = cmd.upper()
+        if not self.server.allow_site_copy or cmd not in ("CPFR", "CPTO"):
+            self.reply("504 SITE command not implemented")
+        elif cmd == "CPFR":
+            if os.path.isfile(self.realpath(path)):
+                self.cpfr = self.realpath(path)
+                self.reply("350 File exists, ready for destination name")
+            else:
+                self.reply("550 %s: No such file or directory" % path)
+        elif self.cpfr == None:
+            self.reply("503 Bad sequence of commands")
+        else:
+            shutil.copyfile(self.cpfr, self.realpath(path))
+            self.cpfr = None
+            self.reply("250 Copy successful")
+
+    #
+    # data connection helpers
+    #
+
+    def _open_pasv(self):
+        self._close_pasv()
+        self.pasv_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.pasv_sock.bind((self.server.host, 0))
+        self.pasv_sock.listen(1)
+        self.pasv_sock.settimeout(30)
+
+    def _close_pasv(self):
+        if self.pasv_sock != None:
+            try:
+                self.pasv_sock.close()
+            except socket.error:
+                pass
+            self.pasv_sock = None
+
+    def _accept_data(self):
+        if self.pasv_sock == None:
+            self.reply("425 Use PASV or EPSV first")
+            return None
+        try:
+            data, unused_addr = self.pasv_sock.accept()
+        except socket.error:
+            self.reply("425 Can't open data connection")
+            return None
+        finally:
+            self._close_pasv()
+        return data
+
+    def _store(self, arg, mode):
+        srv = self.server
+        path = self.realpath(arg)
+        if not os.path.isdir(os.path.dirname(path)):
+            self.reply("553 %s: No such file or directory" % arg)
+            self._close_pasv()
+            return
+        if os.path.isdir(path):
+            self.reply("550 %s: Is a directory" % arg)
+            self._close_pasv()
+            return
+        if srv.fail_rate and random.random() < srv.fail_rate:
+            self.reply("451 Requested action aborted: simulated failure")
+            self._close_pasv()
+            return
+        data = self._accept_data()
+        if data == None:
+            return
+        drop = srv._should_drop()
+        self.reply("150 Opening BINARY mode data connection")
+        if mode == "r+b" and not os.path.exists(path):
+            mode = "wb"
+        received = 0
+        started = time.time()
+        with open(path, mode) as f:
+            if mode == "r+b":
+                f.seek(self.rest)
+                f.truncate()
+            self.rest = 0
+            while True:
+                limit = 65536
+                if drop:
+                    limit = min(limit, srv.drop_after_bytes - received)
+                    if limit <= 0:
+                        break
+                buf = data.recv(limit)
+                if not buf:
+                    break
+                f.write(buf)
+                received += len(buf)
+                if srv.bandwidth:
+                    ahead = received / float(srv.bandwidth) - \
+                            (time.time() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        with srv.lock:
+            srv.bytes_received += received
+        if drop:
+            # simulate the link going away in the middle of the transfer
+            data.close()
+            try:
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except socket.error, e:
+                if e.errno != errno.ENOTCONN:
+                    raise
+            raise _Dropped()
+        data.close()
+        self.reply("226 Transfer complete")
+
+    def _list(self, arg, fmt):
+        path = self.realpath(arg if arg and not arg.startswith("-") else ".")
+        if not os.path.isdir(path):
+            self.reply("550 No such directory")
+            return
+        data = self._accept_data()
+        if data == None:
+            return
+        self.reply("150 Here comes the directory listing")
+        for name in sorted(os.listdir(path)):
+            data.sendall(fmt(os.path.join(path, name), name) + "\r\n")
+        data.close()
+        self.reply("226 Directory send OK")
+
+
+class _Dropped(Exception):
+    """Raised to abandon a control connection after a simulated drop."""
+    pass
+
+
+class StandInTestCase(unittest.TestCase):
+    """Base class for tests that run ftp_upload against a StandInFTPServer.
+
+    setUp() builds a scratch tree holding the incoming, processed and
+    cloud directories, starts a server whose login directory is the scratch
+    tree, and loads an ftp_upload configuration that points at it.  Extra
+    config items can be supplied by overriding extra_config.
+    """
+
+    extra_config = {}
+
+    def setUp(self):
+        import ftp_upload
+        self.mod = ftp_upload
+        self.root = tempfile.mkdtemp(prefix="ftp_upload_test")
+        self.incoming = os.path.join(self.root, "incoming")
+        self.processed = os.path.join(self.root, "processed")
+        self.cloud = os.path.join(self.root, "cloud")
+        for d in (self.incoming, self.processed, self.cloud):
+            os.mkdir(d)
+        self.server = StandInFTPServer(self.root).start()
+
+        items = {
+            "incoming_location": self.incoming,
+            "processed_location": self.processed,
+            "ftp_server": self.server.host,
+            "ftp_port": self.server.port,
+            "ftp_username": self.server.username,
+            "ftp_password": self.server.password,
+            "ftp_destination": "cloud",
+            "console_log_level": "critical",
+            # the images the tests make are complete as soon as they're made
+            "quiet_period": 0,
+        }
+        items.update(self.extra_config)
+        confpath = os.path.join(self.root, "ftp_upload.conf")
+        with open(confpath, "w") as f:
+            for name, value in items.items():
+                f.write("%s = %s\n" % (name, value))
+        self.mod.get_config.done = False
+        assert self.mod.get_config(confpath)
+
+    def tearDown(self):
+        self.mod.stop_recompressor()
+        self.mod.stop_upload_executor()
+        self.mod.close_ftp_pool()
+        self.mod.reset_rate_limiter()
+        self.mod.metrics.reset()
+        self.mod.close_dedup_index()
+        self.mod.reset_readiness()
+        self.mod.get_config.done = False
+        self.server.stop()
+        shutil.rmtree(self.root, True)
+
+    def make_image(self, day, location, name, size=None):
+        """Create an image file in the incoming tree and return its path.
+        :param size: size of the file in bytes; default is a copy of
+        SampleImage.jpg
+        """
+        dirpath = os.path.join(self.incoming, day, location)
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        path = os.path.join(dirpath, name)
+        if size == None:
+            shutil.copy(SAMPLE_IMAGE, path)
+        else:
+            with open(path, "wb") as f:
+                f.write(os.urandom(size))
+        return path